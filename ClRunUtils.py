@@ -1,6 +1,8 @@
 import numpy as np
-import os,  shutil, copy_reg, types
-from CosmParams import Cosmology
+import os,  shutil, copy_reg, types, hashlib, itertools
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from CosmParams import Cosmology, tabulate_bkgd_batch
 #Classes which will be useful for computing Cl's
 
 
@@ -118,13 +120,134 @@ class RunData(object):
 #       below where j_l(x) first becomes > epsilon
 # noilktag: if True, and if ilktag not passed, doesn't set ilktag=tag,
 #       just leaves it as an empty string
+# ilkmethod: how Ilk integrals are done. options are
+#       'quad' - adaptive quad for each (l,k) pair, uses krcut approx
+#       'grid' - window and background fns put on a shared r-grid, then
+#                all k for one ell are done as a matrix product against
+#                a table of spherical bessel fns. exact bessel fns, no krcut
+#       'levin' - adaptive levin collocation for each (l,k) pair; cost is
+#                nearly independent of k, exact bessel fns, no krcut
+#       'fftlog' - all k for one ell from a single FFT over a log r-grid,
+#                using the log-uniform spacing of kdata.karray
+#   Separately from ilkmethod, if a shell basis file made by
+#       computeIlk_shellbasis is stored (see ilkcachedir) and matches the run, Ilk
+#       for any window it resolves is a weighted sum over shells.
+# ilkcachedir: if nonempty, Ilk files are stored here under a hash of the
+#       window, cosmology, k lattice, and integral settings (see ilkhash),
+#       so identical Ilk are shared between runs without tag bookkeeping.
+#       if empty, Ilk files go in ilkdir labeled by ilktag/iswilktag
+# ilkformat: format new Ilk files are written in; either format is read.
+#       'npy' - binary .npy array [ell,k] + .json sidecar, memory mappable
+#       'text' - text table with header, as written by older versions
+# clformat: format new C_l files are written in; either format is read.
+#       'npy' - binary .npy array [pair,ell] + .json sidecar, memory mapped
+#               so a subset of maps can be read without loading all pairs
+#       'text' - text table with header, as written by older versions
+# clmethod: how the k integral for non-Limber C_l is done. options are
+#       'quad' - adaptive quad over cubic interpolated Ilk for each
+#                (pair, ell); the reference method
+#       'grid' - Ilk for all maps are on the same ln k grid, so C_l for
+#                all pairs and ells come from one simpson-weighted sum
+# limbermethod: how Limber approx C_l (ell>=limberl) are done. options are
+#       'quad' - adaptive quad in z for each (pair, ell); the reference
+#       'grid' - windows, background fns, and P((l+1/2)/r) for all ells
+#                put on one z-grid, then all pairs and ells are sums on it
+# clsparse: if True, C_l are computed exactly for all ells up to
+#       clsparse_ldense, then at ells spaced by clsparse_dlnl in ln(ell),
+#       bisecting intervals until a spline of l(l+1)C_l in ln(ell) matches
+#       computed midpoints to clsparse_tol (rel to sqrt(C_l^ii C_l^jj));
+#       the rest of lvals are filled in from that spline
+# limberauto: if True, limberl is ignored and each pair of maps gets its own
+#       switch to Limber: exact and Limber C_l are compared at the ells in
+#       limberauto_lprobe, the error is taken to fall as 1/(l+1/2)^2, and
+#       Limber is used from where that puts it below limberauto_tol (rel
+#       to sqrt(C_l^ii C_l^jj)). Ilk are only computed for the ells a
+#       map's pairs need.
+# tabmethod: how the background cosmology fns are tabulated, see
+#       Cosmology in CosmParams. 'gauss' (default) or 'quad'
+# pkmethod: where the matter power spectrum comes from, see Cosmology in
+#       CosmParams. 'camb' (default) runs CAMB, 'eh' computes it in-process
+# cosmparams: dict of param labels as in cosmpfile (e.g. 'Och2','h0') and
+#       values that replace the file's; see get_ClRunData_batch
+# executormode: how Ilk and C_l tasks are run, see TaskExecutor. one
+#       executor is kept for the life of the ClRunData; its workers are
+#       reused by every stage of a computeCl call and closed when it
+#       returns. 'process' (default), 'thread', 'serial'
 ###########################################################################
 class ClRunData(RunData):
     zintlim=10000
     kintlim=10000
-    def __init__(self,tag='',ilktag='',iswilktag='',rundir='output/',cosmpfile='testparam.cosm',kdata=0,lmax=0,lvals=np.array([]),zmax=2.,limberl=20,epsilon=1.e-10,cosm_zrhgf_bkgrd=np.array([]),pk_ext=np.array([]),sharpkcut=False,besselxmincut=True,noilktag=False,nperz=200.):
+    ilkmethods=['quad','grid','levin','fftlog']
+    ilkformats=['npy','text']
+    clformats=['npy','text']
+    clmethods=['quad','grid']
+    limbermethods=['quad','grid']
+    #settings for ilkmethod='grid'
+    ilkgrid_nperosc=20 #r-grid pts per oscillation of j_l(kr) at largest k in block
+    ilkgrid_nperz=2000 #min r-grid pts per unit z
+    ilkgrid_nperedge=10 #min r-grid pts per width of smoothed window edge
+    ilkgrid_maxelements=4.e6 #max size of bessel table held in memory at once
+    #settings for ilkmethod='levin'
+    levin_npts=16 #collocation points per segment
+    levin_maxdepth=20 #max number of times a segment gets bisected
+    #settings for ilkmethod='fftlog'; r-resolution set by ilkgrid_ settings
+    fftlog_padlogk=2. #decades of padding added to both ends of k range
+    fftlog_q=0.5 #power law bias of fftlog, need -l<q<2
+    ilkchunk_nk=100 #k values per saved chunk when computing Ilk for each (l,k)
+    #settings for clmethod='grid'
+    clgrid_nsub=4 #interpolated pts per ln k step of kdata in C_l sums
+    #settings for limbermethod='grid'
+    limbergrid_nperz=1000 #z-grid pts per unit z
+    limbergrid_nperedge=10 #extra z-grid pts per width of smoothed window edge
+    limbergrid_nedge=5 #refine this many edge widths either side of each edge
+    #pairs of different maps whose window overlap (see window_overlaps in
+    # genCrossCor) is below this aren't computed, and are left out of docross
+    # so they can be computed later by lowering it; 0 computes all pairs
+    cloverlap_tol=0.
+    #settings for clsparse=True
+    clsparse_ldense=30 #all ells up to this are computed
+    clsparse_dlnl=0.2 #initial spacing in ln(ell) of computed ells above that
+    clsparse_tol=1.e-3 #max interpolation error, rel to sqrt(C_l^ii C_l^jj)
+    #settings for limberauto=True
+    limberauto_lprobe=[10,20,40] #ells where exact and Limber C_l are compared
+    limberauto_tol=1.e-3 #max Limber error, rel to sqrt(C_l^ii C_l^jj)
+    logtasktimes=False #append per-task times and cost estimates to tasktimes_*.dat; for calibrating task costs
+    #settings for Ilk shell basis, used by getIlk_for_binmap when available
+    useilkshells=True #if False, always compute Ilk directly
+    ilkshell_dr=5. #comoving width [Mpc/h] of hat fn shells
+    ilkshell_tol=1.e-4 #max integrated rel err of kernel interp'd between shells
+    ilkshell_ncheck=8 #pts per shell used to check interp err
+    def __init__(self,tag='',ilktag='',iswilktag='',rundir='output/',cosmpfile='testparam.cosm',kdata=0,lmax=0,lvals=np.array([]),zmax=2.,limberl=20,epsilon=1.e-10,cosm_zrhgf_bkgrd=np.array([]),pk_ext=np.array([]),sharpkcut=False,besselxmincut=True,noilktag=False,nperz=200.,ilkmethod='quad',ilkcachedir='output/Ilkcache/',ilkformat='npy',clformat='npy',clmethod='quad',limbermethod='quad',clsparse=False,limberauto=False,tabmethod='gauss',pkmethod='camb',cosmparams={},executormode='process'):
         RunData.__init__(self,tag,rundir,cosmpfile,lmax,lvals,clrundat=True)
         self.limberl=limberl
+        if ilkmethod not in self.ilkmethods:
+            print "***WARNING: unknown ilkmethod '{0:s}', using 'quad'.".format(ilkmethod)
+            ilkmethod='quad'
+        self.ilkmethod=ilkmethod
+        self.ilkshells=None #shell basis for Ilk, loaded when needed
+        if ilkformat not in self.ilkformats:
+            print "***WARNING: unknown ilkformat '{0:s}', using 'npy'.".format(ilkformat)
+            ilkformat='npy'
+        self.ilkformat=ilkformat
+        if clformat not in self.clformats:
+            print "***WARNING: unknown clformat '{0:s}', using 'npy'.".format(clformat)
+            clformat='npy'
+        self.clformat=clformat
+        if clmethod not in self.clmethods:
+            print "***WARNING: unknown clmethod '{0:s}', using 'quad'.".format(clmethod)
+            clmethod='quad'
+        self.clmethod=clmethod
+        if limbermethod not in self.limbermethods:
+            print "***WARNING: unknown limbermethod '{0:s}', using 'quad'.".format(limbermethod)
+            limbermethod='quad'
+        self.limbermethod=limbermethod
+        self.clsparse=clsparse
+        self.limberauto=limberauto
+        self.executor=TaskExecutor(executormode)
+        self.ilkcachedir=ilkcachedir
+        if ilkcachedir and not os.path.isdir(ilkcachedir):
+            print "    creating dir",ilkcachedir
+            os.makedirs(ilkcachedir)
         self.epsilon=epsilon #used to set tolerance on integrals
         self.tag=tag
         if ilktag or noilktag: #mostly just used for testing
@@ -146,7 +269,11 @@ class ClRunData(RunData):
         self.besselxmincut=besselxmincut
         #print 'in ClRundata, zmax=',self.zmax
         #redo barebones cosm with one containing correct kdata, etc
-        self.cosm = Cosmology(self.cosmfile,cambdir=self.cambdir,kmin=self.kdata.kmin,kmax=self.kdata.kmax,epsilon=self.epsilon,bkgd_zrhgf_ext=cosm_zrhgf_bkgrd,pk_ext=pk_ext,nperz=nperz)
+        self.cosm = Cosmology(self.cosmfile,cambdir=self.cambdir,kmin=self.kdata.kmin,kmax=self.kdata.kmax,epsilon=self.epsilon,bkgd_zrhgf_ext=cosm_zrhgf_bkgrd,pk_ext=pk_ext,nperz=nperz,tabmethod=tabmethod,params=cosmparams,pkmethod=pkmethod)
+        if cosm_zrhgf_bkgrd.size: #external bkgd fns identified by their values
+            self.bkgdkey=hashlib.md5(np.ascontiguousarray(cosm_zrhgf_bkgrd,dtype=float).tostring()).hexdigest()
+        else:
+            self.bkgdkey='nperz={0!r}'.format(float(nperz))
 
         #infostr will hold run data to print in header of data files
         kinfo = self.kdata.infostr
@@ -163,13 +290,55 @@ class ClRunData(RunData):
             iswilkstr=' (iswilk:{0:s})'.format(self.iswilktag)
         else:
             iswilkstr=''
+        if self.ilkmethod!='quad':
+            methodstr=', ilkmethod={0:s}'.format(self.ilkmethod)
+        else:
+            methodstr=''
+        if self.clmethod!='quad':
+            methodstr+=', clmethod={0:s}'.format(self.clmethod)
+        if self.limbermethod!='quad':
+            methodstr+=', limbermethod={0:s}'.format(self.limbermethod)
+        if self.clsparse:
+            methodstr+=', clsparse tol={0:0.1e}'.format(self.clsparse_tol)
+        if self.limberauto:
+            methodstr+=', limberauto tol={0:0.1e}'.format(self.limberauto_tol)
                 
-        self.infostr='runtag {0:s}{1:s}{8:s}, {2:s}, eps={3:0.1e},besselmincut={4:b}, besselmaxcut={5:b}\n{6:s}\nk-data: {7:s}'.format(self.tag,ilkstr,ellstr,epsilon,besselxmincut,sharpkcut,cosminfo,kinfo,iswilkstr)
+        self.infostr='runtag {0:s}{1:s}{8:s}, {2:s}, eps={3:0.1e},besselmincut={4:b}, besselmaxcut={5:b}{9:s}\n{6:s}\nk-data: {7:s}'.format(self.tag,ilkstr,ellstr,epsilon,besselxmincut,sharpkcut,cosminfo,kinfo,iswilkstr,methodstr)
         
+    #returns hex string identifying Ilk for binmap with these settings;
+    # if no binmap is given, identifies the run settings alone.
+    # ell values and k range aren't included, since Ilk files can cover
+    # more than asked for; just the spacing and offset of the log k grid
+    def ilkhash(self,binmap=None):
+        kd=self.kdata
+        klattice=round(np.log10(kd.kmin)*kd.nperlogk,6)%1.
+        keystr='; '.join([self.cosm.paramkey(),'bkgd: '+self.bkgdkey,\
+            'kperlog={0:d}, klattice={1:0.6f}, krcut=({2!r},{3!r})'.format(kd.nperlogk,klattice,kd.krcutadd,kd.krcutmult),\
+            'eps={0!r}, sharpkcut={1:b}, besselxmincut={2:b}, ilkmethod={3:s}'.format(self.epsilon,self.sharpkcut,self.besselxmincut,self.ilkmethod)])
+        if binmap is not None:
+            keystr='; '.join([binmap.windowkey(),keystr])
+        return hashlib.md5(keystr).hexdigest()
+
     def equivRunData(self):
         #returns a MapRunData object with equivalent properties
         return RunData(self.tag,self.rundir,self.cosmfile,lvals=self.lvals)
     
+###########################################################################
+# ClRunData for each dict in cosmparamlist (see cosmparams), labeled by
+#  tags, with other ClRunData kwargs shared. Background fns for all of them
+#  come from one tabulate_bkgd_batch call up to zmax, which are handed to
+#  each one's Cosmology, so none of them integrates its own. They're the
+#  tables tabmethod='gauss' would give each
+def get_ClRunData_batch(cosmparamlist,tags,zmax=2.,nperz=200.,**kwargs):
+    rundatlist=[ClRunData(tag=tag,zmax=zmax,nperz=nperz,cosmparams=params,**kwargs) for tag,params in itertools.izip(tags,cosmparamlist)]
+    Om=np.array([rundat.cosm.Om for rundat in rundatlist])
+    w0=np.array([rundat.cosm.w0 for rundat in rundatlist])
+    zrhgf=tabulate_bkgd_batch(Om,w0,zmax,nperz,Cosmology.gauss_npts)
+    for n,rundat in enumerate(rundatlist):
+        rundat.cosm.tabulateZdep(zmax,nperz,zrhgf_ext=zrhgf[n])
+        rundat.cosm.nperz=nperz
+    return rundatlist
+
 ###########################################################################
 #MapRunData - bundleds together info used in generating maps from Cl
 ###########################################################################
@@ -184,6 +353,148 @@ class MapRunData(RunData):
     # to bundle info needed for maps but not Cl calculations.
 
 
+###########################################################################
+#TaskExecutor - pool of workers shared by all the stages of a run (Ilk,
+#        non-Limber C_l, Limber C_l). Big objects every task needs
+#        (cosmology, binmaps, P(k) interpolator) are registered as context
+#        with ref() under a name: they're sent to each worker once, when
+#        the pool starts, and tasks hold ContextRef placeholders for them,
+#        which run_taskbatch swaps back for the objects. Registering a name
+#        again replaces its entry; the pool only restarts when a name the
+#        workers don't have is registered, or an entry's state changes.
+#        Workers are started when first needed, and kept while inside a
+#        'with executor:' block (which can nest); they're closed when the
+#        outermost block exits.
+# mode: 'process' - multiprocessing Pool
+#       'thread' - thread pool; nothing is pickled, but only code that
+#                  releases the GIL (numpy, fft) runs concurrently
+#       'serial' - tasks run in this process, one at a time
+###########################################################################
+_worker_context={} #context objects available in this process, by key
+
+def _init_worker_context(context):
+    _worker_context.clear()
+    _worker_context.update(context)
+
+class ContextRef(object):
+    def __init__(self,key):
+        self.key=key
+
+# replace ContextRef placeholders in task args (incl. nested tuples)
+def resolve_context(args):
+    if isinstance(args,ContextRef):
+        return _worker_context[args.key]
+    if isinstance(args,tuple):
+        return tuple([resolve_context(a) for a in args])
+    return args
+
+class TaskExecutor(object):
+    modes=['process','thread','serial']
+    def __init__(self,mode='process',Nworkers=0):
+        if mode not in self.modes:
+            print "***WARNING: unknown executor mode '{0:s}', using 'process'.".format(mode)
+            mode='process'
+        self.mode=mode
+        if mode=='serial':
+            Nworkers=1
+        elif not Nworkers:
+            Nworkers=cpu_count()
+        self.Nworkers=Nworkers
+        self.pool=None
+        self.depth=0 #how many 'with' blocks are open
+        self.context={} #key:object
+        self.contextstate={} #key:state when registered
+        self.poolstate={} #key:state for the context the pool started with
+
+    #keys are unique to this executor, since thread and serial modes share
+    # one _worker_context with any other executors in the process
+    def _key(self,name):
+        return '{0:d}_{1:s}'.format(id(self),name)
+
+    #register obj as context under name, returns ContextRef for tasks to
+    # hold. state is anything that identifies obj's contents (eg whether
+    # tables have been filled in); workers get a new copy when it changes,
+    # while a new obj with the same name and state is taken to be the same
+    def ref(self,obj,name='',state=None):
+        key=self._key(name or type(obj).__name__)
+        self.context[key]=obj
+        self.contextstate[key]=state
+        return ContextRef(key)
+
+    #drop context registered under names, eg when a stage is done with it.
+    # running workers keep their copies, so it doesn't force a restart
+    def release(self,*names):
+        for name in names:
+            key=self._key(name)
+            self.context.pop(key,None)
+            self.contextstate.pop(key,None)
+            _worker_context.pop(key,None)
+
+    # make context available to tasks run in this process
+    def publish(self):
+        _worker_context.update(self.context)
+
+    def _checkpool(self):
+        if self.mode=='serial':
+            self.publish()
+            return
+        stale=[k for k in self.contextstate if k not in self.poolstate or self.poolstate[k]!=self.contextstate[k]]
+        if self.pool is None or stale:
+            if self.pool is not None:
+                print "  Restarting workers with updated context."
+            self.terminate()
+            if self.mode=='process':
+                self.pool=Pool(self.Nworkers,initializer=_init_worker_context,initargs=(self.context,))
+            else:
+                self.pool=ThreadPool(self.Nworkers)
+            self.poolstate=dict(self.contextstate)
+        if self.mode=='thread': #threads see this process's context
+            self.publish()
+
+    def imap_unordered(self,fn,iterable):
+        self._checkpool()
+        if self.mode=='serial':
+            return itertools.imap(fn,iterable)
+        return self.pool.imap_unordered(fn,iterable)
+
+    def map(self,fn,iterable):
+        self._checkpool()
+        if self.mode=='serial':
+            return map(fn,iterable)
+        return self.pool.map(fn,iterable)
+
+    #stop workers right away, eg after a task fails; restarted when needed
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool=None
+        self.poolstate={}
+
+    #let workers finish and exit
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool=None
+        self.poolstate={}
+
+    #workers started inside a with block are kept until the outermost exits
+    def __enter__(self):
+        self.depth+=1
+        return self
+    def __exit__(self,exctype,excval,tb):
+        self.depth-=1
+        if not self.depth:
+            self.close()
+        return False
+
+    #pools can't be pickled or copied; copies start with no workers
+    def __getstate__(self):
+        return {'mode':self.mode,'Nworkers':self.Nworkers}
+    def __setstate__(self,state):
+        self.__init__(state['mode'],state['Nworkers'])
+
 ###########################################################################
 #helper functions for multiprocessing with class methods
 ###########################################################################
@@ -1,8 +1,8 @@
 import numpy as np
-import os,subprocess
+import os,subprocess,hashlib
 import copy_reg, types
 from scipy.integrate import quad
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, CubicSpline
 ###########################################################################
 #helper functions for multiprocessing; allows you to call instance methods
 ###########################################################################
@@ -24,16 +24,139 @@ from scipy.interpolate import interp1d
 # ###########################################################################
 # copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
+###########################################################################
+# integrals of fn over each interval [x[i],x[i+1]] of ascending array x,
+#  with an npts Gauss-Legendre rule on each; fn must take arrays.
+#  a running sum of these gives the integral from x[0] at every node
+def gauss_intervals(fn,x,npts=8):
+    t,w=np.polynomial.legendre.leggauss(npts)
+    mid=.5*(x[1:]+x[:-1])
+    half=.5*(x[1:]-x[:-1])
+    return half*np.dot(fn(mid[:,np.newaxis]+half[:,np.newaxis]*t),w)
+
+###########################################################################
+# background fns for many cosmologies at once: Om, w0 are arrays [Ncosm]
+#  (or scalars, broadcast), OL=1-Om as in Cosmology. returns r, H, D
+#  (normalized to 1 today), f at ascending z, each [Ncosm,Nz], in the same
+#  h units as Cosmology, so h0 doesn't enter. Integrals are running sums of
+#  gauss_intervals; r is integrated from zprev, where it's rprev ([Ncosm]
+#  or scalar). The D1 integral is done in u=sqrt(a), where its integrand
+#  is smooth down to a=0; u outside the grid, down to 0 and up to today's
+#  1, is split into intervals of <=.05
+def bkgd_gauss_batch(Om,w0,z,zprev=0.,rprev=0.,npts=8):
+    H0=100.
+    c=Cosmology.c
+    Om,w0=np.broadcast_arrays(np.atleast_1d(Om).astype(float),np.atleast_1d(w0).astype(float))
+    Om=Om[:,np.newaxis,np.newaxis] #broadcast against [interval,pt] arrays
+    OL=1.-Om
+    w0=w0[:,np.newaxis,np.newaxis]
+    def E(zz): #H/H0
+        return np.sqrt(Om*(1.+zz)**3.+OL*(1.+zz)**(3.*(1.+w0)))
+    H=H0*E(z[np.newaxis,:])[:,0,:]
+    zr=np.concatenate(([zprev],z)) if z[0]>zprev else z
+    dr=gauss_intervals(lambda x: c/(H0*E(x)),zr,npts)
+    r=np.atleast_1d(rprev)[:,np.newaxis]+np.cumsum(np.concatenate((np.zeros((dr.shape[0],1)),dr),axis=1),axis=1)[:,-z.size:]
+    u=np.sqrt(1./(1.+z[::-1])) #ascending
+    ulow=np.linspace(0.,u[0],int(np.ceil(u[0]/.05))+1)[:-1]
+    uhigh=np.linspace(u[-1],1.,int(np.ceil((1.-u[-1])/.05))+1)[1:]
+    u=np.concatenate((ulow,u,uhigh))
+    Du=np.cumsum(gauss_intervals(lambda x: 2.*x*(1./(x*x*E(-1.+1./(x*x))))**3,u,npts),axis=1)
+    I=Du[:,ulow.size-1:ulow.size-1+z.size][:,::-1] #int_0^a (H0/(xH))^3 dx at each z
+    Om=Om[:,:,0]
+    OL=OL[:,:,0]
+    w0=w0[:,:,0]
+    D=5.*Om/2.*I*H/H0
+    #f=dlnD/dlnA, as in Cosmology.fgrowth
+    ainv=1.+z
+    ev2=(H/H0)**2
+    f=-1.5-1.5*w0*OL*ainv**(3.*(1.+w0))/ev2+2.5*Om*(ainv**2)/(D*ev2)
+    return r,H,D/(5.*Om/2.*Du[:,-1:]),f
+
+# background tables for many cosmologies, as an array [Ncosm,5,Nz] of
+#  z, r, H, D, f rows, on the same z grid Cosmology.tabulateZdep uses.
+#  each [5,Nz] slice can be passed to Cosmology or ClRunData as
+#  bkgd_zrhgf_ext/cosm_zrhgf_bkgrd
+def tabulate_bkgd_batch(Om,w0=-1.,zmax=10.,nperz=200.,npts=8):
+    Nz=int(np.ceil(zmax*nperz-1.e-6))+1
+    z=(1./nperz)*np.arange(Nz)
+    r,H,g,f=bkgd_gauss_batch(Om,w0,z,npts=npts)
+    zrhgf=np.array([np.tile(z,(r.shape[0],1)),r,H,g,f])
+    return zrhgf.transpose(1,0,2)
+
+###########################################################################
+# cubic spline through y at the evenly spaced x, for evaluating many times
+#  inside integrands: coefficients are precomputed, and a point's interval
+#  is found by one division instead of a search. It's the same not-a-knot
+#  spline as interp1d(kind='cubic'), and gives fill outside [x[0],x[-1]].
+#  Ascending x that aren't evenly spaced (e.g. r(z) tabulated on a z grid)
+#  are first resampled onto as many evenly spaced pts by a spline.
+#  Scalars in give floats out, with no array overhead; arrays give arrays
+class UniformSpline(object):
+    def __init__(self,x,y,fill=0.):
+        x=np.asarray(x,dtype=float)
+        self.x0=float(x[0])
+        self.x1=float(x[-1])
+        self.dx=(self.x1-self.x0)/(x.size-1)
+        self.Nint=x.size-1
+        self.fill=fill
+        spline=CubicSpline(x,y)
+        xeven=self.x0+self.dx*np.arange(x.size)
+        if not np.allclose(x,xeven,rtol=0.,atol=1.e-8*self.dx):
+            spline=CubicSpline(xeven,spline(xeven))
+        self.coef=spline.c #[power 3..0, interval]
+        self.coeflists=self.coef.tolist() #python floats, for scalar lookups
+    def __call__(self,x):
+        if np.ndim(x)==0:
+            x=float(x)
+            if not self.x0<=x<=self.x1:
+                return self.fill
+            i=min(int((x-self.x0)/self.dx),self.Nint-1)
+            t=x-self.x0-i*self.dx
+            c3,c2,c1,c0=self.coeflists
+            return ((c3[i]*t+c2[i])*t+c1[i])*t+c0[i]
+        x=np.asarray(x,dtype=float)
+        i=np.clip(((x-self.x0)/self.dx).astype(int),0,self.Nint-1)
+        t=x-self.x0-i*self.dx
+        c=self.coef
+        result=((c[0,i]*t+c[1,i])*t+c[2,i])*t+c[3,i]
+        result[(x<self.x0)|(x>self.x1)]=self.fill
+        return result
+
+###########################################################################
+# tabmethod: how tabulateZdep gets r(z), D(z), and f(z). options are
+#       'gauss' - one cumulative pass over the whole z grid, summing
+#                Gauss-Legendre rules (gauss_npts pts) between grid pts
+#       'quad' - separate adaptive quad integrals at each z; the reference
+# pkmethod: where getPk gets the z=0 matter power spectrum. options are
+#       'camb' - runs the camb executable (if its output isn't there yet)
+#                and reads in its matterpower file
+#       'eh' - linear P(k) computed in-process from the Eisenstein & Hu
+#                (1998) transfer fn with baryons, with ns and As from the
+#                .cosm file, or normalized to its sigma8 if that's given
 class Cosmology(object):
     """Class containing cosmological params and functions"""
     c =  299792. #speed of light in km/s. units chosen so c/H is in Mpc
+    tabmethods=['gauss','quad']
+    gauss_npts=8 #Gauss-Legendre pts per z grid interval, for tabmethod='gauss'
+    pkmethods=['camb','eh']
+    eh_nperlogk=300 #k pts per decade of P(k) for pkmethod='eh'
+    Tcmb=2.7255 #CMB temperature in K, as given to CAMB
     #-----------------------------------
-    def __init__(self,paramfile,tabulateZ=False,needPk=False,zmax=1.,nperz=200.,cambdir='output/camb_output/',kmin=-1.,kmax=-1.,rerunCAMB=False,CAMBkmax=-1.,epsilon=1.e-10,bkgd_zrhgf_ext=np.array([]),pk_ext=np.array([])):
+    def __init__(self,paramfile,tabulateZ=False,needPk=False,zmax=1.,nperz=200.,cambdir='output/camb_output/',kmin=-1.,kmax=-1.,rerunCAMB=False,CAMBkmax=-1.,epsilon=1.e-10,bkgd_zrhgf_ext=np.array([]),pk_ext=np.array([]),tabmethod='gauss',params={},pkmethod='camb'):
         print " Initializing instance of Cosmology"
         
         self.paramfile = paramfile
-        self.importCosmParams(paramfile)
+        self.importCosmParams(paramfile,params)
+        self.cambdir = cambdir #default if no Pk needed
         self.epsilon=epsilon #used for integral tolerance
+        if tabmethod not in self.tabmethods:
+            print "***WARNING: unknown tabmethod '{0:s}', using 'gauss'.".format(tabmethod)
+            tabmethod='gauss'
+        self.tabmethod=tabmethod
+        if pkmethod not in self.pkmethods:
+            print "***WARNING: unknown pkmethod '{0:s}', using 'camb'.".format(pkmethod)
+            pkmethod='camb'
+        self.pkmethod=pkmethod
         self.zmax=0
         #if tabulated cosmology background functions have been passed, supercede zmax, nperz, tabulateZ
         if bkgd_zrhgf_ext.size:
@@ -45,30 +168,50 @@ class Cosmology(object):
             self.tabZ = 0
         self.nperz = nperz
 
-        self.cambdir = cambdir #default if no Pk needed
         if pk_ext.size:
             needPk=True
             print "  ...Using external power spectrum!"
         if needPk: #set everything up
-            self.getPk(kmin,kmax,cambdir,rerunCAMB,CAMBkmax,pk_ext) 
+            self.getPk(kmin,kmax,cambdir,rerunCAMB,CAMBkmax,pk_ext=pk_ext)
         else: self.havePk =0
     
         #infostr contains info for data file headers
         self.infostr="CAMBtag '{0:s}': Oc={1:0.3g}, Ob={2:0.3g}, h0={3:0.3g}, w0={4:0.3g}, ns={5:0.3g}, On={6:0.3g} [OL=1-Om, Oc=Om-Ob-On. epsilon={7:0.3g}]".format(self.CAMBtag,self.Oc,self.Ob,self.h0,self.w0,self.ns,self.On,self.epsilon)
+        if self.pkmethod=='eh':
+            if self.sigma8>0:
+                self.infostr+=', P(k): eh, sigma8={0:0.3g}'.format(self.sigma8)
+            else:
+                self.infostr+=', P(k): eh, As={0:0.3g}'.format(self.As)
+
+    #-----------------------------------
+    # string w full precision params setting background and growth fns
+    def paramkey(self):
+        return 'Oc={0!r}, Ob={1!r}, On={2!r}, h0={3!r}, w0={4!r}, ns={5!r}'.format(self.Oc,self.Ob,self.On,self.h0,self.w0,self.ns)
 
     #-----------------------------------
     # read in cosmological paramter files, set up instance params
-    def importCosmParams(self,paramfile):
+    # params: dict of labels as in the file (e.g. 'Och2','h0') and values
+    #  that replace the file's
+    def importCosmParams(self,paramfile,params={}):
         print "  Importing cosm params from:",paramfile
         f = open(paramfile,'r')
         lines= f.read().split('\n')
         f.close()
+        Nfile=len(lines)
+        #overrides come after the file's lines, and whichever of Ox or Oxh2
+        # they give sets the other, whatever form the file used
+        for label in params:
+            val=params[label]
+            lines.append('{0:s}={1:s} #'.format(label,val if isinstance(val,str) else repr(float(val))))
         haveOc=0
         haveOb=0
         haveOn=0
-        for l in lines:
+        self.As=2.1e-9 #primordial amplitude at k=.05/Mpc, if not in file
+        self.sigma8=-1. #if >0, P(k) from pkmethod='eh' is normalized to it
+        for n,l in enumerate(lines):
             label = l[:l.find('=')].strip()
             data = l[l.find('=')+1:l.find('#')].strip()
+            override= n>=Nfile
             if label=='CAMBtag':
                 self.CAMBtag = data
             elif label=='w0':
@@ -85,14 +228,21 @@ class Cosmology(object):
                 haveOn=1
             elif label =='Och2':
                 self.Och2 = float(data)
+                if override: haveOc=0
             elif label =='Obh2':
                 self.Obh2 = float(data)
+                if override: haveOb=0
             elif label =='Onh2':
                 self.Onh2 = float(data)
+                if override: haveOn=0
             elif label =='h0':
                 self.h0 = float(data)
             elif label =='ns':
                 self.ns = float(data)
+            elif label =='As':
+                self.As = float(data)
+            elif label =='sigma8':
+                self.sigma8 = float(data)
         if haveOc:
             self.Och2=self.Oc*self.h0*self.h0
         else:
@@ -112,14 +262,10 @@ class Cosmology(object):
         #make z array, tabulate z-dependent quantities, save as member arrays
         # can pass optional array zrhgf [first index specifies z,r,H,g, or f][z index]
         # -if this is non empty, supercedes other argumetns
+        # tables are stored in cambdir under a hash of everything that sets
+        #  them (see bkgd_filename); a stored table serves any zmax it
+        #  reaches, and is extended past its end when a higher zmax is asked
         self.tabZ=1 #used to see if this fn has been called
-        pf = self.paramfile
-        cosmtag=pf[pf.rfind('/')+1:pf.rfind('.cosm')]
-        if outtag:
-            addtotag='_'+outtag
-        else:
-            addtotag=''
-        tabzfile=self.cambdir+'{0:s}_tabz_zmax{1:f}_nperz{2:f}.dat'.format(cosmtag+addtotag,zmax,nperz)
 
         print "  Tabulating background cosmology fns. zmax={0:g}, nperz={1:g}".format(zmax,nperz)
         if zrhgf_ext.size:
@@ -130,60 +276,38 @@ class Cosmology(object):
             self.g_array=zrhgf_ext[3,:]
             self.f_array=zrhgf_ext[4,:]
             self.zmax=self.z_array[-1]
-            self.nperz=self.z_array.size/self.zmax
+            self.nperz=(self.z_array.size-1)/self.zmax
         else:
-
+            tabzfile=self.bkgd_filename(nperz,outtag)
+            dz = 1./nperz
+            Nz = int(np.ceil(zmax*nperz-1.e-6))+1
+            zrhgf=np.zeros((5,0))
             if not overwritefile and os.path.isfile(tabzfile):
-                #check for existing file
                 print '    using z data from',tabzfile
-                #if it exists, read it in
-                inzrhgf=np.loadtxt(tabzfile,skiprows=0)#1)#set to 1 if header included
-                #for now, assumes that this is the array we want
-                
-                self.z_array=inzrhgf[:,0]
-                self.r_array=inzrhgf[:,1]
-                self.H_array=inzrhgf[:,2]
-                self.g_array=inzrhgf[:,3]
-                self.f_array=inzrhgf[:,4]
-                self.zmax=self.z_array[-1]
-                self.nperz=self.z_array.size/self.zmax
-            else:
-                self.zmax=zmax
-                self.nperz=nperz
-                dz = 1./nperz
-                Nz = zmax*nperz+1
-                self.z_array = dz*np.arange(Nz)
-                self.r_array = np.zeros_like(self.z_array) #Mpc/h units
-                self.H_array = np.zeros_like(self.z_array) #h km/s/Mpc
-                self.g_array = np.zeros_like(self.z_array)
-                self.f_array = np.zeros_like(self.z_array)
-                for i in xrange(self.z_array.size):
-                    self.r_array[i]=self.comov_r_z(self.z_array[i])
-                    self.H_array[i]=self.Hubble(self.z_array[i])
-                    self.g_array[i]=self.D1(self.z_array[i])
-                    self.f_array[i]=self.fgrowth(self.z_array[i])
-                
-                self.g_array = self.g_array/self.D1(0) #normalize to 1 today
-
-                #write arrays to file
-                zrhgf_grid=np.zeros((self.z_array.size,5))
-                zrhgf_grid[:,0]=self.z_array
-                zrhgf_grid[:,1]=self.r_array
-                zrhgf_grid[:,2]=self.H_array
-                zrhgf_grid[:,3]=self.g_array
-                zrhgf_grid[:,4]=self.f_array
-                #numpy version on flux can't handle header arg, take it out
-                #header='columns: z r h g f; cosm file {0:s}; zmax {1:f}; nperz {2:f}'.format(cosmtag,zmax,nperz)
+                zrhgf=np.load(tabzfile)
+            Nold=zrhgf.shape[1]
+            if Nold<Nz: #compute only the z past the stored table
+                znew=dz*np.arange(Nold,Nz)
+                if Nold:
+                    print '    extending stored table from zmax={0:g}'.format(zrhgf[0,-1])
+                if self.tabmethod=='gauss':
+                    r,H,g,f=self.bkgd_gauss(znew,*zrhgf[:2,-1]) if Nold else self.bkgd_gauss(znew)
+                else:
+                    r,H,g,f=self.bkgd_quad(znew)
+                zrhgf=np.concatenate((zrhgf,np.array([znew,r,H,g,f])),axis=1)
                 print '    Saving z tab data to ',tabzfile
-                np.savetxt(tabzfile,zrhgf_grid)#,header=header)#header removed for flux's numpy version
+                np.save(tabzfile,zrhgf)
+            self.z_array,self.r_array,self.H_array,self.g_array,self.f_array=zrhgf[:,:Nz]
+            self.zmax=self.z_array[-1]
+            self.nperz=nperz
                 
         #set up interpolating functions
         print '     Setting up interpolating functions.'
-        self.co_r = interp1d(self.z_array,self.r_array,kind='cubic',bounds_error=False,fill_value=0.)
-        self.z_from_cor= interp1d(self.r_array,self.z_array,kind='cubic',bounds_error=False,fill_value=0.)
+        self.co_r = UniformSpline(self.z_array,self.r_array)
+        self.z_from_cor= UniformSpline(self.r_array,self.z_array)
         self.hub =self.Hubble#interp1d(self.z_array,self.H_array,kind='cubic') #analytic!
-        self.growth =interp1d(self.z_array,self.g_array,kind='cubic',bounds_error=False,fill_value=0.)
-        self.growthrate = interp1d(self.z_array,self.f_array,kind='cubic',bounds_error=False,fill_value=0.)
+        self.growth =UniformSpline(self.z_array,self.g_array)
+        self.growthrate = UniformSpline(self.z_array,self.f_array)
         print '     Tabulation done.'
            
     #==================================================
@@ -195,12 +319,15 @@ class Cosmology(object):
         #if external [k,P] array passed, this overrides everything else
     def getPk(self,kmin=-1.,kmax=-1.,cambdir='',rerunCAMB=False,CAMBkmax=-1.,kperln=0,pk_ext=np.array([])):
         print "  In getPk"
-        if not pk_ext.size:
+        infile=''
+        if not pk_ext.size and self.pkmethod=='eh':
+            print "  ...computing Eisenstein-Hu P(k)"
+            pk_ext=self.EHPk_array(kmin,kmax)
+        elif not pk_ext.size:
             print "  ...cambdir=",cambdir,"rerunCAMB=",rerunCAMB
             print "  ...kmin=",kmin,"kmax=",kmax,"CAMBkmax=",CAMBkmax
             if CAMBkmax<0:
                 CAMBkmax=kmax
-            self.havePk = 1 #use to check whether this has been run
             if cambdir: #if something given here, make it the instance's cambdir
                 self.cambdir=cambdir
             infile = ''.join([self.cambdir,self.CAMBtag,'_matterpower.dat'])
@@ -215,6 +342,7 @@ class Cosmology(object):
             print "  ...using extenral P(k) array."    
         #now there will be a CAMB-produced matter power spec file, read it:
         self.importP(infile,kmin,kmax,pk_ext) # in Mpc/h units
+        self.havePk = 1
         
     #-----------------------------------
     #once getPk has been run, use this as interpolating function
@@ -223,6 +351,84 @@ class Cosmology(object):
     #def P(self,k):
     #    return np.interp(k,self.k_forPower,self.P_forPower)
 
+    #-----------------------------------
+    # Eisenstein & Hu (1998) transfer fn with baryons, for k in h/Mpc.
+    #  neutrinos are counted with cdm
+    def EH_transfer(self,k):
+        h = self.h0
+        kMpc = k*h #1/Mpc
+        om = self.Om*h*h
+        ob = self.Ob*h*h
+        fb = self.Ob/self.Om
+        fc = 1.-fb
+        theta = self.Tcmb/2.7
+        zeq = 2.50e4*om/theta**4
+        keq = 7.46e-2*om/theta**2
+        b1 = 0.313*om**-0.419*(1.+0.607*om**0.674)
+        b2 = 0.238*om**0.223
+        zd = 1291.*om**0.251/(1.+0.659*om**0.828)*(1.+b1*ob**b2)
+        Req = 31.5*ob/theta**4*(1000./zeq)
+        Rd = 31.5*ob/theta**4*(1000./zd)
+        s = 2./(3.*keq)*np.sqrt(6./Req)*np.log((np.sqrt(1.+Rd)+np.sqrt(Rd+Req))/(1.+np.sqrt(Req)))
+        ksilk = 1.6*ob**0.52*om**0.73*(1.+(10.4*om)**-0.95)
+        q = kMpc/(13.41*keq)
+        a1 = (46.9*om)**0.670*(1.+(32.1*om)**-0.532)
+        a2 = (12.0*om)**0.424*(1.+(45.0*om)**-0.582)
+        alphac = a1**-fb*a2**(-fb**3)
+        bc1 = 0.944/(1.+(458.*om)**-0.708)
+        bc2 = (0.395*om)**-0.0266
+        betac = 1./(1.+bc1*(fc**bc2-1.))
+        def T0(alpha,beta):
+            L = np.log(np.e+1.8*beta*q)
+            C = 14.2/alpha+386./(1.+69.9*q**1.08)
+            return L/(L+C*q*q)
+        ks = kMpc*s
+        f = 1./(1.+(ks/5.4)**4)
+        Tc = f*T0(1.,betac)+(1.-f)*T0(alphac,betac)
+        y = (1.+zeq)/(1.+zd)
+        G = y*(-6.*np.sqrt(1.+y)+(2.+3.*y)*np.log((np.sqrt(1.+y)+1.)/(np.sqrt(1.+y)-1.)))
+        alphab = 2.07*keq*s*(1.+Rd)**-0.75*G
+        betanode = 8.41*om**0.435
+        stilde = s/(1.+(betanode/ks)**3)**(1./3.)
+        betab = 0.5+fb+(3.-2.*fb)*np.sqrt((17.2*om)**2+1.)
+        Tb = (T0(1.,1.)/(1.+(ks/5.2)**2)+alphab/(1.+(betab/ks)**3)*np.exp(-(kMpc/ksilk)**1.4))*np.sinc(kMpc*stilde/np.pi)
+        return fb*Tb+fc*Tc
+
+    #-----------------------------------
+    # linear z=0 P(k) [(Mpc/h)^3] at k [h/Mpc] from EH_transfer:
+    #  Delta^2(k)=(4/25) As (k/kpivot)^(ns-1) (ck/H0)^4 T^2 (D1(0)/Om)^2,
+    #  D1 normalized to a in matter domination. if sigma8>0, rescaled to it
+    def EHPk(self,k):
+        kpivot = 0.05/self.h0 #h/Mpc
+        ckH0 = self.c*k/100.
+        Delta2 = 4./25.*self.As*(k/kpivot)**(self.ns-1.)*ckH0**4*self.EH_transfer(k)**2*(self.D1(0)/self.Om)**2
+        P = 2.*np.pi**2*Delta2/k**3
+        if self.sigma8>0:
+            P *= (self.sigma8/self.sigmaR(8.))**2
+        return P
+
+    # rms linear density in top hats of radius R [Mpc/h], from EHPk
+    #  without any sigma8 rescaling
+    def sigmaR(self,R):
+        lnk = np.linspace(np.log(1.e-5),np.log(1.e3),4001)
+        k = np.exp(lnk)
+        sigma8 = self.sigma8
+        self.sigma8 = -1.
+        P = self.EHPk(k)
+        self.sigma8 = sigma8
+        x = k*R
+        W = 3.*(np.sin(x)-x*np.cos(x))/x**3
+        return np.sqrt(np.trapz(k**3*P*W**2/(2.*np.pi**2),lnk))
+
+    # [k,P] array from EHPk, eh_nperlogk pts per decade from kmin to kmax
+    #  (defaults as for CAMB: 1.e-4 and 100 h/Mpc)
+    def EHPk_array(self,kmin=-1.,kmax=-1.):
+        if kmin<=0: kmin=1.e-4
+        if kmax<=0: kmax=100.
+        Nk = int(np.ceil(np.log10(kmax/kmin)*self.eh_nperlogk))+1
+        k = np.logspace(np.log10(kmin),np.log10(kmax),Nk)
+        return np.array([k,self.EHPk(k)]).T
+
     #==================================================
     #Functions computed from cosm. params
     def comov_r_z(self,z):
@@ -251,15 +457,50 @@ class Cosmology(object):
         D1*=I
         return D1
     #-----------------------------------
-    def fgrowth(self,z): #dlnD/dlnA
+    def fgrowth(self,z,D=None): #dlnD/dlnA; D1(z) is computed if not given
         ainv = 1.+z
         ev2 = self.Om*ainv**3.+self.OL*ainv**(3.*(1.+self.w0))#(H/H0)^2
-        D = self.D1(z)
+        if D is None:
+            D = self.D1(z)
         A = -1.5
         B = -1.5*self.w0*self.OL*ainv**(3.*(1.+self.w0))/ev2
         C = 2.5*self.Om*(ainv**2)/(D*ev2)
         return A+B+C
     #-----------------------------------
+    # file background tables are stored in, named by a hash of the params,
+    #  z spacing, and tabmethod (and integral tolerance for 'quad')
+    def bkgd_filename(self,nperz,outtag=''):
+        keystr='; '.join([self.paramkey(),'nperz={0!r}'.format(float(nperz)),'tabmethod='+self.tabmethod])
+        if self.tabmethod=='quad':
+            keystr+='; eps={0!r}'.format(self.epsilon)
+        if outtag:
+            outtag+='_'
+        return ''.join([self.cambdir,'bkgd_',outtag,hashlib.md5(keystr).hexdigest(),'.npy'])
+
+    #-----------------------------------
+    # r, H, D (normalized to 1 today), f at each z of ascending array z
+    #  with separate quad integrals at each z
+    def bkgd_quad(self,z):
+        r = np.zeros_like(z) #Mpc/h units
+        H = np.zeros_like(z) #h km/s/Mpc
+        g = np.zeros_like(z)
+        f = np.zeros_like(z)
+        for i in xrange(z.size):
+            r[i]=self.comov_r_z(z[i])
+            H[i]=self.Hubble(z[i])
+            g[i]=self.D1(z[i])
+            f[i]=self.fgrowth(z[i])
+        return r,H,g/self.D1(0),f #normalize to 1 today
+
+    #-----------------------------------
+    # r, H, D (normalized to 1 today), f at each z of ascending array z,
+    #  see bkgd_gauss_batch. r is integrated from zprev, where it's rprev;
+    #  zprev<z[0] is the end of an existing table, or 0 for a new one
+    def bkgd_gauss(self,z,zprev=0.,rprev=0.):
+        r,H,g,f = bkgd_gauss_batch(self.Om,self.w0,z,zprev,rprev,self.gauss_npts)
+        return r[0],H[0],g[0],f[0]
+
+    #-----------------------------------
     # reads in P(k) from an external file, adds power laws on high and lowk ends
     #  if necessary. if external array passed, use that instead
     def importP(self,infile='',kmin=-1.,kmax=-1.,pk_ext=np.array([])):
@@ -349,7 +590,7 @@ class Cosmology(object):
         #Initial power spectrum, amplitude, spectral index and running
         f.write(''.join(["initial_power_num = 1\n","pivot_scalar = 0.05 \n",\
                              "pivot_tensor = 0.05 \n",\
-                             "scalar_amp(1) = 2.1e-9\n",\
+                             "scalar_amp(1) = ",str(cosm.As),"\n",\
                              "scalar_spectral_index(1)  = ",str(cosm.ns),"\n",\
                              "scalar_nrun(1) = 0\n","scalar_nrunrun(1)  = 0\n",\
                              "tensor_spectral_index(1)  = 0\n",\
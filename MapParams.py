@@ -205,6 +205,11 @@ class BinMap(MapWrapper):
             result =result/self.binint
         return result
 
+    def windowkey(self):
+        #string w all params that set the window fn (not tag or noise);
+        # used to identify Ilk data for identical windows
+        return 'BinMap z=[{0!r},{1!r},{2!r},{3!r}], sharp={4!r}, isISW={5:b}, isGal={6:b}'.format(self.zmin,self.zminnom,self.zmaxnom,self.zmax,self.sharpness,self.isISW,self.isGal)
+
 
 ###########################################################################
 # SurveyBinMap - inherits from binmap, survey specific initialization
@@ -251,6 +256,9 @@ class SurveyBinMap(BinMap):
     def window(self,z):
         #bin n's window function is normalized F*dndz times bias
         return self.dndzfull(z)*self.bias(z,*self.biasargs)
+
+    def windowkey(self):
+        return 'SurveyBinMap z=[{0!r},{1!r},{2!r},{3!r}], sharp={4!r}, sigz0={5!r}, dndz={6:s}{7!r}, bias={8:s}{9!r}, fracbadz={10!r}, badz=[{11!r},{12!r}]'.format(self.zmin,self.zminnom,self.zmaxnom,self.zmax,self.sharpness,self.sigz0,self.dndz.__name__,list(self.dndzargs),self.bias.__name__,list(self.biasargs),self.fracbadz,self.badzminz,self.badzmaxz)
         
     def sigz(self,z): #assuming some form of z dependence...
         return self.sigz0*(1.+z)
@@ -1,10 +1,11 @@
 import numpy as np
 from scipy.integrate import quad
-from scipy.special import jv
+from scipy.special import jv, spherical_jn, loggamma
 from scipy.optimize import brentq
-from scipy.interpolate import interp1d
-import os, subprocess,copy,copy_reg,types
-from multiprocessing import Pool, Manager
+from scipy.interpolate import interp1d, CubicSpline
+from scipy.fftpack import next_fast_len
+import os, subprocess,copy,copy_reg,types,json,shutil,time
+from multiprocessing import Pool, Manager, cpu_count
 import itertools
 import matplotlib.pyplot as plt
 
@@ -21,10 +22,8 @@ from ClRunUtils import *
 #          plus indices relevant for 
 ###########################################################################
 class ClData(object):
-    def __init__(self,rundata,bintags,dopairs=[],clgrid=np.array([]),addauto=True,docrossind=[],nbarlist=[]):
-        if rundata.tag: runtag = '_'+rundata.tag
-        else: runtag=''
-        self.clfile= ''.join([rundata.cldir,'Cl',runtag,'.dat'])
+    def __init__(self,rundata,bintags,dopairs=[],clgrid=np.array([]),addauto=True,docrossind=[],nbarlist=[],domask=None):
+        self.clfile= cl_filename(rundata)
         self.rundat = rundata #Clrundata instance
         self.bintaglist=bintags #tag, given mapind
         self.Nmap=len(bintags)
@@ -34,13 +33,13 @@ class ClData(object):
         self.crosspairs=crosspairs #[crossind,mapinds] (NCross x2)
         self.crossinds=crossinds #[mapind,mapind] (Nmap x Nmap)
 
-        if len(docrossind): #if list of cross pair indices given, use those
+        #domask[crossind] is True for pairs which have C_l computed
+        if domask is not None: #if mask given, use that
+            self.domask=np.array(domask,dtype=bool)
+        elif len(docrossind): #if list of cross pair indices given, use those
             self.docross = docrossind
-            self.pairs=get_pairs_fromcrossind(self.bintaglist,docrossind,self.crosspairs,self.crossinds)
         else: #otherwise uses pairs. if both empty, just does auto correlations
-            self.pairs=consolidate_dotags(dopairs,bintags)
-            docross=get_docross_ind(self.tagdict,self.pairs,self.crossinds,addauto=addauto)
-            self.docross=docross #crossinds which have C_l computed
+            self.domask=get_domask(self.tagdict,dopairs,self.crossinds,addauto=addauto)
 
         self.Nell=rundata.lvals.size
         self.cl=clgrid #[crossind, ell]
@@ -55,21 +54,32 @@ class ClData(object):
         
         #keep noise contrib to C_l in separate array
         self.noisecl = np.zeros((self.Ncross,self.Nell))
-        for i in xrange(self.Nmap):
-            if self.nbar[i]!=-1: #assumes -1 for no noise or isw
-                diagind=self.crossinds[i,i]
-                self.noisecl[diagind,:]=1/self.nbar[i]
-                self.noisecl[diagind,0]=0
-
+        hasnoise=self.nbar!=-1 #assumes -1 for no noise or isw
+        diaginds=self.crossinds[hasnoise,hasnoise]
+        self.noisecl[diaginds,:]=1./self.nbar[hasnoise,np.newaxis]
+        self.noisecl[diaginds,0]=0
+
+    #list of crossinds which have C_l computed
+    @property
+    def docross(self):
+        return [int(n) for n in np.where(self.domask)[0]]
+    @docross.setter
+    def docross(self,docrossind):
+        self.domask=np.zeros(self.Ncross,dtype=bool)
+        self.domask[np.asarray(docrossind,dtype=int)]=True
+
+    #[(tag1,tag2),...] for computed pairs, grouped by map type where possible
+    @property
+    def pairs(self):
+        return consolidate_domask(self.domask,self.bintaglist)
 
     def hasClvals(self):
         return bool(self.cl.size)
 
     def clcomputed_forpair(self,tag1,tag2):
         mapind1=self.tagdict[tag1]
-        mapind2=self.tagdict[tag1]
-        xind=self.crossinds[mapind1,mapind2]
-        return xind in self.docross
+        mapind2=self.tagdict[tag2]
+        return self.domask[self.crossinds[mapind1,mapind2]]
 
     #pass string, for all binmaps with that string in their tag, change nbar
     def changenbar(self,mapstr,newnbar):
@@ -83,44 +93,60 @@ class ClData(object):
                 else:
                     self.noisecl[diagind,:]=1./newnbar
 
+    #new ClData for maps with indices mapinds, in that order; can be used
+    # to take a subset of maps and/or reorder them
+    def get_submaps(self,mapinds):
+        mapinds=np.asarray(mapinds,dtype=int)
+        newpairs,newxinds=get_index_pairs(mapinds.size)
+        rows=self.crossinds[mapinds[newpairs[:,0]],mapinds[newpairs[:,1]]]
+        if self.hasClvals():
+            newcl=self.cl[rows]
+        else:
+            newcl=np.array([])
+        outcldat=ClData(self.rundat,[self.bintaglist[m] for m in mapinds],clgrid=newcl,nbarlist=self.nbar[mapinds],domask=self.domask[rows])
+        outcldat.noisecl=self.noisecl[rows]
+        return outcldat
+
     #given binmap tag, remove that map
     def deletemap(self,tag):
         if tag not in self.bintaglist:
             return False
-        newNmap=self.Nmap-1
-        newNcross=newNmap*(newNmap+1)/2
-        oldmapind=self.tagdict[tag]
-        newcl=np.zeros((newNcross,self.Nell))
-        delxinds=self.crossinds[oldmapind,:]
-        #newdocross=np.setdiff1d(self.docross,delxinds)#unique elements of docross not in delxinds
-
-
-        newi=0        
-        for j in xrange(self.Ncross):
-            if not j in delxinds: #copy over values we're keeping
-                newcl[newi,:]=self.cl[j,:]
-                newi+=1
-        #set up new values
-        self.Nmap=newNmap
-        self.bintaglist.remove(tag)
-        self.tagdict={self.bintaglist[m]:m for m in xrange(self.Nmap)}
-        self.Ncross=newNcross
-        crosspairs,crossinds=get_index_pairs(self.Nmap)
-        self.crosspairs=crosspairs #[crossind,mapinds] (NCross x2)
-        self.crossinds=crossinds #[mapind,mapind] (Nmap x Nmap)
-        #THIS IS A TEMPORARY HACK
-        self.pairs=consolidate_dotags(['all'],self.bintaglist)
-        #self.docross=['all'] 
-        #self.pairs=get_pairs_fromcrossind(self.bintaglist,newdocross,self.crosspairs,self.crossinds)
-        self.cl=newcl
-        self.nbar=np.delete(self.nbar,oldmapind)
-        #just set up noisecl again
-        self.noisecl = np.zeros((self.Ncross,self.Nell)) 
-        for i in xrange(self.Nmap):
-            if self.nbar[i]!=-1: #assumes -1 for no noise or isw
-                self.noisecl[i,i]=1/self.nbar[i]
+        delind=self.tagdict[tag]
+        newcldat=self.get_submaps([m for m in xrange(self.Nmap) if m!=delind])
+        for attr in ['bintaglist','Nmap','tagdict','Ncross','crosspairs','crossinds','domask','cl','nbar','noisecl']:
+            setattr(self,attr,getattr(newcldat,attr))
         return True
 
+    #combine with C_l in oldcl, eg to write everything to file; returns new
+    # ClData with oldcl's maps followed by any maps only in this one
+    # if Overwrite; values here are kept even if old exist for that pair,
+    #  otherwise, pairs computed in oldcl keep their old values
+    def merge(self,oldcl,Overwrite=False):
+        oldind=translate_tag_inds(self,oldcl)
+        combotags=oldcl.bintaglist[:]+[self.bintaglist[t] for t in xrange(self.Nmap) if oldind[t]<0]
+        comboNmap=len(combotags)
+        combopairs,comboxinds=get_index_pairs(comboNmap)
+        #map index of each combo map in old and new, -1 if not there
+        oldmapind=-1*np.ones(comboNmap,dtype=int)
+        oldmapind[:oldcl.Nmap]=np.arange(oldcl.Nmap)
+        newmapind=np.array([self.tagdict.get(tag,-1) for tag in combotags],dtype=int)
+        c0=combopairs[:,0]
+        c1=combopairs[:,1]
+        inold=(oldmapind[c0]>=0)*(oldmapind[c1]>=0)
+        innew=(newmapind[c0]>=0)*(newmapind[c1]>=0)
+        oldx=oldcl.crossinds[oldmapind[c0],oldmapind[c1]] #junk where not inold
+        newx=self.crossinds[newmapind[c0],newmapind[c1]]
+        olddone=inold*oldcl.domask[oldx]
+        newdone=innew*self.domask[newx]
+        useold=olddone*np.logical_not(Overwrite*innew)
+        usenew=innew*np.logical_not(useold)
+
+        comboCl=np.zeros((comboNmap*(comboNmap+1)/2,self.Nell))
+        comboCl[useold]=oldcl.cl[oldx[useold]]
+        comboCl[usenew]=self.cl[newx[usenew]]
+        combonbar=np.where(newmapind>=0,self.nbar[newmapind],oldcl.nbar[oldmapind])
+        return ClData(self.rundat,combotags,clgrid=comboCl,nbarlist=combonbar,domask=olddone+newdone)
+
 
 ###########################################################################
 def sphericalBesselj(n,x):
@@ -196,6 +222,103 @@ def LimberCl_integrand(z,hubble,growth,cor,Pz_interpfn,iswprefactor,window1,wind
     result=np.nan_to_num(result)#if nan, will get replaced with zero
     return result
 
+#-------------------------------------------------------------------------
+# Limber C_l for all pairs and ells at once (rundata.limbermethod='grid')
+#  Everything in LimberCl_integrand is put on one z-grid shared by all
+#  maps: windows (zero outside each map's zmin,zmax), H D^2/r^2/c, the ISW
+#  factor, and P((l+1/2)/r(z)) for every ell. Then for each ell,
+#  C_l^ij = sum_z w_z P_l(z) A_il(z) A_jl(z) is one matrix product, with
+#  trapezoid weights w_z. returns array [Ncross,Nell]; pairs not in
+#  docross are left zero
+def LimberCl_grid(binmaps,lvals,cosm,crosspairs,docross,nperz=1000,nperedge=10,nedge=5,maxelements=4.e6):
+    zgrid=Limber_zgrid(binmaps,nperz,nperedge,nedge)
+    Nz=zgrid.size
+    Nmap=len(binmaps)
+    Nell=lvals.size
+    w=trapezoid_weights(zgrid)
+    r=cosm.co_r(zgrid)
+    usez=(zgrid>0)*(r>0) #integrand is zero at r=0
+    bkgd=np.zeros(Nz)
+    bkgd[usez]=cosm.hub(zgrid[usez])*cosm.growth(zgrid[usez])**2/r[usez]**2/cosm.c
+    W=windows_on_zgrid(binmaps,zgrid)
+    isISW=np.array([m.isISW for m in binmaps])
+    if np.any(isISW): #(l+1/2)/r gets put in below
+        iswfac=(100.)**2*3./cosm.c**2*(1.-cosm.growthrate(zgrid))*r**2
+    Clmat=np.zeros((Nell,Nmap,Nmap))
+    #do ells in blocks, keeping [ell,map,z] arrays below maxelements
+    Nlblock=max(1,int(maxelements/(Nmap*Nz)))
+    for lstart in xrange(0,Nell,Nlblock):
+        lblock=lvals[lstart:lstart+Nlblock]
+        lhalf=(lblock+.5)[:,np.newaxis]
+        k=np.zeros((lblock.size,Nz))
+        k[:,usez]=lhalf/r[usez]
+        P=np.zeros((lblock.size,Nz))
+        P[:,usez]=cosm.P(k[:,usez])
+        A=np.tile(W,(lblock.size,1,1)) #[ell,map,z]
+        if np.any(isISW):
+            A[:,isISW,:]*=(iswfac/lhalf**2)[:,np.newaxis,:]
+        Aw=A*(w*bkgd)[np.newaxis,np.newaxis,:]*P[:,np.newaxis,:]
+        Clmat[lstart:lstart+lblock.size]=np.matmul(Aw,A.transpose(0,2,1))
+    Clmat[lvals==0]=0.
+    Clvals=np.zeros((crosspairs.shape[0],Nell))
+    docross=np.asarray(docross,dtype=int)
+    if docross.size:
+        Clvals[docross,:]=np.nan_to_num(Clmat[:,crosspairs[docross,0],crosspairs[docross,1]].T)
+    return Clvals
+
+# z-grid for LimberCl_grid: evenly spaced at nperz per unit z over all
+#  maps' z ranges, plus nperedge pts per edge width for nedge widths either
+#  side of each map's smoothed window edges, plus each map's zmin and zmax
+def Limber_zgrid(binmaps,nperz=1000,nperedge=10,nedge=5):
+    zlo=min([m.zmin for m in binmaps])
+    zhi=max([m.zmax for m in binmaps])
+    zpts=[np.linspace(zlo,zhi,int(np.ceil(nperz*(zhi-zlo)))+1)]
+    for m in binmaps:
+        zpts.append(np.array([m.zmin,m.zmax]))
+        for znom in (m.zminnom,m.zmaxnom):
+            sigz0=getattr(m,'sigz0',0.) #plain BinMaps have no photo-z errors
+            if m.isGal and sigz0>0: #photo-z errors set edge width
+                dzedge=sigz0*(1.+znom)
+            else: #smoothed tophat edges
+                dzedge=m.sharpness*(m.zmaxnom-m.zminnom)/2.
+            if dzedge<=0:
+                continue
+            edgez=znom+dzedge*np.linspace(-nedge,nedge,2*nedge*nperedge+1)
+            zpts.append(edgez[(edgez>=m.zmin)*(edgez<=m.zmax)])
+    return np.unique(np.concatenate(zpts))
+
+# trapezoid weights for a possibly uneven grid
+def trapezoid_weights(x):
+    w=np.zeros(x.size)
+    w[1:]+=.5*np.diff(x)
+    w[:-1]+=.5*np.diff(x)
+    return w
+
+# windows of binmaps on zgrid, [Nmap,Nz], zero outside each map's zmin,zmax
+def windows_on_zgrid(binmaps,zgrid):
+    W=np.zeros((len(binmaps),zgrid.size))
+    for n,m in enumerate(binmaps):
+        inbin=(zgrid>=m.zmin)*(zgrid<=m.zmax)
+        W[n,inbin]=m.window(zgrid[inbin])
+    return W
+
+#-------------------------------------------------------------------------
+# window overlap index for all pairs of maps, [Nmap,Nmap]:
+#   int W_i W_j dz/sqrt(int W_i^2 dz int W_j^2 dz)
+#  on the Limber_zgrid, which resolves photo-z tails, so it's 1 for
+#  identical windows and 0 for pairs whose zmin,zmax ranges don't meet
+def window_overlaps(binmaps,nperz=1000,nperedge=10,nedge=5):
+    zgrid=Limber_zgrid(binmaps,nperz,nperedge,nedge)
+    W=windows_on_zgrid(binmaps,zgrid)
+    M=np.dot(W*trapezoid_weights(zgrid),W.T)
+    norm=np.sqrt(np.diag(M))
+    norm[norm==0]=1.
+    return M/np.outer(norm,norm)
+
+# True if the zmin,zmax ranges of two maps overlap; Limber C_l is zero if not
+def windows_meet(binmap1,binmap2):
+    return min(binmap1.zmax,binmap2.zmax)>max(binmap1.zmin,binmap2.zmin)
+
 
 #=============================================================
 # functions handling Ilk for an individual bin map
@@ -203,39 +326,156 @@ def LimberCl_integrand(z,hubble,growth,cor,Pz_interpfn,iswprefactor,window1,wind
 # getIlk: reads in Ilk file if there, otherwise computes
 def getIlk_for_binmap(binmap,rundata,redo=False,DoNotOverwrite=False):
     needIlk=True
+    canextend=False
     if not redo:
         #check if file w appropriate name exists
-        if binmap.isISW:
-            if rundata.iswilktag: runtag='.'+rundata.iswilktag
-            else: runtag=''
-        else:
-            if rundata.ilktag: runtag = '.'+rundata.ilktag
-            else: runtag=''
-        f = ''.join([rundata.ilkdir,binmap.tag,'_Ilk',runtag,'.dat'])
-        if os.path.isfile(f):
+        f = existing_ilk_file(binmap,rundata)
+        if f:
             #read it in, check that ell and k vals are good
             Ilk,k_forI=readIlk_file(binmap,rundata)
             if Ilk.size:
                 needIlk=False
+            else: #see if we can just compute missing ell and k
+                canextend=True
     if needIlk and (not DoNotOverwrite):
-        Ilk=computeIlk(binmap,rundata)
-        k_forI=rundata.kdata.karray
+        Ilk=np.array([])
+        if canextend:
+            Ilk,k_forI=extendIlk(binmap,rundata)
+        if not Ilk.size:
+            Ilk=computeIlk_fromshells(binmap,rundata)
+        if not Ilk.size:
+            Ilk=computeIlk(binmap,rundata)
+        if not canextend or not k_forI.size:
+            k_forI=rundata.kdata.karray
     elif DoNotOverwrite:
         print "***in getIlk: DoNotOverwrite=True, but need Ilk values"
     return Ilk,k_forI
 
 #-------------------------------------------------------------------------
-def computeIlk(binmap,rundata):
+# getIlk for a list of binmaps: returns lists of Ilk and k_forI in the same
+#  order. With ilkmethod grid or fftlog, binmaps with no stored Ilk are
+#  computed together, one batch per map type, so bessel fns and background
+#  quantities are evaluated once for all bins of that type.
+def getIlk_for_binmaplist(binmaplist,rundata,redo=False,DoNotOverwrite=False):
+    Ilist=[np.array([])]*len(binmaplist)
+    klist=[rundata.kdata.karray]*len(binmaplist)
+    batchmaps={} #typetag:list of indices
+    for i,m in enumerate(binmaplist):
+        canbatch=rundata.ilkmethod in ['grid','fftlog'] and not rundata.sharpkcut and not DoNotOverwrite
+        if canbatch and (redo or not existing_ilk_file(m,rundata)):
+            Ilk=computeIlk_fromshells(m,rundata)
+            if Ilk.size:
+                Ilist[i]=Ilk
+            else:
+                batchmaps.setdefault(m.typetag,[]).append(i)
+        else:
+            Ilist[i],klist[i]=getIlk_for_binmap(m,rundata,redo,DoNotOverwrite)
+    for typetag in batchmaps:
+        inds=batchmaps[typetag]
+        if len(inds)==1:
+            Ilist[inds[0]]=computeIlk(binmaplist[inds[0]],rundata)
+        else:
+            Ibatch=computeIlk_batch([binmaplist[i] for i in inds],rundata)
+            for n,i in enumerate(inds):
+                Ilist[i]=Ibatch[n]
+    return Ilist,klist
+
+#-------------------------------------------------------------------------
+# ell values Ilk is needed for: those below the switch to limber approx
+def ilk_lvals(rundata):
+    if rundata.limberl>=0 and rundata.limberl<=rundata.lmax:
+        return rundata.lvals[rundata.lvals<rundata.limberl]
+    return rundata.lvals
+
+#-------------------------------------------------------------------------
+# if stored Ilk for binmap are on the same log k grid as rundata but are
+#  missing some ell or k values, compute just the missing ones, merge
+#  them into the stored table, and save. Returns Ilk for rundata's ell
+#  and the (possibly larger) array of k they're tabulated at; these are
+#  empty if stored data can't be extended.
+def extendIlk(binmap,rundata):
+    Iold,lold,kold,innperlogk=readIlk_table(existing_ilk_file(binmap,rundata))
+    kdata=rundata.kdata
+    lneed=ilk_lvals(rundata)
+    kneed=kdata.karray
+    #k values must lie on the same log grid to be merged
+    kshift=np.log10(kneed[0]/kold[0])*kdata.nperlogk
+    if innperlogk!=kdata.nperlogk or np.fabs(kshift-np.round(kshift))>1.e-6:
+        print " *** stored Ilk on different k grid, recompute."
+        return np.array([]),np.array([])
+    kold_ind=np.round(np.log10(kold/kold[0])*kdata.nperlogk).astype(int)
+    kneed_ind=np.round(np.log10(kneed/kold[0])*kdata.nperlogk).astype(int)
+    newl=np.setdiff1d(lneed,lold)
+    #fill in any gap between stored and requested k, so table is contiguous
+    kall_ind=np.arange(min(kold_ind[0],kneed_ind[0]),max(kold_ind[-1],kneed_ind[-1])+1)
+    newkind=np.setdiff1d(kall_ind,kold_ind)
+    lall=np.union1d(lold,newl)
+    kall=kold[0]*10**(kall_ind/float(kdata.nperlogk))
+    kall[np.searchsorted(kall_ind,kold_ind)]=kold #keep stored k exactly
+    print "Extending stored Ilk for {0:s}: {1:d} new ell, {2:d} new k".format(binmap.tag,newl.size,newkind.size)
+
+    Iall=np.zeros((lall.size,kall.size))
+    lind_old=np.searchsorted(lall,lold)
+    kpos_old=np.searchsorted(kall_ind,kold_ind)
+    Iall[np.ix_(lind_old,kpos_old)]=Iold
+    if newl.size: #new ell, all k
+        Iall[np.searchsorted(lall,newl),:]=computeIlk(binmap,rundata,lvals=newl,kvals=kall,writefile=False)
+    if newkind.size: #old ell, new k
+        kpos_new=np.searchsorted(kall_ind,newkind)
+        Iall[np.ix_(lind_old,kpos_new)]=computeIlk(binmap,rundata,lvals=lold,kvals=kall[kpos_new],writefile=False)
+    writeIlk(Iall,binmap,rundata,lvals=lall,kvals=kall)
+    clear_ilk_chunks(binmap,rundata)
+
+    #return just requested ell, k from min to max requested
+    kpos=np.searchsorted(kall_ind,kneed_ind)
+    kpos=np.arange(kpos[0],kpos[-1]+1)
+    return Iall[np.ix_(np.searchsorted(lall,lneed),kpos)],kall[kpos]
+
+#-------------------------------------------------------------------------
+# where Ilk for binmap is stored: in the shared cache under a hash of the
+#  settings that determine it, or if there's no cache dir, labeled by tags
+#  extension depends on ilkformat; if not given, use rundata.ilkformat
+ilkfile_ext={'npy':'.npy','text':'.dat'}
+def ilk_filename(binmap,rundata,ilkformat=''):
+    if not ilkformat:
+        ilkformat=rundata.ilkformat
+    ext=ilkfile_ext[ilkformat]
+    if rundata.ilkcachedir:
+        return ''.join([rundata.ilkcachedir,'Ilk_',rundata.ilkhash(binmap),ext])
+    if binmap.isISW:
+        if rundata.iswilktag: runtag='.'+rundata.iswilktag
+        else: runtag=''
+    else:
+        if rundata.ilktag: runtag = '.'+rundata.ilktag
+        else: runtag=''
+    return ''.join([rundata.ilkdir,binmap.tag,'_Ilk',runtag,ext])
+
+# returns name of Ilk file for binmap if one exists in either format,
+#  preferring rundata.ilkformat. returns empty string if there's none
+def existing_ilk_file(binmap,rundata):
+    for ilkformat in [rundata.ilkformat]+[f for f in rundata.ilkformats if f!=rundata.ilkformat]:
+        f=ilk_filename(binmap,rundata,ilkformat)
+        if os.path.isfile(f):
+            return f
+    return ''
+
+#-------------------------------------------------------------------------
+# Work is split into chunks, one per ell for methods that do all k at once
+#  and (ell, block of ilkchunk_nk k values) otherwise. Each chunk is saved
+#  as it finishes, so if a run is interrupted, calling this again with the
+#  same settings only computes the chunks that aren't done.
+def computeIlk(binmap,rundata,lvals=np.array([]),kvals=np.array([]),writefile=True):
+    # if lvals or kvals are given, compute just for those (kvals should
+    #  be on a log grid w spacing from rundata.kdata if using fftlog)
     DOPARALLEL=1
-    print "Computing Ilk for ",binmap.tag,'DOPARALLEL=',DOPARALLEL
+    print "Computing Ilk for ",binmap.tag,'DOPARALLEL=',DOPARALLEL,'method=',rundata.ilkmethod
     #set up arrays
-    kvals = rundata.kdata.karray
+    if not kvals.size:
+        kvals = rundata.kdata.karray
     Nk = kvals.size
     # just do the ell with no limber approx
-    if rundata.limberl>=0 and rundata.limberl<=rundata.lmax:
-        lvals = rundata.lvals[:np.where(rundata.lvals<rundata.limberl)[0][-1]+1]#rundata.lvals
-    else:
-        lvals=rundata.lvals
+    if not lvals.size:
+        lvals=ilk_lvals(rundata)
     Nell = lvals.size
     Ivals = np.zeros((Nell,Nk))
     eps = rundata.epsilon
@@ -252,33 +492,287 @@ def computeIlk(binmap,rundata):
     #bounds for integral in comoving radius
     rmin=co_r(binmap.zmin)
     rmax=co_r(binmap.zmax)
-    
-    lk= itertools.product(lvals,kvals) #items=[l,k]
-    argiter=itertools.izip(lk,itertools.repeat(rmin),itertools.repeat(rmax),itertools.repeat(cosm),itertools.repeat(binmap),itertools.repeat(krcutadd),itertools.repeat(krcutmult),itertools.repeat(zintlim),itertools.repeat(eps),itertools.repeat(rundata.sharpkcut),itertools.repeat(rundata.besselxmincut))
-    if DOPARALLEL:
-        pool = Pool()
-        results=pool.map_async(Iintwrapper,argiter)
-        newI=np.array(results.get())
-        pool.close()
-        pool.join()
-
-        #rearrange into [l,k] shape
-        Ivals=newI.reshape(Nell,Nk)
-
+    #workers get these once, tasks hold references
+    cosmref=cosm_ref(rundata)
+    binmapref=binmap_ref(rundata,binmap)
+
+    #find chunks that still need computing
+    perell= rundata.ilkmethod in ['grid','fftlog']
+    if perell:
+        Nkchunk=Nk
     else:
-        argiter=list(argiter)
-        for i in xrange(len(argiter)):
-            argtuple=argiter[i]
-            lk,rmin,rmax,cosm,binmap,krcutadd,krcutmult,zintlim,epsilon,zeropostcut,besselxmincut= argtuple
-            l,kval=lk
-            lind=np.where(lvals==l)[0][0]
-            kind=np.where(kvals==kval)[0][0]
-            Ival=Iintwrapper(argtuple)
-            Ivals[lind,kind]=Ival
+        Nkchunk=rundata.ilkchunk_nk
+    chunkdir=ilk_chunkdir(binmap,rundata)
+    todo=[] #(lind,kstart,kend) for each chunk not done yet
+    Nchunk=0
+    for lind in xrange(Nell):
+        for kstart in xrange(0,Nk,Nkchunk):
+            kend=min(kstart+Nkchunk,Nk)
+            Nchunk+=1
+            chunkI=readIlk_chunk(chunkdir,lvals[lind],kvals[kstart:kend])
+            if chunkI.size:
+                Ivals[lind,kstart:kend]=chunkI
+            else:
+                todo.append((lind,kstart,kend))
+    if len(todo)<Nchunk:
+        print "  Resuming: {0:d} of {1:d} Ilk chunks already done".format(Nchunk-len(todo),Nchunk)
+    #list tasks as (chunk index, lind, kind); kind=-1 for all k of an ell
+    if perell:
+        tasks=[(c,todo[c][0],-1) for c in xrange(len(todo))]
+        lvals_todo=[lvals[t[1]] for t in tasks]
+    else:
+        tasks=[(c,todo[c][0],kind) for c in xrange(len(todo)) for kind in xrange(todo[c][1],todo[c][2])]
+        lk=[(lvals[t[1]],kvals[t[2]]) for t in tasks] #items=[l,k]
+
+    if rundata.ilkmethod=='grid': #one task per ell, returns all k at once
+        Nrmin=Ilk_grid_Nrmin(binmap,cosm,rundata.ilkgrid_nperz,rundata.ilkgrid_nperedge)
+        argiter=itertools.izip(lvals_todo,itertools.repeat(kvals),itertools.repeat(rmin),itertools.repeat(rmax),itertools.repeat(cosmref),itertools.repeat(binmapref),itertools.repeat(krcutadd),itertools.repeat(krcutmult),itertools.repeat(Nrmin),itertools.repeat(rundata.ilkgrid_nperosc),itertools.repeat(rundata.ilkgrid_maxelements),itertools.repeat(eps),itertools.repeat(rundata.sharpkcut),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper_grid
+    elif rundata.ilkmethod=='fftlog': #one task per ell, one FFT for all k
+        Nrmin=Ilk_grid_Nrmin(binmap,cosm,rundata.ilkgrid_nperz,rundata.ilkgrid_nperedge)
+        #fft needs evenly spaced log k; do span of kvals, pick them out after
+        nperlogk=rundata.kdata.nperlogk
+        kspanind=np.round(np.log10(kvals/kvals[0])*nperlogk).astype(int)
+        kspan=kvals[0]*10**(np.arange(kspanind[-1]+1)/float(nperlogk))
+        argiter=itertools.izip(lvals_todo,itertools.repeat(kspan),itertools.repeat(nperlogk),itertools.repeat(rmin),itertools.repeat(rmax),itertools.repeat(cosmref),itertools.repeat(binmapref),itertools.repeat(Nrmin),itertools.repeat(rundata.fftlog_padlogk),itertools.repeat(rundata.fftlog_q),itertools.repeat(eps),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper_fftlog
+    elif rundata.ilkmethod=='levin': #one task per (l,k) pair, no krcut
+        redges=[co_r(z) for z in (binmap.zminnom,binmap.zmaxnom) if binmap.zmin<z<binmap.zmax]
+        argiter=itertools.izip(lk,itertools.repeat(rmin),itertools.repeat(rmax),itertools.repeat(redges),itertools.repeat(cosmref),itertools.repeat(binmapref),itertools.repeat(rundata.levin_npts),itertools.repeat(rundata.levin_maxdepth),itertools.repeat(eps),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper_levin
+    else: #one task per (l,k) pair
+        argiter=itertools.izip(lk,itertools.repeat(rmin),itertools.repeat(rmax),itertools.repeat(cosmref),itertools.repeat(binmapref),itertools.repeat(krcutadd),itertools.repeat(krcutmult),itertools.repeat(zintlim),itertools.repeat(eps),itertools.repeat(rundata.sharpkcut),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper
+    #run expensive tasks first; save each chunk once all of it is done
+    arglist=list(argiter)
+    costs=Ilk_taskcosts(rundata,binmap,rmin,rmax,lvals,kvals,tasks)
+    Nleft=[c[2]-c[1] if not perell else 1 for c in todo] #tasks left per chunk
+    tasktimes=np.zeros(len(tasks))
+    for t,result,dt in run_scheduled(intwrapper,arglist,costs,DOPARALLEL,rundata.executor):
+        c,lind,kind=tasks[t]
+        tasktimes[t]=dt
+        if perell:
+            if rundata.ilkmethod=='fftlog':
+                result=result[kspanind]
+            Ivals[lind,:]=result
+        else:
+            Ivals[lind,kind]=result
+        Nleft[c]-=1
+        if not Nleft[c]:
+            lind,kstart,kend=todo[c]
+            writeIlk_chunk(chunkdir,lvals[lind],kvals[kstart:kend],Ivals[lind,kstart:kend])
+    if tasks and rundata.logtasktimes:
+        if perell:
+            labels=['{0:s} {1:s} l={2:d} Nk={3:d}'.format(binmap.tag,rundata.ilkmethod,lvals[t[1]],Nk) for t in tasks]
+        else:
+            labels=['{0:s} {1:s} l={2:d} k={3:0.4e}'.format(binmap.tag,rundata.ilkmethod,lvals[t[1]],kvals[t[2]]) for t in tasks]
+        log_tasktimes(rundata.ilkdir+'tasktimes_Ilk.dat',labels,costs,tasktimes)
  
     #save result to file
-    writeIlk(Ivals,binmap,rundata)
+    if writefile:
+        writeIlk(Ivals,binmap,rundata,lvals=lvals,kvals=kvals)
+        clear_ilk_chunks(binmap,rundata)
+    return Ivals
+
+#-------------------------------------------------------------------------
+# Computes Ilk for several binmaps at once with ilkmethod grid or fftlog.
+#  All windows share one r grid covering their combined range, fine enough
+#  for the narrowest of them, so each ell's bessel table and the background
+#  fns are computed once and applied to all windows with one matrix product.
+#  Worth it for bins of one map type, which overlap; returns array
+#  [Nmap,Nell,Nk] and saves each binmap's Ilk as computeIlk would.
+def computeIlk_batch(binmaps,rundata):
+    DOPARALLEL=1
+    print "Computing Ilk for ",', '.join([m.tag for m in binmaps]),'DOPARALLEL=',DOPARALLEL,'method=',rundata.ilkmethod
+    kvals = rundata.kdata.karray
+    Nk = kvals.size
+    lvals=ilk_lvals(rundata)
+    Nell = lvals.size
+    Nmap = len(binmaps)
+    Ivals = np.zeros((Nmap,Nell,Nk))
+    eps = rundata.epsilon
+
+    cosm = rundata.cosm
+    zmax = max([m.zmax for m in binmaps])
+    if not cosm.tabZ or cosm.zmax<zmax:
+        cosm.tabulateZdep(max(rundata.zmax,zmax),nperz=cosm.nperz)
+    rmins=np.array([cosm.co_r(m.zmin) for m in binmaps])
+    rmaxs=np.array([cosm.co_r(m.zmax) for m in binmaps])
+    rmin=rmins.min()
+    rmax=rmaxs.max()
+    #keep each window's r spacing at least as fine as it would be alone
+    Nrmin=max([Ilk_grid_Nrmin(m,cosm,rundata.ilkgrid_nperz,rundata.ilkgrid_nperedge)*(rmax-rmin)/(rmaxs[n]-rmins[n]) for n,m in enumerate(binmaps)])
+    Nrmin=int(Nrmin)+1
+    cosmref=cosm_ref(rundata)
+    binmapsref=tuple([binmap_ref(rundata,m) for m in binmaps])
+
+    #ells done on an earlier, interrupted run have chunks for every map
+    chunkdirs=[ilk_chunkdir(m,rundata) for m in binmaps]
+    lvals_todo=[]
+    for lind in xrange(Nell):
+        chunks=[readIlk_chunk(d,lvals[lind],kvals) for d in chunkdirs]
+        if all([c.size for c in chunks]):
+            Ivals[:,lind,:]=np.array(chunks)
+        else:
+            lvals_todo.append(lvals[lind])
+    if len(lvals_todo)<Nell:
+        print "  Resuming: {0:d} of {1:d} ell already done".format(Nell-len(lvals_todo),Nell)
+
+    if rundata.ilkmethod=='fftlog':
+        argiter=itertools.izip(lvals_todo,itertools.repeat(kvals),itertools.repeat(rundata.kdata.nperlogk),itertools.repeat(rmins),itertools.repeat(rmaxs),itertools.repeat(cosmref),itertools.repeat(binmapsref),itertools.repeat(Nrmin),itertools.repeat(rundata.fftlog_padlogk),itertools.repeat(rundata.fftlog_q),itertools.repeat(eps),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper_fftlog_batch
+    else:
+        argiter=itertools.izip(lvals_todo,itertools.repeat(kvals),itertools.repeat(rmins),itertools.repeat(rmaxs),itertools.repeat(cosmref),itertools.repeat(binmapsref),itertools.repeat(Nrmin),itertools.repeat(rundata.ilkgrid_nperosc),itertools.repeat(rundata.ilkgrid_maxelements),itertools.repeat(eps),itertools.repeat(rundata.besselxmincut))
+        intwrapper=Iintwrapper_grid_batch
+    arglist=list(argiter)
+    tasks=[(n,np.where(lvals==l)[0][0],-1) for n,l in enumerate(lvals_todo)]
+    costs=Ilk_taskcosts(rundata,binmaps[0],rmin,rmax,lvals,kvals,tasks,Nrmin)
+    tasktimes=np.zeros(len(tasks))
+    for t,result,dt in run_scheduled(intwrapper,arglist,costs,DOPARALLEL,rundata.executor):
+        lind=tasks[t][1]
+        tasktimes[t]=dt
+        Ivals[:,lind,:]=result
+        for n in xrange(Nmap):
+            writeIlk_chunk(chunkdirs[n],lvals[lind],kvals,result[n])
+    if tasks and rundata.logtasktimes:
+        labels=['{0:s}[{1:d} maps] {2:s} l={3:d} Nk={4:d}'.format(binmaps[0].typetag,Nmap,rundata.ilkmethod,lvals[t[1]],Nk) for t in tasks]
+        log_tasktimes(rundata.ilkdir+'tasktimes_Ilk.dat',labels,costs,tasktimes)
+
+    for n in xrange(Nmap):
+        writeIlk(Ivals[n],binmaps[n],rundata,lvals=lvals,kvals=kvals)
+        clear_ilk_chunks(binmaps[n],rundata)
     return Ivals
+#=========================================================================
+# Cost-aware scheduling for worker pools
+#  Tasks are sorted by estimated cost and handed out most expensive first,
+#  in batches whose total cost is half of each worker's fair share of
+#  what's left (guided scheduling): expensive tasks go out alone, cheap
+#  ones are grouped to cut overhead, and batches shrink towards the end
+#  so workers finish at about the same time.
+#-------------------------------------------------------------------------
+# returns list of batches, each a list of task indices
+def schedule_batches(costs,Nworkers):
+    order=np.argsort(-costs,kind='mergesort')
+    remaining=costs.sum()
+    batches=[]
+    batch=[]
+    batchcost=0.
+    target=remaining/(2.*Nworkers)
+    for i in order:
+        batch.append(i)
+        batchcost+=costs[i]
+        if batchcost>=target:
+            batches.append(batch)
+            remaining-=batchcost
+            batch=[]
+            batchcost=0.
+            target=remaining/(2.*Nworkers)
+    if batch:
+        batches.append(batch)
+    return batches
+
+# runs on worker: do tasks in batch, timing each
+def run_taskbatch(argtuple):
+    intwrapper,batch=argtuple
+    out=[]
+    for t,args in batch:
+        t0=time.time()
+        result=intwrapper(resolve_context(args))
+        out.append((t,result,time.time()-t0))
+    return out
+
+# generator running intwrapper on arglist in scheduled order;
+#  yields (task index, result, seconds) as tasks finish, in no fixed order
+#  uses executor's workers if given, otherwise a pool just for this call
+def run_scheduled(intwrapper,arglist,costs,DOPARALLEL=True,executor=None):
+    if not len(arglist):
+        return
+    costs=np.asarray(costs,dtype=float)
+    if not DOPARALLEL:
+        if executor is not None:
+            executor.publish()
+        for t in np.argsort(-costs,kind='mergesort'):
+            for out in run_taskbatch((intwrapper,[(t,arglist[t])])):
+                yield out
+        return
+    ownpool= executor is None
+    if ownpool:
+        executor=TaskExecutor('process')
+    batches=schedule_batches(costs,executor.Nworkers)
+    try:
+        batchargs=((intwrapper,[(t,arglist[t]) for t in b]) for b in batches)
+        for outlist in executor.imap_unordered(run_taskbatch,batchargs):
+            for out in outlist:
+                yield out
+    except:
+        executor.terminate()
+        raise
+    finally:
+        #outside a 'with executor:' block, nothing else will reuse workers
+        if ownpool or not executor.depth:
+            executor.close()
+
+# ContextRef for the run's cosmology. Its state includes whether z-dep fns
+#  and P(k) are tabulated, so workers get a new copy once they are
+def cosm_ref(rundata):
+    cosm=rundata.cosm
+    return rundata.executor.ref(cosm,'cosm',(cosm.tabZ,cosm.zmax,cosm.havePk))
+
+# ContextRef for a binmap, named by its tag; its window identifies it
+def binmap_ref(rundata,binmap):
+    return rundata.executor.ref(binmap,binmap_refname(binmap),binmap.windowkey())
+def binmap_refname(binmap):
+    return 'binmap '+binmap.tag
+
+# append per-task estimated cost and measured time to logfile, and print
+#  how well cost predicts time, for tuning the cost model
+def log_tasktimes(logfile,labels,costs,times):
+    costs=np.asarray(costs,dtype=float)
+    times=np.asarray(times,dtype=float)
+    f=open(logfile,'a')
+    f.write(''.join(['{0:s} {1:0.6e} {2:0.6e}\n'.format(labels[t],costs[t],times[t]) for t in xrange(len(labels))]))
+    f.close()
+    secpercost=np.dot(costs,times)/np.dot(costs,costs)
+    use=(times>0)*(costs>0)
+    if np.any(use):
+        logresid=np.log(times[use]/(secpercost*costs[use]))
+        print "  {0:d} tasks, {1:0.2f}s total, max {2:0.2f}s; cost model {3:0.2e}s/unit, rms log resid {4:0.2f}".format(times.size,times.sum(),times.max(),secpercost,np.sqrt(np.mean(logresid**2)))
+
+#-------------------------------------------------------------------------
+# estimated relative cost of each Ilk task in tasks=[(chunk,lind,kind)],
+#  kind=-1 meaning all kvals for that ell. for grid, Nrmin is taken from
+#  binmap unless given
+def Ilk_taskcosts(rundata,binmap,rmin,rmax,lvals,kvals,tasks,Nrmin=0):
+    method=rundata.ilkmethod
+    xmin={}
+    for l in set(lvals[t[1]] for t in tasks):
+        if rundata.besselxmincut and l>0:
+            xmin[l]=findxmin(l,rundata.epsilon)
+        else:
+            xmin[l]=0.
+    if method=='fftlog': #one fft per ell, about the same for all
+        return np.ones(len(tasks))
+    if method=='grid': #size of bessel tables
+        if not Nrmin:
+            Nrmin=Ilk_grid_Nrmin(binmap,rundata.cosm,rundata.ilkgrid_nperz,rundata.ilkgrid_nperedge)
+        costs=[]
+        for t in tasks:
+            rlo=np.maximum(rmin,xmin[lvals[t[1]]]/kvals)
+            Nr=np.maximum(Nrmin,rundata.ilkgrid_nperosc*kvals*(rmax-rlo)/(2.*np.pi))
+            costs.append(np.sum(Nr*(rlo<rmax)))
+        return np.array(costs)
+    costs=np.zeros(len(tasks))
+    for n,t in enumerate(tasks):
+        l=lvals[t[1]]
+        kval=kvals[t[2]]
+        if l==0 or kval*rmax<=xmin[l]: #skipped by besselxmincut
+            costs[n]=.01
+        elif method=='levin': #nearly independent of k
+            costs[n]=1.
+        else: #quad: number of oscillations of j_l(kr) across bin
+            costs[n]=1.+kval*(rmax-max(rmin,xmin[l]/kval))/(2.*np.pi)
+    return costs
+
 #--------------------------------------------------
 #wrapper function for integral, so multithreading works
 def Iintwrapper(argtuple):#(l,kval,rmin,rmax,cosm,binmap,zintlim=10000):
@@ -380,25 +874,505 @@ def Iintegrand_postcut(r,l,k,window,z_from_cor,hubble,growth,growthrate,isISW=Fa
         bessel = np.cos(np.pi*(l+1.)/2.)/(k*r)
     dI*=bessel
     return dI*prefactor
-#-------------------------------------------------------------------------
-def writeIlk(Ilkarray,binmap,rundata):
+#--------------------------------------------------
+# Fixed r-grid Ilk computation (rundata.ilkmethod='grid')
+#  Puts window, growth, H(z), and (1-f) on one uniform r-grid, then
+#  gets I_l(k) for a block of k values as a matrix product against a table
+#  of j_l(kr). Uses exact bessel fns everywhere, so krcut only matters if
+#  sharpkcut (zeropostcut) is set.
+#--------------------------------------------------
+# r-dependent part of Ilk integrand: everything except j_l(kr) and ISW 1/k^2
+#  works on arrays of r
+def Ilk_kernel(r,binmap,cosm):
+    z = cosm.z_from_cor(r)
+    result = binmap.window(z)*cosm.growth(z)*cosm.hub(z)/cosm.c
+    if binmap.isISW: #ISW gets f-1 piece
+        result = result*(1.-cosm.growthrate(z))
+    return result*np.ones_like(r)
+
+# Ilk_kernel for several binmaps, evaluating background fns once;
+#  row n is zero outside [rmins[n],rmaxs[n]]. returns array [Nmap,Nr]
+def Ilk_kernels(r,binmaps,cosm,rmins,rmaxs):
+    z = cosm.z_from_cor(r)
+    bkgd = cosm.growth(z)*cosm.hub(z)/cosm.c
+    fISW = None
+    result = np.zeros((len(binmaps),r.size))
+    for n,binmap in enumerate(binmaps):
+        inbin=(r>=rmins[n])*(r<=rmaxs[n])
+        if not np.any(inbin):
+            continue
+        result[n,inbin] = binmap.window(z[inbin])*bkgd[inbin]
+        if binmap.isISW:
+            if fISW is None:
+                fISW = 1.-cosm.growthrate(z)
+            result[n,inbin] *= fISW[inbin]
+    return result
+
+# prefactor that multiplies Ilk for ISW maps, as fn of k
+def Ilk_prefactor(kvals,binmap,cosm):
     if binmap.isISW:
-        if rundata.iswilktag: runtag = '.'+rundata.iswilktag
-        else: runtag=''
+        H02 = (100.)**2 #h^2km^2/Mpc^2/s^2 
+        return 3.*H02/(cosm.c**2)/(kvals**2) #unitless
+    return np.ones_like(kvals)
+
+# weights for simpson's rule on N evenly spaced points; if N is even,
+#  the last three intervals use simpson's 3/8 rule instead
+def simpson_weights(N,dx):
+    if N%2==0:
+        if N==2: #trapezoid
+            return np.array([.5,.5])*dx
+        w=np.zeros(N)
+        if N>4:
+            w[:N-3]=simpson_weights(N-3,dx)
+        w[N-4:]+=np.array([1.,3.,3.,1.])*3.*dx/8.
+        return w
+    w=np.ones(N)
+    w[1:-1:2]=4.
+    w[2:-1:2]=2.
+    return w*dx/3.
+
+# min number of r-grid points for a binmap, set so that both the z-range
+#  and the smoothed edges of the window fn are resolved
+def Ilk_grid_Nrmin(binmap,cosm,nperz=2000,nperedge=10):
+    Nrmin=nperz*(binmap.zmax-binmap.zmin)
+    sigz0=getattr(binmap,'sigz0',0.) #plain BinMaps have no photo-z errors
+    if binmap.isGal and sigz0>0: #photo-z errors set edge width
+        dzedge=sigz0*(1.+binmap.zminnom)
+    else: #smoothed tophat edges
+        dzedge=binmap.sharpness*(binmap.zmaxnom-binmap.zminnom)/2.
+    #dr/dz is smallest at upper edge
+    zedge=min(binmap.zmaxnom,binmap.zmax-dzedge)
+    dredge=cosm.co_r(zedge+dzedge)-cosm.co_r(zedge)
+    if dredge>0:
+        rmin=cosm.co_r(binmap.zmin)
+        rmax=cosm.co_r(binmap.zmax)
+        Nrmin=max(Nrmin,nperedge*(rmax-rmin)/dredge)
+    return int(Nrmin)+1
+
+# number of r-grid points needed for oscillations at kval; always odd
+def Ilk_grid_Nr(kval,dr,Nrmin,nperosc):
+    Nr=max(Nrmin,int(np.ceil(nperosc*kval*dr/(2.*np.pi))))
+    return Nr+1-Nr%2
+
+#--------------------------------------------------
+# computes Ilk for one ell and all kvals. kernelfn(r) returns
+#  array of shape [Nkernel,Nr], so several windows can share bessel tables
+#  returns array of shape [Nkernel,Nk] (no ISW prefactor applied)
+def Ilk_grid_forell(l,kvals,rmin,rmax,kernelfn,Nrmin=1001,nperosc=20,maxelements=4.e6,epsilon=1.e-10,besselxmincut=True,krcutadd=-1,krcutmult=-1,zeropostcut=False):
+    Nk=kvals.size
+    dr=rmax-rmin
+    result=None
+    if besselxmincut: #j_l(x) set to zero below x where it first reaches epsilon
+        xmin=findxmin(l,epsilon)
     else:
-        if rundata.ilktag: runtag = '.'+rundata.ilktag
-        else: runtag=''
-    outfile = ''.join([rundata.ilkdir,binmap.tag,'_Ilk',runtag,'.dat'])
+        xmin=0.
+    usecut= zeropostcut and krcutadd>=0 and krcutmult>=0
+    kstart=0
+    while kstart<Nk:
+        #get a block of k with bessel table size below maxelements
+        kend=kstart+1
+        while kend<Nk and (kend+1-kstart)*Ilk_grid_Nr(kvals[kend],dr,Nrmin,nperosc)<=maxelements:
+            kend+=1
+        kblock=kvals[kstart:kend]
+        #bessel fns are cut below xmin/k; largest k in block sets grid start
+        rlo=max(rmin,xmin/kblock[-1])
+        if rlo>=rmax:
+            if result is None:
+                result=np.zeros((kernelfn(np.array([rmin,rmax])).shape[0],Nk))
+            kstart=kend
+            continue
+        Nr=Ilk_grid_Nr(kblock[-1],rmax-rlo,Nrmin,nperosc)
+        rgrid=np.linspace(rlo,rmax,Nr)
+        kern=kernelfn(rgrid)*simpson_weights(Nr,rgrid[1]-rgrid[0])
+        if result is None:
+            result=np.zeros((kern.shape[0],Nk))
+        x=np.outer(kblock,rgrid)
+        jl=spherical_jn(l,x)
+        if besselxmincut:
+            jl[x<xmin]=0.
+        if usecut: #zero bessel fns past krcut, where quad would do the same
+            r_atkrcut=(l*krcutmult+krcutadd)/kblock
+            docut=kblock*dr>2*np.pi*10.
+            jl[docut[:,np.newaxis]*(rgrid[np.newaxis,:]>r_atkrcut[:,np.newaxis])]=0.
+        result[:,kstart:kend]=np.dot(kern,jl.T)
+        kstart=kend
+    return result
+
+#--------------------------------------------------
+#wrapper for grid integral for one ell, so multithreading works
+# returns array of I_l(k) for all k in kvals
+def Iintwrapper_grid(argtuple):
+    l,kvals,rmin,rmax,cosm,binmap,krcutadd,krcutmult,Nrmin,nperosc,maxelements,epsilon,zeropostcut,besselxmincut = argtuple
+    if l==0: return np.zeros(kvals.size) #don't compute monopole
+    kernelfn=lambda r: Ilk_kernel(r,binmap,cosm)[np.newaxis,:]
+    result=Ilk_grid_forell(l,kvals,rmin,rmax,kernelfn,Nrmin,nperosc,maxelements,epsilon,besselxmincut,krcutadd,krcutmult,zeropostcut)[0,:]
+    return result*Ilk_prefactor(kvals,binmap,cosm)
+
+# same, for several binmaps sharing one grid; returns array [Nmap,Nk]
+def Iintwrapper_grid_batch(argtuple):
+    l,kvals,rmins,rmaxs,cosm,binmaps,Nrmin,nperosc,maxelements,epsilon,besselxmincut = argtuple
+    if l==0: return np.zeros((len(binmaps),kvals.size)) #don't compute monopole
+    kernelfn=lambda r: Ilk_kernels(r,binmaps,cosm,rmins,rmaxs)
+    result=Ilk_grid_forell(l,kvals,rmins.min(),rmaxs.max(),kernelfn,Nrmin,nperosc,maxelements,epsilon,besselxmincut)
+    return result*np.array([Ilk_prefactor(kvals,m,cosm) for m in binmaps])
+
+#--------------------------------------------------
+# Levin collocation Ilk computation (rundata.ilkmethod='levin')
+#  For w=(j_l(kr),j_{l+1}(kr)), w'=Aw with A=[[l/r,-k],[k,-(l+2)/r]].
+#  Find p(r) with p'+A^T p = (f,0); then int f j_l dr = [p.w] at the edges.
+#  p is smooth even when f*j_l oscillates quickly, so cost is set by how
+#  smooth the kernel f is, not by k, and no krcut approx is needed.
+#--------------------------------------------------
+_levin_matrices={} #cache of chebyshev collocation matrices, keyed by npts
+def levin_chebmatrices(npts):
+    if npts not in _levin_matrices:
+        x=np.cos(np.pi*np.arange(npts)/(npts-1.)) #lobatto nodes, x[0]=1
+        V=np.polynomial.chebyshev.chebvander(x,npts-1)
+        dV=np.zeros_like(V)
+        for m in xrange(1,npts):
+            coef=np.zeros(npts)
+            coef[m]=1.
+            dV[:,m]=np.polynomial.chebyshev.chebval(x,np.polynomial.chebyshev.chebder(coef))
+        _levin_matrices[npts]=(x,V,dV)
+    return _levin_matrices[npts]
+
+# int_a^b f(r)j_l(kr) dr on one segment, fvals is kernel at the nodes
+#  falls back on direct chebyshev quadrature if segment has < one oscillation,
+#  where the levin system is badly conditioned
+def levin_segment(l,kval,a,b,kernelfn,npts):
+    x,V,dV=levin_chebmatrices(npts)
+    r=.5*(a+b)+.5*(b-a)*x
+    f=kernelfn(r)
+    if kval*(b-a)<2.*np.pi:
+        #clenshaw-curtis: integrate chebyshev interpolant of f*j_l exactly
+        c=np.linalg.solve(V,f*spherical_jn(l,kval*r))
+        m=np.arange(0,npts,2)
+        return .5*(b-a)*np.sum(c[m]*2./(1.-m*m))
+    dV=dV*2./(b-a)
+    M=np.zeros((2*npts,2*npts))
+    M[:npts,:npts]=dV+(l/r)[:,np.newaxis]*V
+    M[:npts,npts:]=kval*V
+    M[npts:,:npts]=-kval*V
+    M[npts:,npts:]=dV-((l+2.)/r)[:,np.newaxis]*V
+    rhs=np.zeros(2*npts)
+    rhs[:npts]=f
+    c=np.linalg.lstsq(M,rhs,rcond=-1)[0]
+    #p at r=b (x=1) and r=a (x=-1)
+    sign=(-1.)**np.arange(npts)
+    p1b,p2b=np.sum(c[:npts]),np.sum(c[npts:])
+    p1a,p2a=np.sum(c[:npts]*sign),np.sum(c[npts:]*sign)
+    wb=spherical_jn(l,kval*b),spherical_jn(l+1,kval*b)
+    wa=spherical_jn(l,kval*a),spherical_jn(l+1,kval*a)
+    return p1b*wb[0]+p2b*wb[1]-p1a*wa[0]-p2a*wa[1]
+
+# adaptive bisection: accept segment when it agrees with sum of its halves
+def levin_adaptive(l,kval,a,b,kernelfn,npts,epsilon,maxdepth,whole=None,depth=0):
+    if whole is None:
+        whole=levin_segment(l,kval,a,b,kernelfn,npts)
+    mid=.5*(a+b)
+    left=levin_segment(l,kval,a,mid,kernelfn,npts)
+    right=levin_segment(l,kval,mid,b,kernelfn,npts)
+    halves=left+right
+    if depth>=maxdepth or np.fabs(whole-halves)<=max(epsilon,epsilon*np.fabs(halves)):
+        return halves
+    return levin_adaptive(l,kval,a,mid,kernelfn,npts,epsilon,maxdepth,left,depth+1)+levin_adaptive(l,kval,mid,b,kernelfn,npts,epsilon,maxdepth,right,depth+1)
+
+#--------------------------------------------------
+#wrapper for levin integral for one (l,k), so multithreading works
+# redges - r values of window edges; used as initial breakpoints
+def Iintwrapper_levin(argtuple):
+    lk,rmin,rmax,redges,cosm,binmap,npts,maxdepth,epsilon,besselxmincut = argtuple
+    l,kval=lk
+    if l==0: return 0. #don't compute monopole
+    if besselxmincut:
+        xmin=findxmin(l,epsilon)
+        rmin=max(rmin,xmin/kval)
+        if rmin>=rmax:
+            return 0.
+    kernelfn=lambda r: Ilk_kernel(r,binmap,cosm)
+    breaks=[rmin]+[r for r in sorted(redges) if rmin<r<rmax]+[rmax]
+    result=0.
+    for i in xrange(len(breaks)-1):
+        result+=levin_adaptive(l,kval,breaks[i],breaks[i+1],kernelfn,npts,epsilon,maxdepth)
+    return result*Ilk_prefactor(kval,binmap,cosm)
+
+#--------------------------------------------------
+# FFTLog Ilk computation (rundata.ilkmethod='fftlog')
+#  With r and k on log grids of equal spacing dlnr=dlnk, write
+#  I_l(k)=int F(r) j_l(kr) dlnr with F=r*kernel. Expanding F*r^-q in a
+#  fourier series in lnr, each term's integral is known analytically
+#  (the mellin transform of j_l), so all k come out of one FFT.
+#--------------------------------------------------
+# mellin transform of j_l: int_0^inf t^(z-1) j_l(t) dt, valid for -l<Re(z)<2
+def mellin_sphericalBesselj(l,z):
+    lnU=np.log(2.)*(z-2.)+.5*np.log(np.pi)+loggamma(.5*(l+z))-loggamma(.5*(3.+l-z))
+    return np.exp(lnU)
+
+# given kernel values F_n=F(r_n) on r_n=r0*exp(n*dlnr), returns
+#  G(k_j)=int F(r) j_l(kr) dlnr on k_j=k0*exp(j*dlnr)
+#  F can have leading axes for several kernels; transforms along last
+def fftlog_besselj(l,F,r0,k0,dlnr,q=0.):
+    N=F.shape[-1]
+    n=np.arange(N)
+    c=np.fft.rfft(F*np.exp(-q*n*dlnr),axis=-1)/(r0**q)/N
+    eta=2.*np.pi*np.arange(c.shape[-1])/(N*dlnr)
+    a=c*mellin_sphericalBesselj(l,q+1j*eta)*np.exp(-1j*eta*np.log(r0*k0))
+    if N%2==0: #nyquist term must be real
+        a[...,-1]=a[...,-1].real
+    kj=k0*np.exp(n*dlnr)
+    return N*np.fft.irfft(np.conj(a),N,axis=-1)*kj**(-q)
+
+#--------------------------------------------------
+#wrapper for fftlog computation for one ell, so multithreading works
+# the log-k grid is oversampled relative to kdata.karray so that the
+#  window is resolved in r, and padded by padlogk decades on either end
+# returns array of I_l(k) for all k in kdata.karray
+def Iintwrapper_fftlog(argtuple):
+    l,kvals,nperlogk,rmin,rmax,cosm,binmap,Nrmin,padlogk,q,epsilon,besselxmincut = argtuple
+    if l==0: return np.zeros(kvals.size) #don't compute monopole
+    kernelfn=lambda r: Ilk_kernel(r,binmap,cosm)[np.newaxis,:]
+    result=Ilk_fftlog_forell(l,kvals,nperlogk,rmin,rmax,kernelfn,Nrmin,padlogk,q,epsilon,besselxmincut)[0,:]
+    return result*Ilk_prefactor(kvals,binmap,cosm)
+
+# same, for several binmaps sharing one fft grid; returns array [Nmap,Nk]
+def Iintwrapper_fftlog_batch(argtuple):
+    l,kvals,nperlogk,rmins,rmaxs,cosm,binmaps,Nrmin,padlogk,q,epsilon,besselxmincut = argtuple
+    if l==0: return np.zeros((len(binmaps),kvals.size)) #don't compute monopole
+    kernelfn=lambda r: Ilk_kernels(r,binmaps,cosm,rmins,rmaxs)
+    result=Ilk_fftlog_forell(l,kvals,nperlogk,rmins.min(),rmaxs.max(),kernelfn,Nrmin,padlogk,q,epsilon,besselxmincut,rmaxs)
+    return result*np.array([Ilk_prefactor(kvals,m,cosm) for m in binmaps])
+
+# fftlog Ilk for one ell and log spaced kvals, no ISW prefactor applied.
+#  kernelfn(r) returns array [Nkernel,Nr]; rmaxs gives the upper edge of
+#  each kernel (for besselxmincut) if they differ from rmax
+def Ilk_fftlog_forell(l,kvals,nperlogk,rmin,rmax,kernelfn,Nrmin,padlogk=2.,q=0.5,epsilon=1.e-10,besselxmincut=True,rmaxs=None):
+    N,oversamp,dlnr,Npad=fftlog_gridsize(kvals,nperlogk,rmin,rmax,Nrmin,padlogk)
+    k0=kvals[0]*np.exp(-Npad*dlnr)
+    r0=np.sqrt(rmin*rmax)*np.exp(-.5*(N-1)*dlnr)
+    rgrid=r0*np.exp(np.arange(N)*dlnr)
+    inwin=(rgrid>=rmin)*(rgrid<=rmax)
+    kern=kernelfn(rgrid[inwin])*rgrid[inwin]
+    F=np.zeros((kern.shape[0],N))
+    F[:,inwin]=kern
+    G=fftlog_besselj(l,F,r0,k0,dlnr,q)
+    result=G[:,Npad:Npad+(kvals.size-1)*oversamp+1:oversamp]
+    if besselxmincut: #quad path returns zero if j_l(kr)<epsilon for all r
+        xmin=findxmin(l,epsilon)
+        if rmaxs is None:
+            rmaxs=rmax*np.ones(result.shape[0])
+        result[np.outer(rmaxs,kvals)<=xmin]=0.
+    return result
+
+# size of the log r grid for Ilk_fftlog_forell: returns N, oversampling of
+#  the k grid, dlnr, and number of padding pts below kvals[0]. N is even
+#  (for the Nyquist term) and has only factors 2,3,5, since FFTs of lengths
+#  with large prime factors are far slower
+def fftlog_gridsize(kvals,nperlogk,rmin,rmax,Nrmin,padlogk=2.):
+    dlnk=np.log(10.)/nperlogk
+    #spacing in lnr needed to resolve the window at its far edge
+    oversamp=int(np.ceil(dlnk/((rmax-rmin)/Nrmin/rmax)))
+    dlnr=dlnk/oversamp
+    Npad=int(np.ceil(padlogk*np.log(10.)/dlnr))
+    N=(kvals.size-1)*oversamp+1+2*Npad
+    #log r range must cover the window, with room for zeros on each side
+    Nwin=int(np.ceil(np.log(rmax/rmin)/dlnr))+1
+    if N<2*Nwin:
+        N=2*Nwin
+    N=2*next_fast_len((N+1)//2)
+    return N,oversamp,dlnr,Npad
+
+#=========================================================================
+# Shell basis for Ilk (see ClRunData.ilkshell_ settings)
+#  Ilk is linear in the window fn, so write the r-dependent kernel as a
+#  piecewise linear fn on evenly spaced nodes r_i: K(r)=sum_i K(r_i)phi_i(r)
+#  with phi_i the hat fn peaked at r_i. Then Ilk=sum_i K(r_i) B_il(k), with
+#  B_il(k)=int phi_i(r) j_l(kr) dr independent of the window. The B's
+#  are computed once per cosmology+kdata and stored with the Ilk files.
+#-------------------------------------------------------------------------
+def ilkshell_file(rundata):
+    if rundata.ilkcachedir:
+        return ''.join([rundata.ilkcachedir,'Ilkshells_',rundata.ilkhash(),'.npz'])
+    if rundata.ilktag: runtag = '.'+rundata.ilktag
+    else: runtag=''
+    return ''.join([rundata.ilkdir,'Ilkshells',runtag,'.npz'])
+
+#-------------------------------------------------------------------------
+# compute and save shell basis, tabulated out to comoving dist of zmax
+def computeIlk_shellbasis(rundata,zmax=0):
+    DOPARALLEL=1
+    if not zmax:
+        zmax=rundata.zmax
+    cosm = rundata.cosm
+    if not cosm.tabZ or cosm.zmax<zmax:
+        cosm.tabulateZdep(zmax,nperz=cosm.nperz)
+    dr=rundata.ilkshell_dr
+    Nint=int(np.ceil(cosm.co_r(zmax)/dr))
+    rnodes=dr*np.arange(Nint+1)
+    kvals = rundata.kdata.karray
+    lvals = ilk_lvals(rundata)
+    print "Computing Ilk shell basis: {0:d} shells out to z={1:g}, DOPARALLEL={2:d}".format(rnodes.size,zmax,DOPARALLEL)
+    argiter=itertools.izip(lvals,itertools.repeat(kvals),itertools.repeat(rnodes),itertools.repeat(rundata.ilkgrid_nperosc),itertools.repeat(rundata.ilkgrid_maxelements),itertools.repeat(rundata.epsilon),itertools.repeat(rundata.besselxmincut))
+    if DOPARALLEL:
+        with rundata.executor:
+            B=np.array(rundata.executor.map(Iintwrapper_shells,argiter)) #[l,k,shell]
+    else:
+        B=np.array([Iintwrapper_shells(argtuple) for argtuple in argiter])
+
+    outfile=ilkshell_file(rundata)
+    print 'Writing Ilk shell basis to ',outfile
+    np.savez(outfile,B=B,lvals=lvals,kvals=kvals,rnodes=rnodes,infostr=np.array(rundata.infostr),cosmkey=np.array(rundata.cosm.paramkey()),bkgdkey=np.array(rundata.bkgdkey),epsilon=rundata.epsilon,besselxmincut=rundata.besselxmincut)
+    rundata.ilkshells=None
+    return getIlk_shellbasis(rundata)
+
+#-------------------------------------------------------------------------
+# load shell basis for this run if there is one whose cosmology, k values,
+#  and bessel settings match rundata. returns None if not.
+def getIlk_shellbasis(rundata):
+    if rundata.ilkshells is not None:
+        return rundata.ilkshells
+    infile=ilkshell_file(rundata)
+    if not os.path.isfile(infile):
+        return None
+    npz=np.load(infile)
+    basis={key:npz[key] for key in npz.files}
+    npz.close()
+    kvals=rundata.kdata.karray
+    #shells only depend on the background, so P(k) settings don't matter
+    if 'cosmkey' not in basis or str(basis['cosmkey'])!=rundata.cosm.paramkey() or str(basis['bkgdkey'])!=rundata.bkgdkey:
+        print " *** Ilk shell basis cosmology doesn't match, not using it."
+        return None
+    if basis['kvals'].size!=kvals.size or not np.allclose(basis['kvals'],kvals,rtol=1.e-8):
+        print " *** Ilk shell basis kvals don't match, not using it."
+        return None
+    if basis['epsilon']!=rundata.epsilon or basis['besselxmincut']!=rundata.besselxmincut:
+        print " *** Ilk shell basis bessel settings don't match, not using it."
+        return None
+    print "Reading Ilk shell basis from",infile
+    rundata.ilkshells=basis
+    return basis
+
+#-------------------------------------------------------------------------
+# if a matching shell basis exists and resolves this binmap's window,
+#  compute Ilk as weighted sum of shells and save it; otherwise returns
+#  empty array
+def computeIlk_fromshells(binmap,rundata):
+    #shell sums have no krcut, so they can't stand in for sharpkcut Ilk
+    if not rundata.useilkshells or rundata.sharpkcut:
+        return np.array([])
+    basis=getIlk_shellbasis(rundata)
+    if basis is None:
+        return np.array([])
+    cosm = rundata.cosm
+    if not cosm.tabZ or cosm.zmax<binmap.zmax:
+        cosm.tabulateZdep(max(rundata.zmax,binmap.zmax),nperz=cosm.nperz)
+    rnodes=basis['rnodes']
+    rmin=cosm.co_r(binmap.zmin)
+    rmax=cosm.co_r(binmap.zmax)
+    if rmax>rnodes[-1]:
+        return np.array([])
+    lvals = ilk_lvals(rundata)
+    lind=[]
+    for l in lvals:
+        where=np.where(basis['lvals']==l)[0]
+        if not where.size:
+            return np.array([])
+        lind.append(where[0])
+
+    #check that kernel is well described by linear interp between nodes
+    inbin=(rnodes>=rmin)*(rnodes<=rmax)
+    weights=np.zeros(rnodes.size)
+    weights[inbin]=Ilk_kernel(rnodes[inbin],binmap,cosm)
+    # the hats at the window's edge nodes reach up to one node spacing
+    # outside it, where the kernel is zero, so check there too
+    dr=rnodes[1]-rnodes[0]
+    rlo=max(rmin-dr,rnodes[0])
+    rhi=min(rmax+dr,rnodes[-1])
+    rfine=np.linspace(rlo,rhi,int(rundata.ilkshell_ncheck*(rhi-rlo)/dr)+2)
+    kfine=np.zeros(rfine.size)
+    inwin=(rfine>=rmin)*(rfine<=rmax)
+    kfine[inwin]=Ilk_kernel(rfine[inwin],binmap,cosm)
+    interperr=np.sum(np.fabs(np.interp(rfine,rnodes,weights)-kfine))/np.sum(np.fabs(kfine))
+    if interperr>rundata.ilkshell_tol:
+        print "  Ilk shell basis doesn't resolve {0:s} (interp err {1:0.2e}), computing directly.".format(binmap.tag,interperr)
+        return np.array([])
+
+    print "Computing Ilk for ",binmap.tag,'from shell basis, interp err {0:0.2e}'.format(interperr)
+    B=basis['B']
+    Ivals=np.array([np.dot(B[i],weights) for i in lind])
+    Ivals*=Ilk_prefactor(rundata.kdata.karray,binmap,cosm)[np.newaxis,:]
+    writeIlk(Ivals,binmap,rundata)
+    return Ivals
+
+#--------------------------------------------------
+# shell basis Ilk for one ell: returns array [Nk,Nshell] of
+#  int phi_i(r) j_l(kr) dr, computed with simpson's rule on a grid
+#  that subdivides each shell evenly, so hat fns are exact on it.
+def Ilk_shells_forell(l,kvals,rnodes,nperosc=20,maxelements=4.e6,epsilon=1.e-10,besselxmincut=True):
+    Nk=kvals.size
+    Nint=rnodes.size-1
+    dr=rnodes[1]-rnodes[0]
+    result=np.zeros((Nk,rnodes.size))
+    if besselxmincut:
+        xmin=findxmin(l,epsilon)
+    else:
+        xmin=0.
+    nsub=lambda kval: 2*max(1,int(np.ceil(.5*nperosc*kval*dr/(2.*np.pi))))
+    kstart=0
+    while kstart<Nk:
+        #shells entirely below xmin/k for all k in block are skipped
+        kend=kstart+1
+        while kend<Nk and (kend+1-kstart)*(nsub(kvals[kend])*(Nint-int(xmin/kvals[kend]/dr))+1)<=maxelements:
+            kend+=1
+        kblock=kvals[kstart:kend]
+        ilo=min(int(xmin/kblock[-1]/dr),Nint)
+        if ilo==Nint:
+            kstart=kend
+            continue
+        m=nsub(kblock[-1]) #grid pts per shell, even for simpson
+        Nr=(Nint-ilo)*m+1
+        rgrid=np.linspace(rnodes[ilo],rnodes[-1],Nr)
+        x=np.outer(kblock,rgrid)
+        A=spherical_jn(l,x)*simpson_weights(Nr,rgrid[1]-rgrid[0])
+        if besselxmincut:
+            A[x<xmin]=0.
+        #position of each grid pt within its shell interval
+        t=(np.arange(Nr)%m)/float(m)
+        t[-1]=1.
+        starts=np.arange(Nint-ilo)*m
+        result[kstart:kend,ilo:-1]+=np.add.reduceat(A*(1.-t),starts,axis=1)
+        result[kstart:kend,ilo+1:]+=np.add.reduceat(A*t,starts,axis=1)
+        kstart=kend
+    return result
+
+#--------------------------------------------------
+#wrapper for shell basis computation for one ell, so multithreading works
+def Iintwrapper_shells(argtuple):
+    l,kvals,rnodes,nperosc,maxelements,epsilon,besselxmincut = argtuple
+    if l==0: return np.zeros((kvals.size,rnodes.size)) #don't compute monopole
+    return Ilk_shells_forell(l,kvals,rnodes,nperosc,maxelements,epsilon,besselxmincut)
+
+#-------------------------------------------------------------------------
+#  by default, Ilkarray is for rundata's kdata and non-limber ell; otherwise
+#  pass the lvals and kvals its rows and columns correspond to
+def writeIlk(Ilkarray,binmap,rundata,lvals=np.array([]),kvals=np.array([])):
+    outfile = ilk_filename(binmap,rundata)
 
     print 'Writing Ilk data to ',outfile
-    k = rundata.kdata.karray
-    lvals = rundata.lvals
-    Nell = sum(l<rundata.limberl for l in lvals) #number below limber switch
+    if kvals.size:
+        k = kvals
+    else:
+        k = rundata.kdata.karray
+    if not lvals.size:
+        lvals=ilk_lvals(rundata)
+    Nell = lvals.size
+    headerstr = '\n'.join([binmap.infostr,rundata.infostr])
+    if rundata.ilkformat=='npy':
+        writeIlk_npy(outfile,Ilkarray[:Nell,:],lvals[:Nell],k,rundata.kdata.nperlogk,rundata.kdata.krcutadd,rundata.kdata.krcutmult,headerstr)
+        return
     krcutstr='{0:13g}.{1:<10g}'.format(rundata.kdata.krcutadd,rundata.kdata.krcutmult)
     if rundata.kdata.krcutadd<0 or rundata.kdata.krcutmult<0:
         krcutstr='{0:23g}'.format(-1.)
     
-    headerstr = '\n'.join([binmap.infostr,rundata.infostr])
     collabels =''.join([' {0:23s} {1:23s}\n{2:s}'.format('k[h/Mpc] (top=krcutadd.mult)','ell=>',krcutstr),''.join([' {0:23d}'.format(lvals[n]) for n in xrange(Nell)]),'\n'])
     bodystr=''.join([\
                          ''.join([' {0:+23.16e}'.format(k[row]),''.join([' {0:+23.16e}'.format(Ilkarray[lind,row]) for lind in xrange(Nell)]),'\n'])\
@@ -409,23 +1383,69 @@ def writeIlk(Ilkarray,binmap,rundata):
     f.write(collabels) #line 7 has row, col labels, line 8 has lvals
     f.write(bodystr)
     f.close()
-    
+
 #-------------------------------------------------------------------------
-# read in file containing Ilk for given map bin, resturn Ilk array,lvals, kvals
-def readIlk_file(binmap,rundata):
-    if binmap.isISW:
-        if rundata.iswilktag: runtag = '.'+rundata.iswilktag
-        else: runtag=''
-    else:
-        if rundata.ilktag: runtag = '.'+rundata.ilktag
-        else: runtag=''
-    
-    infile=''.join([rundata.ilkdir,binmap.tag,'_Ilk',runtag,'.dat'])
-    print "Reading Ilk from file",infile
+# chunks of Ilk saved during computeIlk, in a dir next to the Ilk file.
+#  each holds k values and Ilk for one ell and block of k
+def ilk_chunkdir(binmap,rundata):
+    f=ilk_filename(binmap,rundata)
+    return f[:f.rfind('.')]+'_chunks/'
+
+def ilk_chunkfile(chunkdir,l,kvals):
+    return ''.join([chunkdir,'l{0:d}_k{1:0.6e}_n{2:d}.npy'.format(int(l),kvals[0],kvals.size)])
+
+def writeIlk_chunk(chunkdir,l,kvals,Ivals):
+    if not os.path.isdir(chunkdir):
+        os.makedirs(chunkdir)
+    outfile=ilk_chunkfile(chunkdir,l,kvals)
+    #write to temp file then rename, so a killed run can't leave half a chunk
+    f=open(outfile+'.tmp','wb')
+    np.save(f,np.vstack((kvals,Ivals)))
+    f.close()
+    os.rename(outfile+'.tmp',outfile)
+
+# returns Ilk for chunk if it has been saved, empty array otherwise
+def readIlk_chunk(chunkdir,l,kvals):
+    infile=ilk_chunkfile(chunkdir,l,kvals)
+    if not os.path.isfile(infile):
+        return np.array([])
+    x=np.load(infile)
+    if x.shape!=(2,kvals.size) or not np.allclose(x[0],kvals,rtol=1.e-10):
+        return np.array([])
+    return x[1]
+
+def clear_ilk_chunks(binmap,rundata):
+    chunkdir=ilk_chunkdir(binmap,rundata)
+    if os.path.isdir(chunkdir):
+        shutil.rmtree(chunkdir)
+
+#-------------------------------------------------------------------------
+# binary Ilk format: Ilk[ell,k] in a .npy file, so it can be memory mapped
+#  and read one ell at a time, plus a .json sidecar w ell, k, header info
+def writeIlk_npy(outfile,Ilkarray,lvals,k,nperlogk,krcutadd,krcutmult,headerstr):
+    np.save(outfile,np.ascontiguousarray(Ilkarray,dtype=np.float64))
+    info={'lvals':[int(l) for l in lvals],'k':[float(kval) for kval in k],'nperlogk':int(nperlogk),'krcutadd':krcutadd,'krcutmult':krcutmult,'header':headerstr}
+    f=open(outfile[:-len('.npy')]+'.json','w')
+    json.dump(info,f,indent=1)
+    f.close()
+
+#-------------------------------------------------------------------------
+# read Ilk in either format; returns I[ell,k] (memory mapped for npy),
+#  ell, k, and nperlogk
+def readIlk_npy(infile):
+    f=open(infile[:-len('.npy')]+'.json','r')
+    info=json.load(f)
+    f.close()
+    I=np.load(infile,mmap_mode='r')
+    return I,np.array(info['lvals']),np.array(info['k']),info['nperlogk']
+
+def readIlk_table(infile):
+    if infile.endswith(ilkfile_ext['npy']):
+        return readIlk_npy(infile)
+    return readIlk_text(infile)
+
+def readIlk_text(infile):
     x = np.loadtxt(infile,skiprows=6)
-    inkrcut=x[0,0]
-    inkrcutadd=int(inkrcut)
-    inkrcutmult=int(str(inkrcut)[str(inkrcut).find('.')+1:])
     k=x[1:,0]
     l=x[0,1:].astype(int)
     I=np.transpose(x[1:,1:])
@@ -438,17 +1458,21 @@ def readIlk_file(binmap,rundata):
     f.close()
     kstr=kstr[kstr.find('kperlog=')+len('kperlog='):]#cut just before nperlogk
     innperlogk=int(kstr[:kstr.find(',')])
+    return I,l,k,innperlogk
+
+#-------------------------------------------------------------------------
+# read in file containing Ilk for given map bin, resturn Ilk array,lvals, kvals
+def readIlk_file(binmap,rundata):
+    infile=existing_ilk_file(binmap,rundata)
+    print "Reading Ilk from file",infile
+    I,l,k,innperlogk=readIlk_table(infile)
     inkmin=k[0]
     inkmax=k[-1]
 
     #return ivals if nperlogk and l values match up, otherwise return empty array
     #should have all ell in lvals where ell<limberl, assume ascending order
-    limberl=rundata.limberl
-    if limberl>=0 and limberl<=rundata.lmax:
-        # these are the expected ell values we want out
-        checkell=rundata.lvals[:np.where(rundata.lvals<limberl)[0][-1]+1]
-    else:
-        checkell=rundata.lvals
+    # these are the expected ell values we want out
+    checkell=ilk_lvals(rundata)
     if l.size>=checkell.size:
         lind_incheck=[] #index of each checkell element in l
         for lval in checkell:
@@ -460,7 +1484,7 @@ def readIlk_file(binmap,rundata):
                 return np.array([]),np.array([])
         lind_incheck=np.array(lind_incheck)
         if innperlogk>= rundata.kdata.nperlogk and inkmin<=rundata.kdata.kmin and inkmax>=rundata.kdata.kmax:
-            return I[lind_incheck,:],k #k_forI can be different than kdata, as long as it samples enough
+            return np.array(I[lind_incheck,:]),k #k_forI can be different than kdata, as long as it samples enough
         else:
             print " *** unexpected kvals, recompute."
             return np.array([]),np.array([])
@@ -469,6 +1493,29 @@ def readIlk_file(binmap,rundata):
         print " *** unexpected number of lvals, recompute."
         return np.array([]),np.array([])
 
+#-------------------------------------------------------------------------
+# convert text Ilk file to binary npy+json format, return new filename
+def convertIlk_text_to_npy(infile,removetext=False):
+    I,l,k,innperlogk=readIlk_text(infile)
+    f=open(infile,'r')
+    headerstr=''.join([f.readline() for n in xrange(5)]).rstrip('\n')
+    f.close()
+    #krcut from kdata header line, 'krcut(add,mult)=(add,mult);'
+    kstr=headerstr[headerstr.find('krcut(add,mult)=(')+len('krcut(add,mult)=('):]
+    inkrcutadd,inkrcutmult=[float(x) for x in kstr[:kstr.find(')')].split(',')]
+    outfile=infile[:infile.rfind('.')]+ilkfile_ext['npy']
+    print 'Converting',infile,'to',outfile
+    writeIlk_npy(outfile,I,l,k,innperlogk,inkrcutadd,inkrcutmult,headerstr)
+    if removetext:
+        os.remove(infile)
+    return outfile
+
+# convert all text Ilk files in a directory (eg ilkdir or ilkcachedir)
+def convertIlk_dir(indir,removetext=False):
+    if indir[-1]!='/': indir+='/'
+    infiles=[indir+f for f in sorted(os.listdir(indir)) if f.endswith('.dat') and ('_Ilk' in f or f.startswith('Ilk_'))]
+    return [convertIlk_text_to_npy(f,removetext) for f in infiles]
+
 ###########################################################################
 # functions for computing, tabulating,and using cross corr functions
 ###########################################################################
@@ -526,46 +1573,29 @@ def getCl(binmaplist,rundata,dopairs=[],redoAllCl=False,redoTheseCl=False,redoAu
         nbarlist=[m.nbar for m in binmaplist]
         cldat=ClData(rundata,taglist,dopairs=dopairs,addauto=True,nbarlist=nbarlist)
         Nmap=cldat.Nmap
-        dopairs=cldat.pairs
-        tagdict = cldat.tagdict
         crosspairs=cldat.crosspairs
-        crossinds=cldat.crossinds
-        Ncross = cldat.Ncross
-        docross=cldat.docross #list of pair indices want to compute
-        
-        #old = follow indices for maplist in prev existing file
-        oldind=-1*np.ones(Nmap) #for each binmap, its index in oldbinmaplist
+        domask=cldat.domask #True for pairs want to compute
         
-        #get set up to navigate existing (old) Cl data
-        oldxinds=oldcl.crossinds
-        olddox=oldcl.docross #index of (in oldtag basis) cross corrs to do
-
-        #get indices of tags existing in oldbintags
+        #for each map, its index in old file's map list, -1 if not there
         oldind=translate_tag_inds(cldat,oldcl)
-        for t in xrange(Nmap): #add autocorr for any maps not in oldtags
-            if oldind[t]<0 and not redoAutoCl:
-                docross.append(crossinds[t,t])
-
-        newdocross = docross[:]
-        crossfromold = []#crossinds of x corrs previously computed
+        inold=oldind>=0
+        if not redoAutoCl: #add autocorr for any maps not in oldtags
+            domask[cldat.crossinds[np.logical_not(inold),np.logical_not(inold)]]=True
+
+        #pairs with both maps in old file, and crossind there
+        i0=crosspairs[:,0]
+        i1=crosspairs[:,1]
+        bothold=inold[i0]*inold[i1]
+        oldx=oldcl.crossinds[oldind[i0],oldind[i1]] #junk where not bothold
+        fromold=np.zeros(cldat.Ncross,dtype=bool) #x corrs previously computed
         if not (redoTheseCl or redoAutoCl):
             print "  Checking for previously computed C_l values."
-            #Remove from newdocross for pairs already computed
-            for t in xrange(Nmap):
-                if oldind[t]>=0: #tag in oldtags
-                    #check which desired pairs are already computed
-                    for t2 in xrange(t,Nmap): #loop through possible pairs
-                        #if pair not in dopairs, don't compute
-                        if crossinds[t,t2] not in newdocross:
-                            continue
-                        #otherwise, check if second tag in oldtags
-                        #if pair in olddo, already computed; don't need it
-                        elif (oldind[t2]>=0) and (oldxinds[oldind[t],oldind[t2]] in olddox):
-                            newdocross.remove(crossinds[t,t2])
-                            crossfromold.append(crossinds[t,t2])
+            #pairs already computed don't need new values
+            fromold=domask*bothold*oldcl.domask[oldx]
         else:
             print "  Will compute C_l for all requested pairs."
             ANYNEW=True
+        newdocross=[int(n) for n in np.where(domask*np.logical_not(fromold))[0]]
 
         #need new values if entries in newdocross, otherwise returns zero array
         if not DoNotOverwrite:
@@ -580,13 +1610,15 @@ def getCl(binmaplist,rundata,dopairs=[],redoAllCl=False,redoTheseCl=False,redoAu
         
         if np.any(newcl.cl!=0):
             ANYNEW=True
+        #pairs computeCl skipped for small window overlap stay uncomputed
+        if newdocross and not DoNotOverwrite:
+            skipped=np.zeros(cldat.Ncross,dtype=bool)
+            skipped[newdocross]=True
+            domask[skipped*np.logical_not(newcl.domask)]=False
         #Clvals = Clgrid to return, all asked for in this call
         Clvals = np.copy(newcl.cl)
-        for n in crossfromold: #get the prev computed values from oldcl
-            i0 = crosspairs[n,0]
-            i1 = crosspairs[n,1]
-            oldn = oldxinds[oldind[i0],oldind[i1]]
-            Clvals[n,:] = oldcl.cl[oldn,:]
+        #get the prev computed values from oldcl
+        Clvals[fromold,:] = oldcl.cl[oldx[fromold],:]
         #put Clvals data into the relevant ClData instance
         cldat.cl=Clvals
             
@@ -607,7 +1639,18 @@ def getCl(binmaplist,rundata,dopairs=[],redoAllCl=False,redoTheseCl=False,redoAu
 #     if redoIlk, recomputes even if files exist
 #     if addauto and no crossinds given,
 #           compute autocorrelations even if not in dopairs
-def computeCl(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=False):
+# lswitch: with rundata.limberauto, per-pair ells [Ncross] to switch to Limber
+#  at, from limber_switch; found here if not given
+# the run's workers are kept for every stage, including nested computeCl
+#  calls from computeCl_sparse and limber_switch, and closed at the end
+def computeCl(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=False,lswitch=None):
+    with rundata.executor:
+        try:
+            return computeCl_stages(binmaps,rundata,dopairs,docrossind,redoIlk,addauto,lswitch)
+        finally:
+            rundata.executor.release('Plnk',*[binmap_refname(m) for m in binmaps])
+
+def computeCl_stages(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=False,lswitch=None):
     bintags=[m.tag for m in binmaps]
     nbars=[m.nbar for m in binmaps] #will be -1 for e.g. ISW
 
@@ -621,6 +1664,16 @@ def computeCl(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=Fal
     Ncross=cldat.Ncross
     tagdict=cldat.tagdict
     docross=cldat.docross
+
+    #leave out pairs of maps whose windows barely overlap; they aren't in
+    # docross, so the C_l file lists them as not computed
+    if rundata.cloverlap_tol>0 and len(docross):
+        overlap=window_overlaps(binmaps,rundata.limbergrid_nperz,rundata.limbergrid_nperedge,rundata.limbergrid_nedge)
+        pruned=cldat.domask*(crosspairs[:,0]!=crosspairs[:,1])*(overlap[crosspairs[:,0],crosspairs[:,1]]<rundata.cloverlap_tol)
+        if np.any(pruned):
+            print "  Skipping {0:d} pairs with window overlap below {1:g}".format(np.sum(pruned),rundata.cloverlap_tol)
+            cldat.domask[pruned]=False
+            docross=cldat.docross
     
     #print 'in computeCl, dopairs',dopairs
     #if we're not computing anything, just return array ofzeros
@@ -631,26 +1684,31 @@ def computeCl(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=Fal
         cldat.cl=Clvals
         return cldat
     
+    if rundata.clsparse:
+        cldat.cl=computeCl_sparse(binmaps,rundata,docross,redoIlk)
+        return cldat
+
     print "  Computing new C_l values."    
 
     # First sort out when to switch to limber approx
-    limberl=rundata.limberl #where to switch to Limber
-    print "limberl=",limberl
-    if limberl>0 and limberl<=rundata.lmax:
-        lvals_preLim=rundata.lvals[:np.where(rundata.lvals<limberl)[0][-1]+1]
-        Nell_preLim=lvals_preLim.size
-        lvals_postLim=rundata.lvals[np.where(rundata.lvals<limberl)[0][-1]+1:]
-        Nell_postLim=Nell-Nell_preLim
-    elif limberl==0:
-        lvals_preLim=np.array([])
-        Nell_preLim=0
-        lvals_postLim=rundata.lvals
-        Nell_postLim=Nell
+    # Nlpre[xind] is the number of lvals (ascending) pair xind has computed
+    #  without it; the same for all pairs unless rundata.limberauto
+    if rundata.limberauto:
+        if lswitch is None:
+            lswitch=limber_switch(binmaps,rundata,docross,redoIlk)
+        Nlpre=np.searchsorted(rundata.lvals,lswitch)
     else:
-        lvals_preLim=rundata.lvals
-        lvals_postLim=np.array([])
-        Nell_preLim=Nell
-        Nell_postLim=0
+        limberl=rundata.limberl #where to switch to Limber
+        print "limberl=",limberl
+        if limberl>=0 and limberl<=rundata.lmax:
+            Nlpre=np.full(Ncross,np.sum(rundata.lvals<limberl),dtype=int)
+        else:
+            Nlpre=np.full(Ncross,Nell,dtype=int)
+    Nell_preLim=int(Nlpre[docross].max()) #all ells any pair needs exactly
+    Nell_Lim0=int(Nlpre[docross].min()) #first ell any pair uses Limber for
+    lvals_preLim=rundata.lvals[:Nell_preLim]
+    lvals_postLim=rundata.lvals[Nell_Lim0:]
+    Nell_postLim=Nell-Nell_Lim0
 
     #print 'preLim lvals:',lvals_preLim
     #print 'Nell_preLim',Nell_preLim
@@ -664,86 +1722,256 @@ def computeCl(binmaps,rundata,dopairs=[],docrossind=[],redoIlk=False,addauto=Fal
         # For Pk, just use camb's default adaptive nperlogk spacing 
         print 'getting CAMB P(k), kmin,kmax=',kdata.kmin,kdata.kmax
         cosm.getPk(kdata.kmin,kdata.kmax)#kperln=kdata.nperlogk*np.log(10))
+    #set up P(k) in terms of lnk
+    Plnk = interp1d(np.log(cosm.k_forPower),cosm.P_forPower,bounds_error=False,fill_value=0.)
+    
+    #tabulate z-dep fns for all maps, and give the executor everything its
+    # workers will need up front, so all the stages below share them
+    zmax=max([m.zmax for m in binmaps]+[rundata.zmax])
+    if not cosm.tabZ or cosm.zmax<zmax:
+        cosm.tabulateZdep(zmax,nperz=cosm.nperz)
+    cosm_ref(rundata)
+    binmaprefs=[binmap_ref(rundata,m) for m in binmaps]
+    #Plnk is rebuilt each call; its state is what it's built from, so a
+    # new one with the same P(k) doesn't restart workers
+    Plnkref=rundata.executor.ref(Plnk,'Plnk',(cosm.k_forPower[0],cosm.k_forPower[-1],cosm.k_forPower.size,cosm.P_forPower.sum()))
 
     if Nell_preLim:
         #get Ilk functions
         print "  Getting Ilk transfer functions.."
-        Igrid=[]#map,ell,k; ell indices only for ell<limberl 
-        kforIgrid=[]#map,k
-        #np.zeros((Nmap,Nell_preLim,rundata.kdata.karray.size))
-        for m in xrange(Nmap):
-            Igridbit,k_forI=getIlk_for_binmap(binmaps[m],rundata,redoIlk)
-            Igrid.append(Igridbit)
-            kforIgrid.append(k_forI)
-        Igrid=np.array(Igrid)
-        kforIgrid = np.array(kforIgrid)
-        lnkforIgrid = np.log(kforIgrid)
-
-        #set up P(k) in terms of lnk
-        Plnk = interp1d(np.log(cosm.k_forPower),cosm.P_forPower,bounds_error=False,fill_value=0.)
+        #Igrid: map,ell,k; ell indices only for ell<limberl. kforIgrid: map,k
+        #  maps' k arrays can differ if stored Ilk tables were extended
+        if rundata.limberauto:
+            #each map only needs ells its pairs in docross compute exactly
+            Nlmap=np.zeros(Nmap,dtype=int)
+            np.maximum.at(Nlmap,crosspairs[docross,0],Nlpre[docross])
+            np.maximum.at(Nlmap,crosspairs[docross,1],Nlpre[docross])
+            Igrid,kforIgrid=getIlk_for_nell(binmaps,rundata,Nlmap,Nell_preLim,redoIlk)
+        else:
+            Igrid,kforIgrid=getIlk_for_binmaplist(binmaps,rundata,redoIlk)
+
         lnkmin=np.log(kdata.kmin)
         lnkmax=np.log(kdata.kmax)
   
-        #Do Cl computations, interating through crosspairs and lvals
-        print "  Performing non-Limber C_l integrals."
-        nl= itertools.product(xrange(Ncross),xrange(Nell_preLim)) #items=[n,lind]
-        Ipair_fornl=[(Igrid[crosspairs[xind,0],lind,:],Igrid[crosspairs[xind,1],lind,:]) for (xind,lind) in itertools.product(xrange(Ncross),xrange(Nell_preLim))]
-        lnkforIpair=[(lnkforIgrid[crosspairs[xind,0],:],lnkforIgrid[crosspairs[xind,1],:]) for (xind,lind) in itertools.product(xrange(Ncross),xrange(Nell_preLim))]
-        indocross=[xind in docross for (xind,lind) in itertools.product(xrange(Ncross),xrange(Nell_preLim))]
+        if rundata.clmethod=='grid':
+            print "  Performing non-Limber C_l sums on ln k grid."
+            Clvals[:,:Nell_preLim]=Cl_grid(Igrid,kforIgrid,Plnk,kdata.karray,crosspairs,docross,rundata.epsilon,rundata.clgrid_nsub)
+        else:
+            #Do Cl computations, interating through crosspairs and lvals
+            print "  Performing non-Limber C_l integrals."
+            #only pairs in docross get tasks, for ells before their switch
+            nl=[(xind,lind) for xind in docross for lind in xrange(Nlpre[xind])]
+            #Ilk go to workers once, through memory mapped files; each
+            # task just gets the map indices for its pair
+            sharedIlk=writeIlk_shared(Igrid,kforIgrid,rundata)
+            mapinds_fornl=[(crosspairs[xind,0],crosspairs[xind,1]) for (xind,lind) in nl]
     
-        #put everything into a tuple for the integral wrapper
-        argiter = itertools.izip(nl,indocross,itertools.repeat(lnkmin),itertools.repeat(lnkmax),itertools.repeat(Plnk),Ipair_fornl,lnkforIpair,itertools.repeat(rundata.kintlim),itertools.repeat(rundata.epsilon)) #for quad
+            #put everything into a tuple for the integral wrapper
+            argiter = itertools.izip(nl,itertools.repeat(True),itertools.repeat(lnkmin),itertools.repeat(lnkmax),itertools.repeat(Plnkref),itertools.repeat(sharedIlk),mapinds_fornl,itertools.repeat(rundata.kintlim),itertools.repeat(rundata.epsilon)) #for quad
     
-        pool = Pool()
-        results=pool.map_async(Clintwrapper,argiter)
-        newCl=np.array(results.get())
-        pool.close()
-        pool.join()
-
-        #rearrange into [n,l] shape
-        Clvals[:,:Nell_preLim]=newCl.reshape(Ncross,Nell_preLim)
+            #tasks all cost ~same
+            arglist=list(argiter)
+            costs=[1.]*len(arglist)
+            newCl=np.zeros(len(arglist))
+            tasktimes=np.zeros(len(arglist))
+            try:
+                for t,result,dt in run_scheduled(Clintwrapper_shared,arglist,costs,executor=rundata.executor):
+                    newCl[t]=result
+                    tasktimes[t]=dt
+            finally:
+                clearIlk_shared(sharedIlk)
+            if rundata.logtasktimes:
+                labels=['{0:s}-{1:s} l={2:d}'.format(bintags[crosspairs[a[0][0],0]],bintags[crosspairs[a[0][0],1]],lvals_preLim[a[0][1]]) for a in arglist]
+                log_tasktimes(rundata.cldir+'tasktimes_Cl.dat',labels,costs,tasktimes)
+
+            #put into [n,l] shape
+            for t,(xind,lind) in enumerate(nl):
+                Clvals[xind,lind]=newCl[t]
 
     # Do Limber approx calculations 
     if Nell_postLim:
         print "  Performing Limber approx C_l integrals."
-        #make sure z-dep functions have been tabulated
-        #print [m.zmax for m in binmaps]
-        zmax=max([m.zmax for m in binmaps])
-        if not cosm.tabZ or cosm.zmax<zmax:
-            cosm.tabulateZdep(zmax,nperz=cosm.nperz)
-
-        nl= itertools.product(xrange(Ncross),lvals_postLim) #items=[n,lvals]
-        mappair=[(binmaps[crosspairs[xind,0]],binmaps[crosspairs[xind,1]]) for (xind,lind) in itertools.product(xrange(Ncross),xrange(Nell_postLim))]
+        if rundata.limbermethod=='grid':
+            Climber=LimberCl_grid(binmaps,lvals_postLim,cosm,crosspairs,docross,rundata.limbergrid_nperz,rundata.limbergrid_nperedge,rundata.limbergrid_nedge,rundata.ilkgrid_maxelements)
+            uselimber=np.arange(Nell_Lim0,Nell)>=Nlpre[:,np.newaxis]
+            Clvals[:,Nell_Lim0:][uselimber]=Climber[uselimber]
+        else:
+            #only pairs in docross whose windows meet get tasks; Limber C_l
+            # for the rest are zero
+            limbercross=[xind for xind in docross if windows_meet(binmaps[crosspairs[xind,0]],binmaps[crosspairs[xind,1]])]
+            nl=[(xind,lval) for xind in limbercross for lval in rundata.lvals[Nlpre[xind]:]] #items=[n,lvals]
+            mappair=[(binmaprefs[crosspairs[xind,0]],binmaprefs[crosspairs[xind,1]]) for (xind,lval) in nl]
         
-        indocross=[xind in docross for (xind,lind) in itertools.product(xrange(Ncross),xrange(Nell_postLim))]
-        #put everything into a tuple for the integral wrapper
-        argiter = itertools.izip(nl,indocross,mappair,itertools.repeat(cosm),itertools.repeat(rundata.zintlim),itertools.repeat(rundata.epsilon)) #for quad
-        #run computations in parallel
-        DOPARALLEL=1
-        if DOPARALLEL:
-            print "  Running Limber approx integrals in parallel."
-            pool=Pool()
-            results=pool.map_async(LimberCl_intwrapper,argiter)
-            limberCl=np.array(results.get())
-            pool.close()
-            pool.join()
-            Clvals[:,Nell_preLim:]=limberCl.reshape(Ncross,Nell_postLim)
-        else: #the nonparallel version is for testing that things run
-            argiter=list(argiter)
-            print "  Running Limber approx integrals (not in parallel)."
-            for i in xrange(len(argiter)):
-                argtuple=argiter[i]
-                nl,indocross,mappair,cosm,zintlim,epsilon=argtuple
-                n,lval=nl
-                lind=np.where(rundata.lvals==lval)[0][0]
-                thiscl=LimberCl_intwrapper(argtuple)
-                print 'n,lval',n,lval,thiscl*lval*(1+lval)/(2*np.pi)
-                Clvals[n,lind]=thiscl
+            #put everything into a tuple for the integral wrapper
+            argiter = itertools.izip(nl,itertools.repeat(True),mappair,itertools.repeat(cosm_ref(rundata)),itertools.repeat(rundata.zintlim),itertools.repeat(rundata.epsilon)) #for quad
+            #run computations in parallel
+            DOPARALLEL=1
+            if DOPARALLEL:
+                print "  Running Limber approx integrals in parallel."
+                arglist=list(argiter)
+                costs=[1.]*len(arglist)
+                for t,result,dt in run_scheduled(LimberCl_intwrapper,arglist,costs,executor=rundata.executor):
+                    xind,lval=nl[t]
+                    Clvals[xind,np.where(rundata.lvals==lval)[0][0]]=result
+            else: #the nonparallel version is for testing that things run
+                argiter=list(argiter)
+                print "  Running Limber approx integrals (not in parallel)."
+                rundata.executor.publish()
+                for i in xrange(len(argiter)):
+                    argtuple=resolve_context(argiter[i])
+                    nl,indocross,mappair,cosm,zintlim,epsilon=argtuple
+                    n,lval=nl
+                    lind=np.where(rundata.lvals==lval)[0][0]
+                    thiscl=LimberCl_intwrapper(argtuple)
+                    print 'n,lval',n,lval,thiscl*lval*(1+lval)/(2*np.pi)
+                    Clvals[n,lind]=thiscl
 
     cldat.cl=Clvals
                     
     return cldat#Clvals
 
+#------------------------------------------------------------------------
+# C_l at all of rundata.lvals from exact C_l at a sparse set of them
+#  (rundata.clsparse). Computes all ells up to clsparse_ldense, then ells
+#  clsparse_dlnl apart in ln(ell). Then, the midpoint of each interval
+#  is computed and compared to the spline through the others; intervals
+#  where any pair in docross is off by more than clsparse_tol, relative to
+#  sqrt(C_l^ii C_l^jj), are bisected and checked again. Other ells are
+#  filled in from the spline through everything computed.
+#  returns array [Ncross,Nell]; pairs not in docross are 0
+def computeCl_sparse(binmaps,rundata,docross,redoIlk=False):
+    lvals=rundata.lvals
+    Ncross=len(binmaps)*(len(binmaps)+1)/2
+    crosspairs,crossinds=get_index_pairs(len(binmaps))
+    #each stage computes exact C_l for a subset of lvals
+    subrundat=copy.copy(rundata)
+    subrundat.clsparse=False
+    lswitch=None
+    if rundata.limberauto: #same switch for every subset
+        lswitch=limber_switch(binmaps,rundata,docross,redoIlk)
+    def exactCl(linds):
+        subrundat.lvals=lvals[linds]
+        subrundat.lmax=subrundat.lvals[-1]
+        return computeCl(binmaps,subrundat,docrossind=docross,redoIlk=redoIlk,lswitch=lswitch).cl
+        
+    computed=sparse_lind(lvals,rundata.clsparse_ldense,rundata.clsparse_dlnl)
+    Clvals=np.zeros((Ncross,lvals.size))
+    print "  Computing C_l for {0:d} of {1:d} ells".format(computed.size,lvals.size)
+    Clvals[:,computed]=exactCl(computed)
+    #intervals [index in lvals of start, end] to check
+    checkint=[(a,b) for a,b in itertools.izip(computed[:-1],computed[1:]) if b-a>1]
+    while checkint:
+        mids=np.array([(a+b)/2 for a,b in checkint])
+        print "  Checking C_l interpolation at {0:d} ells".format(mids.size)
+        Clvals[:,mids]=exactCl(mids)
+        interpCl=interp_sparseCl(Clvals[:,computed],lvals[computed],lvals[mids])
+        err=np.fabs(interpCl-Clvals[:,mids])/sparseCl_norm(Clvals[:,mids],crosspairs,crossinds)
+        err=err[docross,:].max(axis=0)
+        computed=np.union1d(computed,mids)
+        newint=[]
+        for n in xrange(mids.size):
+            if err[n]>rundata.clsparse_tol:
+                a,b=checkint[n]
+                newint+=[(i0,i1) for i0,i1 in ((a,mids[n]),(mids[n],b)) if i1-i0>1]
+        checkint=newint
+    print "  C_l computed exactly for {0:d} of {1:d} ells".format(computed.size,lvals.size)
+    fillin=np.setdiff1d(np.arange(lvals.size),computed)
+    if fillin.size:
+        Clvals[:,fillin]=interp_sparseCl(Clvals[:,computed],lvals[computed],lvals[fillin])
+    Clvals[np.setdiff1d(np.arange(Ncross),docross),:]=0.
+    return Clvals
+
+# indices of lvals to start with for computeCl_sparse: all with
+#  ell<=ldense, then the next ell at least dlnl further in ln(ell), and
+#  the last
+def sparse_lind(lvals,ldense,dlnl):
+    lind=list(np.where(lvals<=ldense)[0])
+    if not lind:
+        lind=[0]
+    lnl=np.log(np.maximum(lvals,1))
+    for i in xrange(lind[-1]+1,lvals.size):
+        if lnl[i]-lnl[lind[-1]]>=dlnl or i==lvals.size-1:
+            lind.append(i)
+    return np.array(lind)
+
+# interpolate C_l [Ncross,Nsparse] at ells lsparse to ells lout, with a
+#  cubic spline of l(l+1)C_l in ln(ell); only ell>=1 are used
+def interp_sparseCl(Clsparse,lsparse,lout):
+    use=lsparse>=1
+    lnl=np.log(lsparse[use])
+    Dl=Clsparse[:,use]*(lsparse[use]*(lsparse[use]+1.))
+    spline=CubicSpline(lnl,Dl,axis=1)
+    lout=np.asarray(lout,dtype=float)
+    return spline(np.log(np.maximum(lout,1.)))/(lout*(lout+1.))
+
+# scale for C_l^ij errors: sqrt(|C_l^ii C_l^jj|), or |C_l^ij| where autos
+#  aren't there, or 1 if that's zero too
+def sparseCl_norm(Cl,crosspairs,crossinds):
+    Nmap=crossinds.shape[0]
+    auto=np.fabs(Cl[crossinds[np.arange(Nmap),np.arange(Nmap)],:])
+    norm=np.sqrt(auto[crosspairs[:,0]]*auto[crosspairs[:,1]])
+    norm[norm==0]=np.fabs(Cl[norm==0])
+    norm[norm==0]=1.
+    return norm
+
+#------------------------------------------------------------------------
+# ell where each pair of maps should switch to the Limber approx
+#  (rundata.limberauto). Exact and Limber C_l are computed for all pairs in
+#  docross at the ells in rundata.limberauto_lprobe (up to lmax). Limber's
+#  relative error, measured against sqrt(C_l^ii C_l^jj), falls off as
+#  A/(l+1/2)^2 at leading order; A is taken as the largest err*(l+1/2)^2 at
+#  the probes, so the switch is at (l+1/2)^2=A/limberauto_tol. A carries
+#  the dependence on the pair's window widths and redshifts. Below the
+#  lowest probe that falloff isn't tested (e.g. pairs of distant bins,
+#  whose Limber C_l is ~0), so ells there are always exact.
+#  returns array [Ncross] of ells; pairs not in docross get 0
+def limber_switch(binmaps,rundata,docross,redoIlk=False):
+    crosspairs,crossinds=get_index_pairs(len(binmaps))
+    lswitch=np.zeros(crosspairs.shape[0])
+    lprobe=np.array([l for l in rundata.limberauto_lprobe if l<=rundata.lmax],dtype=int)
+    if not lprobe.size: #no probes in range, all exact
+        lswitch[docross]=rundata.lmax+1
+        return lswitch
+    print "  Finding Limber switch for each pair, probing ells",lprobe
+    proberundat=copy.copy(rundata)
+    proberundat.lvals=lprobe
+    proberundat.lmax=lprobe[-1]
+    proberundat.limberauto=False
+    proberundat.clsparse=False
+    proberundat.limberl=-1
+    exactCl=computeCl(binmaps,proberundat,docrossind=docross,redoIlk=redoIlk).cl
+    proberundat.limberl=0
+    limberCl=computeCl(binmaps,proberundat,docrossind=docross).cl
+    nu=lprobe+.5
+    err=np.fabs(limberCl-exactCl)/sparseCl_norm(exactCl,crosspairs,crossinds)
+    A=np.max(err*nu**2,axis=1)
+    lswitch[docross]=np.maximum(np.sqrt(A[docross]/rundata.limberauto_tol)-.5,lprobe[0])
+    print "  Limber switch ells range from {0:0.0f} to {1:0.0f}".format(lswitch[docross].min(),lswitch[docross].max())
+    return lswitch
+
+#------------------------------------------------------------------------
+# Ilk for binmaps at the first Nlmap[m] of rundata.lvals, as lists of
+#  [Nell,Nk] arrays and their k; rows past Nlmap[m] are zero. Maps that
+#  need the same ells are fetched together through getIlk_for_binmaplist
+def getIlk_for_nell(binmaps,rundata,Nlmap,Nell,redo=False):
+    Igrid=[np.zeros((Nell,rundata.kdata.karray.size))]*len(binmaps)
+    kforIgrid=[rundata.kdata.karray]*len(binmaps)
+    for n in np.unique(Nlmap):
+        if not n:
+            continue
+        inds=np.where(Nlmap==n)[0]
+        subrundat=copy.copy(rundata)
+        subrundat.lvals=rundata.lvals[:n]
+        subrundat.lmax=subrundat.lvals[-1]
+        subrundat.limberl=-1
+        subrundat.limberauto=False
+        Ilist,klist=getIlk_for_binmaplist([binmaps[i] for i in inds],subrundat,redo)
+        for i,Ilk,k in itertools.izip(inds,Ilist,klist):
+            Igrid[i]=np.zeros((Nell,Ilk.shape[1]))
+            Igrid[i][:n,:]=Ilk
+            kforIgrid[i]=k
+    return Igrid,kforIgrid
+
 #------------------------------------------------------------------------
 def Clintwrapper(argtuple):
     #nl,bool dothiscross,lnkmin,lnkmax,Pk_array,Igrid,kintlim =argtuple
@@ -803,6 +2031,89 @@ def Clintwrapper(argtuple):
 
     return clval*2./np.pi
 
+#------------------------------------------------------------------------
+# non-Limber C_l for all pairs and ells at once (rundata.clmethod='grid').
+#  Ilk for all maps share one ln k grid, so they're cubic interpolated as
+#  in Clintwrapper, but all at once, onto a grid nsub times finer. Then
+#  C_l^ij = 2/pi sum_k w_k k^3 P(k) I_il(k) I_jl(k), with simpson weights
+#  w_k, is one matrix product per ell. The fine grid matters for pairs
+#  of distant bins, where Ilk oscillate faster than the ln k spacing.
+#  As in Clintwrapper, each I_l(k) is zero outside the k range where it's
+#  above epsilon. returns array [Ncross,Nell]; pairs not in docross are 0
+def Cl_grid(Igrid,kforIgrid,Plnkfunc,karray,crosspairs,docross,epsilon,nsub=4):
+    lnk=np.log(karray)
+    Nk=lnk.size
+    Nmap=len(Igrid)
+    Nell=Igrid[0].shape[0]
+    I=np.zeros((Nell,Nmap,Nk))
+    for m in xrange(Nmap):
+        if kforIgrid[m].size==Nk and np.allclose(kforIgrid[m],karray):
+            I[:,m,:]=Igrid[m]
+        else: #e.g. extended Ilk table covering a different k range
+            for lind in xrange(Nell):
+                I[lind,m,:]=np.interp(lnk,np.log(kforIgrid[m]),Igrid[m][lind,:],left=0.,right=0.)
+    above=I>epsilon
+    first=np.argmax(above,axis=-1)
+    last=Nk-1-np.argmax(above[:,:,::-1],axis=-1)
+    Nfine=(Nk-1)*nsub+1
+    lnkfine=np.linspace(lnk[0],lnk[-1],Nfine)
+    Ifine=interp1d(lnk,I,kind='cubic',axis=-1)(lnkfine)
+    kind=np.arange(Nfine)
+    keep=(kind>=nsub*first[:,:,np.newaxis])*(kind<=nsub*last[:,:,np.newaxis])*(first<last)[:,:,np.newaxis]
+    Ifine*=keep
+    w=simpson_weights(Nfine,lnkfine[1]-lnkfine[0])*np.exp(3.*lnkfine)*Plnkfunc(lnkfine)
+    Clmat=np.matmul(Ifine*w,Ifine.transpose(0,2,1)) #[ell,map,map]
+    Clvals=np.zeros((crosspairs.shape[0],Nell))
+    docross=np.asarray(docross,dtype=int)
+    if docross.size:
+        Clvals[docross,:]=Clmat[:,crosspairs[docross,0],crosspairs[docross,1]].T
+    return Clvals*2./np.pi
+
+#------------------------------------------------------------------------
+# Ilk shared with C_l workers: Igrid and the ln k for each map are saved
+#  once as .npy files in cldir, which workers memory map, so tasks only
+#  carry indices. Maps whose k arrays are shorter are padded with zero Ilk
+#  (outside the range Clintwrapper integrates over). returns file prefix
+def writeIlk_shared(Igrid,kforIgrid,rundata):
+    Nmap=len(Igrid)
+    Nk=max([k.size for k in kforIgrid])
+    I=np.zeros((Nmap,Igrid[0].shape[0],Nk))
+    lnk=np.zeros((Nmap,Nk))
+    for m in xrange(Nmap):
+        Nkm=kforIgrid[m].size
+        I[m,:,:Nkm]=Igrid[m]
+        lnk[m,:Nkm]=np.log(kforIgrid[m])
+        dlnk=lnk[m,Nkm-1]-lnk[m,Nkm-2]
+        lnk[m,Nkm:]=lnk[m,Nkm-1]+dlnk*np.arange(1,Nk-Nkm+1)
+    prefix=''.join([rundata.cldir,'Ilk_shared_',str(os.getpid()),'_',str(id(I))])
+    np.save(prefix+'_I.npy',I)
+    np.save(prefix+'_lnk.npy',lnk)
+    return prefix
+
+_Ilk_shared={} #prefix:(I,lnk) memory maps open in this process
+def readIlk_shared(prefix):
+    if prefix not in _Ilk_shared:
+        _Ilk_shared.clear() #only keep the current one open
+        _Ilk_shared[prefix]=(np.load(prefix+'_I.npy',mmap_mode='r'),np.load(prefix+'_lnk.npy',mmap_mode='r'))
+    return _Ilk_shared[prefix]
+
+def clearIlk_shared(prefix):
+    _Ilk_shared.pop(prefix,None)
+    for f in [prefix+'_I.npy',prefix+'_lnk.npy']:
+        if os.path.isfile(f):
+            os.remove(f)
+
+# Clintwrapper, getting the pair's Ilk from shared files by map index
+def Clintwrapper_shared(argtuple):
+    nl,dothiscross,lnkmin,lnkmax,Plnkfunc,sharedprefix,mapinds,kintlim,epsilon=argtuple
+    if not dothiscross: return 0.
+    I,lnk=readIlk_shared(sharedprefix)
+    n,lind=nl
+    i1,i2=mapinds
+    Ipair=(np.array(I[i1,lind,:]),np.array(I[i2,lind,:]))
+    lnkpair=(np.array(lnk[i1,:]),np.array(lnk[i2,:]))
+    return Clintwrapper((nl,dothiscross,lnkmin,lnkmax,Plnkfunc,Ipair,lnkpair,kintlim,epsilon))
+
 def Cl_integrand(lnk,Pk_interpfn,Ik1_interpfn,Ik2_interpfn):
     k3=np.exp(3*lnk)
     P = Pk_interpfn(lnk)
@@ -817,13 +2128,13 @@ def get_index_pairs(Nmap):
     Ncross=Nmap*(Nmap+1)/2
     crosspairs=np.zeros((Ncross,2),int) #at location crossind, pair of map ind
     crossinds=np.zeros([Nmap,Nmap],int)#at location [mapind,mapind], crossind
-    for w in xrange(Nmap):
-        for v in xrange(w,Nmap):
-            diff=v-w
-            n=w+diff*Nmap - np.sum(np.arange(diff))
-            crosspairs[n,:]=w,v
-            crossinds[w,v] = n
-            crossinds[v,w]=crossinds[w,v]
+    w,v=np.triu_indices(Nmap)
+    diff=v-w
+    n=w+diff*Nmap-diff*(diff-1)/2
+    crosspairs[n,0]=w
+    crosspairs[n,1]=v
+    crossinds[w,v]=n
+    crossinds[v,w]=n
     return crosspairs,crossinds
 
 def get_index_pairs_old(Nmap): 
@@ -858,61 +2169,32 @@ def get_pairs_fromcrossind(taglist,docrossind,crosspairs=np.array([]),crossinds=
 # return list of crossinds for which we want to compute C_l
 # if addauto=True, autocorrelations will be included even if not in other lists
 def get_docross_ind(tagdict,dopairs,crossinds=np.array([]),addauto=False):
-    #print 'in get_docross_ind: dopairs',dopairs
+    return [int(n) for n in np.where(get_domask(tagdict,dopairs,crossinds,addauto))[0]]
+
+# same, but returns bool array [crossind], True for pairs to compute
+def get_domask(tagdict,dopairs,crossinds=np.array([]),addauto=False):
+    Nmap=len(tagdict)
     if not crossinds.size:
-        crosspairs,crossinds = get_index_pairs(len(tagdict))
-    docross=[] #index of cross corrs to do
+        crosspairs,crossinds = get_index_pairs(Nmap)
+    domask=np.zeros(Nmap*(Nmap+1)/2,dtype=bool)
     #add all autocorrelations to 'do' list
     if addauto:
-        #print 'in get_docross_ind: adding autopower cls'
-        for i in xrange(len(tagdict)):
-            docross.append(crossinds[i,i])
+        domask[np.diag(crossinds)]=True
+    typeinds={} #map indices for each map type
+    for tag in tagdict:
+        typeinds.setdefault(tag[:tag.find('_bin')],[]).append(tagdict[tag])
     for pair in dopairs:
-        #print 'in get_docross_ind: on pair',pair
-        p0=pair[0]
-        p1=pair[1]
-        i0=i1=-1 #-1 means not in tagdict
-        p0isbin= '_bin' in p0
-        p1isbin= '_bin' in p1
-        #if a tag is for a specific bin, and not in tagdict, won't be computed
-        if p0isbin:
-            if (p0 in tagdict): i0 =tagdict[p0]
-            else: continue
-        if p1isbin:
-            if (p1 in tagdict): i1 =tagdict[p1]
-            else:continue
-        # add necessary docross entries to list
-        if p0isbin*p1isbin: #both individual bins
-            docross.append(crossinds[i0,i1])
-        elif p0isbin!=p1isbin: #one individual bin, one type
-            if p0isbin:
-                pbin=p0
-                ptype=p1
-                ibin=i0
-            elif p1isbin:
-                pbin=p1
-                ptype=p0
-                ibin=i1
-            for tag in tagdict:
-                new=False
-                if tag[:tag.find('_bin')]==ptype:
-                    itype = tagdict[tag]
-                    new=True
-                if new: #if a new maptype match has been found
-                    #print 'adding to computations',tag,': ',p0,p1
-                    docross.append(crossinds[i0,i1])
-        else: #both types of bin
-            i0list=[]
-            i1list=[]
-            for tag in tagdict:
-                if tag[:tag.find('_bin')]==p0: i0list.append(tagdict[tag])
-                if tag[:tag.find('_bin')]==p1: i1list.append(tagdict[tag])
-            i0i1combos= itertools.product(i0list,i1list)
-            for combo in i0i1combos:
-                docross.append(crossinds[combo[0]][combo[1]])
-                
-    docross=list(set(docross)) #remove duplicates
-    return docross
+        #tags for a specific bin give just that map, otherwise all of type;
+        # if a tag is for a specific bin, and not in tagdict, won't be computed
+        inds=[]
+        for p in (pair[0],pair[1]):
+            if '_bin' in p:
+                inds.append([tagdict[p]] if p in tagdict else [])
+            else:
+                inds.append(typeinds.get(p,[]))
+        if inds[0] and inds[1]:
+            domask[crossinds[np.ix_(inds[0],inds[1])].ravel()]=True
+    return domask
 
 #------------------------------------------------------------------------
 # given two ClData instances returns oldind: array of size newcl.Nmap, where
@@ -920,70 +2202,14 @@ def get_docross_ind(tagdict,dopairs,crossinds=np.array([]),addauto=False):
 #            that is to say newcl.bintaglist[i]=oldcl.bintaglist[oldind[i]]
 #           except: oldind[i]=-1 if tag doesn't appear in oldtaglist
 def translate_tag_inds(newcl,oldcl):
-    #old = follow indices for maplist in prev existing file
-    oldind=-1*np.ones(newcl.Nmap) #for each tag in newcl,bintaglist, its index in oldcl.bintaglist
-    #get indices of tags existing in oldbintags
-    for t in xrange(newcl.Nmap):
-        tag=newcl.bintaglist[t]
-        if tag in oldcl.bintaglist:
-            oldind[t]=oldcl.tagdict[tag]
-    return oldind
+    #for each tag in newcl.bintaglist, its index in oldcl.bintaglist, -1 if not there
+    return np.array([oldcl.tagdict.get(tag,-1) for tag in newcl.bintaglist],dtype=int)
 
 #------------------------------------------------------------------------
 def combine_old_and_new_Cl(newcl,oldcl,Overwrite=False):
     #combine new and old Cl info to write everything to file
     # if OVERWRITE; new Cl values kept even if old exist for that pair
-    Nmap = newcl.Nmap
-    Noldmap = oldcl.Nmap
-    tagdict=newcl.tagdict
-    crossinds=newcl.crossinds
-    oldxinds=oldcl.crossinds
-    
-    oldind=translate_tag_inds(newcl,oldcl)
-    
-    combotags=oldcl.bintaglist[:] #slicing makes deep copy
-    for t in xrange(Nmap): #add any new maptags
-        if oldind[t]<0: combotags.append(newcl.bintaglist[t])
-    comboNmap = len(combotags)
-    combopairs,comboxinds = get_index_pairs(comboNmap)
-    comboNcross = combopairs.shape[0]
-
-    #set up arrays to translate between old, new, combo cross indices
-    # mapindtranslate[n,0]=old tag ind of map n, [n,1]=new tag ind
-    mapindtranslate=-1*np.ones((comboNcross,2))
-    mapindtranslate[:oldcl.Nmap,0] = np.arange(oldcl.Nmap)
-    for m in xrange(len(combotags)):
-        if combotags[m] in newcl.tagdict:
-            mapindtranslate[m,1]=newcl.tagdict[combotags[m]]
-    # xindtranslate[n,0]=oldxind of combo n, [n,1]=new crossind
-    xindtranslate=-1*np.ones((comboNcross,2))
-    for n in xrange(comboNcross):
-        c0,c1=combopairs[n]
-        old0 = mapindtranslate[c0,0]
-        new0 = mapindtranslate[c0,1]
-        old1 = mapindtranslate[c1,0]
-        new1 = mapindtranslate[c1,1]
-        if old0>=0 and old1>=0:
-            xindtranslate[n,0] = oldcl.crossinds[old0,old1]
-        if new0>=0 and new1>=0:
-            xindtranslate[n,1] = newcl.crossinds[new0,new1]
-
-    #combine "do" pairs 
-    combopairs = consolidate_dotags(newcl.pairs+oldcl.pairs,combotags)
-
-    Nell = newcl.Nell
-    comboCl = np.zeros((comboNcross,Nell))
-    for n in xrange(comboNcross):
-        oldn = xindtranslate[n,0]
-        newn = xindtranslate[n,1]
-        if Overwrite and oldn>=0 and newn>=0: 
-            comboCl[n,:] = newcl.cl[newn,:]
-        elif oldn>=0: #if No overwrite, but val was in old file, copy it over
-            comboCl[n,:] = oldcl.cl[oldn,:]
-        elif newn>=0: #not in old file, but in new
-            comboCl[n,:] = newcl.cl[newn,:]
-    combocl=ClData(newcl.rundat,combotags,combopairs,clgrid=comboCl)
-    return combocl
+    return newcl.merge(oldcl,Overwrite)
 
 #------------------------------------------------------------------------
 # given list of unique tag pairs [(tag0,tag1),...] all bin tags
@@ -991,9 +2217,13 @@ def combine_old_and_new_Cl(newcl,oldcl,Overwrite=False):
 #   replace with (tag0,type) rather than (tag0,type_binX)
 #   ->assumes no duplicates in binmaplist
 def  consolidate_dotags(pairs,bintaglist):
-    #print 'CONSOLIDATING',pairs
+    tagdict = {bintaglist[m]:m for m in xrange(len(bintaglist))}
+    #get crosscorr indices for all 'do' pairs. assumes all autocorrs included
+    return consolidate_domask(get_domask(tagdict,pairs),bintaglist)
+
+# same, given bool array [crossind] marking pairs that are done
+def consolidate_domask(domask,bintaglist):
     Nmap = len(bintaglist)
-    tagdict = {bintaglist[m]:m for m in xrange(Nmap)}
     crosspairs,crossinds = get_index_pairs(Nmap)
     #get list of unique map types
     types=[]
@@ -1008,139 +2238,204 @@ def  consolidate_dotags(pairs,bintaglist):
         else:
             binind_fortype[typedict[tt]].append(n)
 
-    #get crosscorr indices for all 'do' pairs. assumes all autocorrs included
-    docross=get_docross_ind(tagdict,pairs,crossinds)
-    pairedwith=np.zeros((Nmap,Nmap)) #1 if bins assoc w/indices are paired
-    accountedfor=np.zeros((Nmap,Nmap)) #1 if this pair is in 'results'
-    for n in docross:
-        i0 = crosspairs[n,0]
-        i1 = crosspairs[n,1]
-        pairedwith[i0,i1]=pairedwith[i1,i0]=1
-
+    pairedwith=domask[crossinds] #True if bins assoc w/indices are paired
+    accountedfor=np.zeros((Nmap,Nmap),dtype=bool) #True if this pair is in 'results'
     results=[]
     for t0 in xrange(len(types)):
         binind0 = binind_fortype[t0] #list of bintag indices
         for t1 in xrange(t0,len(types)):
-            #print 'looking at type pair:',types[t0],types[t1]
             binind1 = binind_fortype[t1]
             #each b1 index has bool, true if that b1 is paired with all t0
-            pairedwithall0=[all([pairedwith[b1,b0] for b0 in binind0]) for b1 in binind1]
-            if all(pairedwithall0): #type-type match
-                #print '  type-type match!'
+            pairedwithall0=pairedwith[np.ix_(binind1,binind0)].all(axis=1)
+            if pairedwithall0.all(): #type-type match
                 results.append((types[t0],types[t1]))
                 #mark those pairs as accounted for
-                for b0 in binind0:
-                    for b1 in binind1:
-                        accountedfor[b0,b1]=accountedfor[b1,b0]=1
+                accountedfor[np.ix_(binind0,binind1)]=True
+                accountedfor[np.ix_(binind1,binind0)]=True
             else:
                 #add type-bin pairs
-                #print '  checking bin-type matches'
-                for bi1 in xrange(len(binind1)):
-                    if pairedwithall0[bi1]:
-                        #print '    adding', (types[t0],bintaglist[binind1[bi1]])
-                        results.append((types[t0],bintaglist[binind1[bi1]]))
-                        for b0 in binind0:
-                            accountedfor[b0,binind1[bi1]]=accountedfor[binind1[bi1],b0]=1
+                for bi1 in np.where(pairedwithall0)[0]:
+                    results.append((types[t0],bintaglist[binind1[bi1]]))
+                    accountedfor[binind0,binind1[bi1]]=accountedfor[binind1[bi1],binind0]=True
                 #check for bin0 bins paired with all t1
-                pairedwithall1=[all([pairedwith[b1,b0] for b1 in binind1]) for b0 in binind0]
-                for bi0 in xrange(len(binind0)):
-                    if pairedwithall1[bi0]:
-                        #print '    adding', (types[t1],bintaglist[binind0[bi0]])
-                        results.append((types[t1],bintaglist[binind0[bi0]]))
-                        for b1 in binind1:
-                            accountedfor[b1,binind0[bi0]]=accountedfor[binind0[bi0],b1]=1
+                if t1==t0: #already done above
+                    continue
+                pairedwithall1=pairedwith[np.ix_(binind1,binind0)].all(axis=0)
+                for bi0 in np.where(pairedwithall1)[0]:
+                    results.append((types[t1],bintaglist[binind0[bi0]]))
+                    accountedfor[binind1,binind0[bi0]]=accountedfor[binind0[bi0],binind1]=True
     #now, check if there are any bin-bin pairs left
-    #print ' checking for leftover bin-bin pairs'
-    for n in docross:
+    leftover=np.where(domask*np.logical_not(accountedfor[crosspairs[:,0],crosspairs[:,1]]))[0]
+    for n in leftover:
         i0 = crosspairs[n,0]
         i1 = crosspairs[n,1]
-        if not accountedfor[i0,i1]:
-            if i0!=i1:
-                #print '    adding', (bintaglist[i0],bintaglist[i1])
-                results.append((bintaglist[i0],bintaglist[i1]))
-            accountedfor[i0,i1]=accountedfor[i1,i0]=1
-    #this is just for testing
-    orphans = pairedwith*np.logical_not(accountedfor)
-    if np.any(orphans):
-        print "MISSING SOME PAIRS IN CONSOLIDATION"
-
+        if i0!=i1:
+            results.append((bintaglist[i0],bintaglist[i1]))
     return results
 #------------------------------------------------------------------------
-def readCl_file(rundata):
+# C_l files: clformat 'text' is a table with header lines listing maps,
+#  nbar, and computed pairs; 'npy' is the [crossind,ell] array as .npy with
+#  a .json sidecar holding maps, nbar, docross, and lvals. Either is read;
+#  npy files are memory mapped, so asking for a subset of maps only reads
+#  the pairs needed for them.
+clfile_ext={'npy':'.npy','text':'.dat'}
+
+def cl_filename(rundata,clformat=''):
+    if not clformat:
+        clformat=rundata.clformat
+    if rundata.tag: runtag = '_'+rundata.tag
+    else: runtag=''
+    return ''.join([rundata.cldir,'Cl',runtag,clfile_ext[clformat]])
+
+# existing C_l file for run, checking rundata.clformat first; '' if none
+def existing_cl_file(rundata):
+    for clformat in [rundata.clformat]+[f for f in rundata.clformats if f!=rundata.clformat]:
+        f=cl_filename(rundata,clformat)
+        if os.path.isfile(f):
+            return f
+    return ''
+
+#------------------------------------------------------------------------
+# map indices in bintaglist for tags in dothesemaps, in that order; entries
+#  with '_bin' are single maps, others are map types and pick out all
+#  bins of that type (eg a RecData's includecl)
+def get_mapinds_fortags(bintaglist,dothesemaps):
+    keepinds=[]
+    for m in dothesemaps:
+        if '_bin' in m: #is a specific map
+            keepinds.append(list(bintaglist).index(m))
+        else: #is a maptype
+            for mi in xrange(len(bintaglist)):
+                if m in bintaglist[mi]:
+                    keepinds.append(mi)
+    return keepinds
+
+#------------------------------------------------------------------------
+# readCl_file: returns ClData for run; cl array will be empty if file
+#   doesn't exist or has wrong lvals
+#   dothesemaps - if given, only get C_l for these maps or map types, in
+#       that order (see get_mapinds_fortags)
+def readCl_file(rundata,dothesemaps=[]):
+    infile=existing_cl_file(rundata)
+    if infile.endswith(clfile_ext['npy']):
+        return readCl_npy(infile,rundata,dothesemaps)
+    cldat=readCl_text(infile,rundata)
+    if len(dothesemaps) and cldat.Nmap:
+        cldat=get_reduced_cldata(cldat,dothesemaps)
+    return cldat
+
+# read header lines and data from a text C_l file. returns bintags, nbar,
+#  dopairs, lvals, clgrid [crossind,ell], and the run info line
+def readCl_table(infile):
+    print "Reading C_l file:", infile
+    #open infile and read the first couple lines to get maplist and dopairs
+    f=open(infile,'r')
+    h0=f.readline() #header line containing list of bin tags
+    h0b=f.readline()#header line containting nbar for each bintag (added 6/15)
+    h1=f.readline() #header line containing list of pairs of tags to do
+    bintags = h0[h0.find(':')+2:].split()
+    #Since adding the nbarline is new, check whether h0b is nbar or pairs
+    if h0b[:5]=='nbar:':
+        hasnbar=True
+        nbarstr=h0b#[h0b.find(':')+2:].split()
+        nbar=np.array([float(x) for x in nbarstr[nbarstr.find(':')+2:].split()])
+        infostr=f.readline().rstrip('\n')
+    else: #in old format, just has pairs
+        hasnbar=False
+        #leave nbar as empty array, ClData init will fill in all nbar=-1
+        nbar=[]
+        infostr=h1.rstrip('\n')
+        h1=h0b
+    f.close()
+    dopairs = [(p[:p.find('-')],p[p.find('-')+1:]) for p in h1[h1.find(':')+2:].split()]
+    dopairs=consolidate_dotags(dopairs,bintags)
+    if hasnbar:
+        data = np.loadtxt(infile,skiprows=9)
+    else:
+        data = np.loadtxt(infile,skiprows=8)
+    if len(data.shape)>1: #if more than one ell value, more than one row in file
+        l = data[:,0].astype(int)
+        clgrid = np.transpose(data[:,1:]) #first index is crosspair, second is ell
+    else: #just one row
+        l= data[0].astype(int)
+        clgrid = data[1:].reshape(data[1:].size,1)
+    return bintags,nbar,dopairs,l,clgrid,infostr
+
+# check lvals read from a file against the run's
+def check_cl_lvals(l,rundata):
+    if l.size==rundata.lvals.size:
+        if (l-rundata.lvals<rundata.epsilon).all():
+            return True
+        else:
+            print "  *** unexpected lvals, recompute"
+    else:
+        print "  *** unexpected size for lvals array, recompute"
+    return False
+
+def readCl_text(infile,rundata):
     #return Clarray, lvals, and string ids of all maps cross corr'd
     #will return empty arrays if file doesn't exist or wrong lvals
     outcl= np.array([])
     bintags=[]
     dopairs=[]
     nbar=[]
-    if rundata.tag: runtag = '_'+rundata.tag
-    else: runtag=''
-    infile = ''.join([rundata.cldir,'Cl',runtag,'.dat'])
-
-
     if os.path.isfile(infile):
-        print "Reading C_l file:", infile
-        #open infile and read the first couple lines to get maplist and dopairs
-        f=open(infile,'r')
-        h0=f.readline() #header line containing list of bin tags
-        h0b=f.readline()#header line containting nbar for each bintag (added 6/15)
-        h1=f.readline() #header line containing list of pairs of tags to do
-        f.close()
-        bintags = h0[h0.find(':')+2:].split()
-        #Since adding the nbarline is new, check whether h0b is nbar or pairs
-        if h0b[:5]=='nbar:':
-            hasnbar=True
-            nbarstr=h0b#[h0b.find(':')+2:].split()
-            nbar=np.array([float(x) for x in nbarstr[nbarstr.find(':')+2:].split()])
-        else: #in old format, just has pairs
-            hasnbar=False
-            #leave nbar as empty array, ClData init will fill in all nbar=-1
-            h1=h0b
-        dopairs = [(p[:p.find('-')],p[p.find('-')+1:]) for p in h1[h1.find(':')+2:].split()]
-        dopairs=consolidate_dotags(dopairs,bintags)
-        Nmaps = len(bintags)
-        if hasnbar:
-            data = np.loadtxt(infile,skiprows=9)
-        else:
-            data = np.loadtxt(infile,skiprows=8)
-        if len(data.shape)>1: #if more than one ell value, more than one row in file
-            l = data[:,0].astype(int)
-            clgrid = np.transpose(data[:,1:]) #first index is crosspair, second is ell
-        else: #just one row
-            l= data[0].astype(int)
-            clgrid = data[1:].reshape(data[1:].size,1)
-
+        bintags,nbar,dopairs,l,clgrid,infostr=readCl_table(infile)
         #return clgrid if l values match up, otherwise return empty array
-        if l.size==rundata.lvals.size:
-            if (l-rundata.lvals<rundata.epsilon).all():
-                outcl=clgrid
-            else:
-                print "  *** unexpected lvals, recompute"
-        else:
-            print "  *** unexpected size for lvals array, recompute"
+        if check_cl_lvals(l,rundata):
+            outcl=clgrid
 
     cldat=ClData(rundata,bintags,dopairs,outcl,nbarlist=nbar)
     return cldat#outcl,bintags,dopairs
+
+def readCl_npy(infile,rundata,dothesemaps=[]):
+    print "Reading C_l file:", infile
+    f=open(infile[:-len('.npy')]+'.json','r')
+    info=json.load(f)
+    f.close()
+    bintags=[str(tag) for tag in info['maps']]
+    nbar=np.array(info['nbar'])
+    docross=np.array(info['docross'],dtype=int)
+    cl=np.load(infile,mmap_mode='r')
+    crosspairs,crossinds=get_index_pairs(len(bintags))
+    if len(dothesemaps):
+        keepinds=np.array(get_mapinds_fortags(bintags,dothesemaps),dtype=int)
+        bintags=[bintags[i] for i in keepinds]
+        nbar=nbar[keepinds]
+        newpairs,newxinds=get_index_pairs(len(bintags))
+        rows=crossinds[keepinds[newpairs[:,0]],keepinds[newpairs[:,1]]]
+    else:
+        rows=np.arange(crosspairs.shape[0])
+    domask=np.zeros(crosspairs.shape[0],dtype=bool)
+    domask[docross]=True
+    outcl=np.array([])
+    if check_cl_lvals(np.array(info['lvals']),rundata):
+        outcl=np.array(cl[rows])
+    cldat=ClData(rundata,bintags,clgrid=outcl,nbarlist=nbar,domask=domask[rows])
+    return cldat
     
 #------------------------------------------------------------------------
+# write C_l in format rundat.clformat
 def writeCl_file(cldat):
     #cldat= a ClData class instance
-    if not cldat.hasClvals:
+    if not cldat.hasClvals():
         print "WARNING: writing file for ClData with empty cl array."
-    rundata=cldat.rundat
-    crosspairs=cldat.crosspairs
-    crossinds=cldat.crossinds
-    taglist=cldat.bintaglist
-    nbarlist=cldat.nbar
-    dopairs=cldat.pairs
-    Clgrid=cldat.cl
-    
-    if rundata.tag: runtag = '_'+rundata.tag
-    else: runtag=''
-    outfile = ''.join([rundata.cldir,'Cl',runtag,'.dat'])
-    lvals = rundata.lvals
-
+    outfile=cl_filename(cldat.rundat)
     print "Writing C_l data to file:",outfile
+    if cldat.rundat.clformat=='npy':
+        writeCl_npy(outfile,cldat.cl,cldat.bintaglist,cldat.nbar,cldat.docross,cldat.rundat.lvals,cldat.rundat.infostr)
+    else:
+        writeCl_text(outfile,cldat.cl,cldat.bintaglist,cldat.nbar,cldat.pairs,cldat.rundat.lvals,cldat.rundat.infostr)
+
+def writeCl_npy(outfile,Clgrid,taglist,nbarlist,docross,lvals,infostr):
+    np.save(outfile,np.ascontiguousarray(Clgrid,dtype=np.float64))
+    info={'maps':list(taglist),'nbar':[float(x) for x in nbarlist],'docross':sorted([int(n) for n in docross]),'lvals':[int(l) for l in lvals],'info':infostr}
+    f=open(outfile[:-len('.npy')]+'.json','w')
+    json.dump(info,f,indent=1)
+    f.close()
+
+def writeCl_text(outfile,Clgrid,taglist,nbarlist,dopairs,lvals,infostr):
+    crosspairs,crossinds=get_index_pairs(len(taglist))
     f=open(outfile,'w')
     #write info about cross corr in data; these lists will be checked
     header0 = 'Maps: '+' '.join(taglist)+'\n'
@@ -1150,11 +2445,10 @@ def writeCl_file(cldat):
     f.write(header0b)
     f.write(header1)
     #write info about run ; won't be checked but good to have
-    f.write(rundata.infostr+'\n')
+    f.write(infostr+'\n')
     f.write('##############################\n') #skiprows = 8
     
     #write column labels
-    #crosspairs,crossinds=get_index_pairs(len(taglist))
     Npairs = crosspairs.shape[0]
     colhead0 = ''.join([' {0:23s}'.format(''),''.join([' {0:23s}'.format(taglist[crosspairs[n,0]]) for n in xrange(Npairs)]),'\n'])
     colhead1 = ''.join([' {0:23s}'.format('lvals'),''.join([' {0:23s}'.format(taglist[crosspairs[n,1]]) for n in xrange(Npairs)]),'\n'])
@@ -1167,7 +2461,110 @@ def writeCl_file(cldat):
     f.write(bodystr)
     f.close()
 
+#------------------------------------------------------------------------
+# convert text C_l file to npy format, returns new filename
+def convertCl_text_to_npy(infile,removetext=False):
+    bintags,nbar,dopairs,l,clgrid,infostr=readCl_table(infile)
+    if not len(nbar):
+        nbar=-1*np.ones(len(bintags))
+    tagdict={bintags[m]:m for m in xrange(len(bintags))}
+    docross=get_docross_ind(tagdict,dopairs,addauto=True)
+    outfile=infile[:infile.rfind('.')]+clfile_ext['npy']
+    print 'Converting',infile,'to',outfile
+    writeCl_npy(outfile,clgrid,bintags,nbar,docross,l,infostr)
+    if removetext:
+        os.remove(infile)
+    return outfile
+
+# convert all text C_l files in a directory (eg cldir)
+def convertCl_dir(indir,removetext=False):
+    if indir[-1]!='/': indir+='/'
+    infiles=[indir+f for f in sorted(os.listdir(indir)) if f.endswith('.dat') and f.startswith('Cl')]
+    return [convertCl_text_to_npy(f,removetext) for f in infiles]
+
 #=========================================================================
+# transformCl:
+#   C_l for new maps which are linear combinations of the maps in cldat,
+#     new map a = sum_i W[a,i] (map i), so C'_l = W C_l W^T, done for all
+#     ells at once. Ref: Hu's lensing tomography paper
+#   W - array [Nnewmap,Nmap], columns in cldat map order
+#   newtags - tags for new maps, in order of rows of W
+#   newnbar - nbar for new maps. If not given, maps made from maps with nbar
+#       get 1/(W N W^T)[a,a], N=diag(1/nbar), the sum of their nbar when
+#       they're nbar weighted; copies of maps w/out nbar (ISW) get -1
+#   newruntag - if given, output gets a copy of cldat.rundat with this tag;
+#       otherwise rundat is shared
+#  A new pair is marked computed only if all the pairs it's built from were.
+#  output: clData object for the new maps
+def transformCl(cldat,W,newtags,newnbar=[],newruntag=''):
+    W=np.atleast_2d(W)
+    Nmap=cldat.Nmap
+    newNmap=W.shape[0]
+    usemap=W!=0
+    if not len(newnbar):
+        newnbar=-1*np.ones(newNmap)
+        hasnbar=cldat.nbar>0
+        for a in xrange(newNmap):
+            if np.all(hasnbar[usemap[a]]):
+                newnbar[a]=1./np.sum(W[a,usemap[a]]**2/cldat.nbar[usemap[a]])
+            elif np.sum(usemap[a])>1:
+                print "***WARNING, no nbar info for some maps combined into",newtags[a]
+                return
+    #C_l as symmetric [ell,map,map] array
+    newxpairs,newxinds=get_index_pairs(newNmap)
+    newcl=np.array([])
+    if cldat.hasClvals():
+        Clmat=np.zeros((cldat.Nell,Nmap,Nmap))
+        Clmat[:,cldat.crosspairs[:,0],cldat.crosspairs[:,1]]=cldat.cl.T
+        Clmat[:,cldat.crosspairs[:,1],cldat.crosspairs[:,0]]=cldat.cl.T
+        newClmat=np.matmul(np.matmul(W,Clmat),W.T)
+        newcl=newClmat[:,newxpairs[:,0],newxpairs[:,1]].T
+    #new pairs built from any pair that wasn't computed aren't computed
+    notdone=np.logical_not(cldat.domask[cldat.crossinds]).astype(float)
+    newnotdone=np.dot(np.dot(usemap,notdone),usemap.T)
+    newdomask=newnotdone[newxpairs[:,0],newxpairs[:,1]]==0
+
+    rundat=cldat.rundat
+    if newruntag and newruntag!=rundat.tag:
+        rundat=copy.copy(rundat)
+        rundat.tag=newruntag
+    outcldat=ClData(rundat,list(newtags),clgrid=newcl,nbarlist=newnbar,domask=newdomask)
+    return outcldat
+
+#-------------------------------------------------------------------------
+# combineCl_bingroups:
+#   given input cldat, make one new map for each list of tags in grouplist,
+#     combining the C_l of the bins in it, weighted by nbar, all at once.
+#     A group with one tag makes a copy of that map.
+#   combotags - tags for new maps, one per group; these are put after the
+#     original maps in the output
+#   keeporig - if True, all original maps are kept; if False, any in a group
+#     are dropped; or, a list of original map tags to keep
+#  ouptut: clData object
+def combineCl_bingroups(cldat,grouplist,combotags,newruntag='',keeporig=True):
+    ingroup=set(itertools.chain(*grouplist))
+    if isinstance(keeporig,(list,tuple,np.ndarray)):
+        keeptags=[t for t in cldat.bintaglist if t in keeporig or t not in ingroup]
+    elif keeporig:
+        keeptags=cldat.bintaglist
+    else:
+        keeptags=[t for t in cldat.bintaglist if t not in ingroup]
+    W=np.zeros((len(keeptags)+len(grouplist),cldat.Nmap))
+    for a,tag in enumerate(keeptags):
+        W[a,cldat.tagdict[tag]]=1.
+    for g,group in enumerate(grouplist):
+        mapinds=[cldat.tagdict[tag] for tag in group]
+        nbars=cldat.nbar[mapinds]
+        if len(mapinds)==1:
+            W[len(keeptags)+g,mapinds[0]]=1.
+        elif np.any(nbars<0):
+            print "***WARNING, no nbar info for one of these maps!",group
+            return
+        else:
+            W[len(keeptags)+g,mapinds]=nbars/np.sum(nbars)
+    return transformCl(cldat,W,list(keeptags)+list(combotags),newruntag=newruntag)
+
+#-------------------------------------------------------------------------
 # combineCl_twobin:
 #   given input cldat containting maps with tags tag1, tag1, combine the Cl from
 #     those bins into one larger bin. Only works if nbar are in cldat.
@@ -1175,68 +2572,8 @@ def writeCl_file(cldat):
 #        note that it should have _bin# in order to be id's as a binmap tag
 #  ouptut: clData object with one less map bin.
 def combineCl_twobin(cldat,tag1,tag2,combotag,newruntag='',keept1=False,keept2=False):
-    newNmap=cldat.Nmap-1+keept1+keept2
-    mapind1=cldat.tagdict[tag1]
-    mapind2=cldat.tagdict[tag2]
-    xind11=cldat.crossinds[mapind1,mapind1]
-    xind22=cldat.crossinds[mapind2,mapind2]
-    xind12=cldat.crossinds[mapind1,mapind2]
-    nbar1=cldat.nbar[mapind1]
-    nbar2=cldat.nbar[mapind2]
-    if nbar1<0 or nbar2<0:
-        print "***WARNING, no nbar info for one of these maps!"
-        return
-    nbartot=nbar1+nbar2
-    
-    # gather info needed to make a new clData object
-    newbintaglist=[]
-    newnbarlist=[]
-    newdocross=[]
-    for m in xrange(cldat.Nmap):
-        if (keept1 or m!=mapind1) and (keept2 or m!=mapind2):
-            newbintaglist.append(cldat.bintaglist[m])
-            newnbarlist.append(cldat.nbar[m])
-    newbintaglist.append(combotag)
-    newnbarlist.append(nbartot)
-    combomapind=newNmap-1 #map index of combined map (last entry)
-    
-    #set up structures for new output dat
-    newNcross=newNmap*(newNmap+1)/2
-    newcl=np.zeros((newNcross,cldat.Nell))
-    newxpairs,newxinds=get_index_pairs(newNmap)
-    #fill in values appropriately. Ref: Hu's lensing tomography paper
-    for n in xrange(newNcross):
-        i,j=newxpairs[n] #in new map index bases
-        if i==combomapind and j==combomapind: #both are the new combined map
-            newcl[n,:]+=nbar1*nbar1*cldat.cl[xind11,:]
-            newcl[n,:]+=nbar2*nbar2*cldat.cl[xind22,:]
-            newcl[n,:]+=2.*nbar1*nbar2*cldat.cl[xind12,:]
-            newcl[n,:]/=nbartot*nbartot
-        elif i==combomapind or j==combomapind: #just 1 is combo
-            if i==combomapind:
-                k=j #map not in combo, in new basis
-            else:
-                k=i
-            oldmapind=cldat.tagdict[newbintaglist[k]] #in old map basis
-            xind1k=cldat.crossinds[mapind1,oldmapind]
-            xind2k=cldat.crossinds[mapind2,oldmapind]
-            newcl[n,:]+=nbar1*cldat.cl[xind1k,:]
-            newcl[n,:]+=nbar2*cldat.cl[xind2k,:]
-            newcl[n,:]/=nbartot
-        else: #nether are combined map, just translate indices
-            oldi=cldat.tagdict[newbintaglist[i]]
-            oldj=cldat.tagdict[newbintaglist[j]]
-            oldxind=cldat.crossinds[oldi,oldj]
-            newcl[n,:]=cldat.cl[oldxind,:]
-        if np.any(newcl[n,:]): #not strictly accurate for combo bin; will mark
-            #  xind as computed even if only one of the constituent bins were
-            newdocross.append(n)
-
-    #construct clData object and return it
-    outcldat=ClData(copy.deepcopy(cldat.rundat),newbintaglist,clgrid=newcl,addauto=False,docrossind=newdocross,nbarlist=newnbarlist)
-    if newruntag:
-        outcldat.rundat.tag=newruntag
-    return outcldat
+    keeptags=[t for t,keep in ((tag1,keept1),(tag2,keept2)) if keep]
+    return combineCl_bingroups(cldat,[[tag1,tag2]],[combotag],newruntag,keeptags)
 
 #=========================================================================
 # renameCl_binmap:
@@ -1246,67 +2583,12 @@ def combineCl_twobin(cldat,tag1,tag2,combotag,newruntag='',keept1=False,keept2=F
 #        note that it should have _bin# in order to be id's as a binmap tag
 #  ouptut: clData object with new bin label
 def renameCl_binmap(cldat,intag,newtag,newruntag='',keeporig=True):
-    inmapind=cldat.tagdict[intag]
-    if not keeporig:#just change name in place
-        #need to change bintaglist, tagdict
-        newbintaglist=cldat.bintaglist[:]
-        newbintaglist[inmapind]=newtag
-        newtagdict=cldat.tagdict.copy()
-        newtagdict.pop(intag)
-        newtagdict[newtag]=cldat.tagdict[intag]
-        #just copy over other data
-        clgrid=cldat.cl[:,:]
-        newdocross=cldat.docross[:]
-        newnbarlist=cldat.nbar[:]
-    else:
-        newNmap=cldat.Nmap+keeporig
-        innbar=cldat.nbar[inmapind]
-        xind11=cldat.crossinds[inmapind,inmapind]#autopower of in map
-        if innbar<0:
-            print "***WARNING, no nbar info map to be copied!"
-            return
-        # gather info needed to make a new clData object
-        newbintaglist=[]
-        newnbarlist=[]
-        newdocross=[]
-        for m in xrange(cldat.Nmap):
-            newbintaglist.append(cldat.bintaglist[m])
-            newnbarlist.append(cldat.nbar[m])
-        newbintaglist.append(newtag)
-        newnbarlist.append(innbar)
-        newmapind=newNmap-1 #map index of copied map (last entry)
-    
-        #set up structures for new output dat 
-        newNcross=newNmap*(newNmap+1)/2
-        newcl=np.zeros((newNcross,cldat.Nell))
-        newxpairs,newxinds=get_index_pairs(newNmap)
-        #fill in values appropriately. Ref: Hu's lensing tomography paper
-        for n in xrange(newNcross):
-            i,j=newxpairs[n] #in new map index bases
-            if i==newmapind and j==newmapind: #both are the new copied map
-                newcl[n,:]=cldat.cl[xind11,:]
-            elif i==newmapind or j==newmapind: #just 1 is new copied map
-                if i==newmapind:
-                    k=j #the map that's not the copy, in new basis
-                else:
-                    k=i
-                oldmapind=cldat.tagdict[newbintaglist[k]] #in old map basis
-                xind1k=cldat.crossinds[inmapind,oldmapind]
-                newcl[n,:]=cldat.cl[xind1k,:]
-            else: #nether are combined map, just translate indices
-                oldi=cldat.tagdict[newbintaglist[i]]
-                oldj=cldat.tagdict[newbintaglist[j]]
-                oldxind=cldat.crossinds[oldi,oldj]
-                newcl[n,:]=cldat.cl[oldxind,:]
-            if np.any(newcl[n,:]): #not strictly accurate for combo bin; will mark
-                #  xind as computed even if only one of the constituent bins were
-                newdocross.append(n)
-
-    #construct clData object and return it
-    outcldat=ClData(copy.deepcopy(cldat.rundat),newbintaglist,clgrid=newcl,addauto=False,docrossind=newdocross,nbarlist=newnbarlist)
-    if newruntag:
-        outcldat.rundat.tag=newruntag
-    return outcldat
+    if keeporig:
+        return combineCl_bingroups(cldat,[[intag]],[newtag],newruntag)
+    #just change name in place
+    newbintaglist=cldat.bintaglist[:]
+    newbintaglist[cldat.tagdict[intag]]=newtag
+    return transformCl(cldat,np.identity(cldat.Nmap),newbintaglist,cldat.nbar,newruntag)
 
 #----------------------------------------------------------
 # combineCl_binlist:
@@ -1318,28 +2600,11 @@ def renameCl_binmap(cldat,intag,newtag,newruntag='',keeporig=True):
 #               or, if keeporig, make a copy of that bin with a new name
 #  ouptut: clData object with one less map bin.
 def combineCl_binlist(cldat,taglist,combotag,newruntag='',keeporig=True,renamesingle=False):
-    outcldat=cldat
-    origtaglist=taglist[:]
-    if newruntag:
-        outruntag=newruntag
-    else:
-        outruntag=cldat.rundat.tag
     if len(taglist)>1:
-        while len(taglist)>1:
-            tag1=taglist[0]
-            tag2=taglist[1]
-            keep1=keep2=False
-            if tag1 in origtaglist:
-                keep1=keeporig
-            if tag2 in origtaglist:
-                keep2=keeporig
-            #print 'tag1,2=',tag1,tag2
-            outcldat=combineCl_twobin(outcldat,tag1,tag2,combotag,outruntag,keep1,keep2)
-            taglist=taglist[1:]
-            taglist[0]=combotag
+        return combineCl_bingroups(cldat,[taglist],[combotag],newruntag,keeporig)
     elif renamesingle and combotag:#add a copied version of input binmap
-        outcldat=renameCl_binmap(outcldat,taglist[0],combotag,outruntag,keeporig)
-    return outcldat
+        return renameCl_binmap(cldat,taglist[0],combotag,newruntag,keeporig)
+    return cldat
 
 
 #------------------------------------------------------------------------
@@ -1347,35 +2612,4 @@ def combineCl_binlist(cldat,taglist,combotag,newruntag='',keeporig=True,renamesi
 #   returns ClData object with some maps, etc taken out;
 #   map indices of output matches order given in dothesemaps
 def get_reduced_cldata(incldat,dothesemaps=[]):
-    bintaglist=incldat.bintaglist
-    keepinds=[]
-    newtags=[]
-    newnbars=[]
-    #check that dothese maps is smaller than bintaglist
-    for m in dothesemaps: #if so construct new bintaglist 
-        if '_bin' in m: #is a specific map
-            mi = np.where(bintaglist==m)[0][0]
-            keepinds.append(mi)
-            newtags.append(m)
-            newnbars.append(incldat.nbar[mi])
-        else: #is a maptype
-            for mi in xrange(incldat.Nmap):
-                if m in bintaglist[mi]:
-                    keepinds.append(mi)
-                    newtags.append(bintaglist[mi])
-                    newnbars.append(incldat.nbar[mi])
-    # use similar alg to that constructing Dl matrices to get recuded cldata
-    newNmap = len(newtags)
-    newNcross=newNmap*(newNmap+1)/2
-    outxpairs,outxinds=get_index_pairs(newNmap)
-    outcl = np.zeros((newNcross,incldat.Nell))
-    for i in xrange(newNmap):
-        for j in xrange(i,newNmap):
-            ci=keepinds[i] #mapind of i in input cl basis
-            cj=keepinds[j] #mapind of j in input cl basis
-            cxij = incldat.crossinds[ci,cj] #crossind of ij pair in input clbasis
-            outcxij= outxinds[i,j] #crossind of ij pair in output cl basis
-            outcl[outcxij,:]=incldat.cl[cxij,:]
-
-    outcldat=ClData(incldat.rundat,newtags,incldat.pairs,outcl,nbarlist=newnbars)
-    return outcldat
+    return incldat.get_submaps(get_mapinds_fortags(incldat.bintaglist,dothesemaps))
@@ -439,8 +439,9 @@ def bintest_get_Clvals(finestN=6,z0=0.7,sigz=0.05,justread=True):
         basemaptype=bintest_get_maptypelist(finestN,['1'*finestN],z0,sigz,includeisw=False)[0]
         basemaptag=basemaptype.tag
         maptypes=bintest_get_maptypelist(finestN,['all'],z0,sigz,includeisw=False)    
-        # combine bins to get Cl for other divisions
-        FIRST=True
+        # collect bins to combine to get Cl for other divisions
+        grouplist=[]
+        outtags=[]
         for mt in maptypes:
             t=mt.tag
             print 'on maptype',t,'------'
@@ -455,13 +456,12 @@ def bintest_get_Clvals(finestN=6,z0=0.7,sigz=0.05,justread=True):
                     outtag=''.join([t,'_bin',str(i)])
                     print '   combining',intags
                     print '      to get',outtag
-                    if FIRST:
-                        nextcl=gcc.combineCl_binlist(basecl,intags,combotag=outtag,newruntag=basecl.rundat.tag+'all',renamesingle=True)
-                        FIRST=False
-                    else:
-                        nextcl=gcc.combineCl_binlist(nextcl,intags,combotag=outtag,renamesingle=True)
-                    print '   nextcl.Nmap',nextcl.Nmap,'nextcl.Ncross',nextcl.Ncross
-                    print '   len(nextcl.docross)',len(nextcl.docross)
+                    grouplist.append(intags)
+                    outtags.append(outtag)
+        #then do all combinations at once
+        nextcl=gcc.combineCl_bingroups(basecl,grouplist,outtags,newruntag=basecl.rundat.tag+'all')
+        print '   nextcl.Nmap',nextcl.Nmap,'nextcl.Ncross',nextcl.Ncross
+        print '   len(nextcl.docross)',len(nextcl.docross)
         #write to file
         gcc.writeCl_file(nextcl)
     else:
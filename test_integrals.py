@@ -13,6 +13,7 @@ from scipy.integrate import quad,romberg
 from scipy.interpolate import interp1d
 from scipy.special import sph_jn
 import time
+import os,shutil
 
 
 #################################################################
@@ -453,6 +454,654 @@ def test_Ilk_nperlogk():
             plt.savefig(outf)
             plt.close()
 
+#---------------------------------------------------
+# compare Ilk from the other ilkmethods to the quad computation, both with
+#  the krcut approx (default) and with it turned off (exact bessel fns)
+def test_Ilk_methods(REDODATA=1):
+    outdir = 'test_output/Ilktests/'
+    cosmfile = 'testparam.cosm'
+    lvals = np.array([2,5,10,19])
+    zedges=np.array([[.01,.1],[1.,1.1],[.01,3.]])
+    binlabels=['lowz','highz','widez']
+    kmin=1.e-3
+    kmax=1.
+    nperlog = 20
+    precision=1.e-10
+    methods=['quad','quad','grid','levin','fftlog']
+    runtags=['methodtest_quad','methodtest_quadnocut','methodtest_grid','methodtest_levin','methodtest_fftlog']
+    kdats=[KData(kmin=kmin,kmax=kmax,nperlogk=nperlog) for m in methods]
+    kdats[1]=KData(kmin=kmin,kmax=kmax,nperlogk=nperlog,krcutadd=-1,krcutmult=-1)
+    rundats=[ClRunData(rundir=outdir,tag=runtags[i],iswilktag=runtags[i],cosmpfile=cosmfile,lvals=lvals,zmax=5.,kdata=kdats[i],epsilon=precision,ilkmethod=methods[i]) for i in xrange(len(methods))]
+
+    maps=[]
+    for i in xrange(zedges.shape[0]):
+        maps.append(MapType(idtag='mat_'+binlabels[i],zedges=zedges[i,:]).binmaps[0])
+        maps.append(MapType(idtag='isw_'+binlabels[i],zedges=zedges[i,:],isISW=True).binmaps[0])
+    maps+=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucmethodtest').binmaps
+
+    for m in maps:
+        Idata=[]
+        for r in rundats:
+            t0=time.time()
+            Idata.append(getIlk_for_binmap(m,r,redo=REDODATA)[0])
+            print '  {0:s} time: {1:0.2f}s'.format(r.tag,time.time()-t0)
+        Idata=np.array(Idata)
+        Imax=np.fabs(Idata[1]).max(axis=1)
+        Imax[Imax==0]=1.
+        print m.tag
+        for i in xrange(2,len(methods)):
+            print '   max|{0:s}-quad|/max|quad|       '.format(methods[i]),np.fabs(Idata[i]-Idata[0]).max(axis=1)/Imax
+            print '   max|{0:s}-quad,nocut|/max|quad| '.format(methods[i]),np.fabs(Idata[i]-Idata[1]).max(axis=1)/Imax
+
+#---------------------------------------------------
+# fftlog grid sizes and time per ell for the Euclid-like bins; before N was
+#  rounded to a fast FFT length, bin4 got N=2*60761 and took ~10s per ell
+def test_Ilk_fftlog_fastlen(l=10):
+    outdir = 'test_output/Ilktests/'
+    rundat=ClRunData(rundir=outdir,tag='fastlentest',lvals=np.array([l]),zmax=5.,kdata=KData(kmin=1.e-3,kmax=1.,nperlogk=20),ilkmethod='fftlog')
+    cosm=rundat.cosm
+    cosm.tabulateZdep(rundat.zmax,nperz=cosm.nperz)
+    kvals=rundat.kdata.karray
+    for m in get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucfastlentest').binmaps:
+        rmin=cosm.co_r(m.zmin)
+        rmax=cosm.co_r(m.zmax)
+        Nrmin=Ilk_grid_Nrmin(m,cosm,rundat.ilkgrid_nperz,rundat.ilkgrid_nperedge)
+        N=fftlog_gridsize(kvals,rundat.kdata.nperlogk,rmin,rmax,Nrmin,rundat.fftlog_padlogk)[0]
+        maxfactor=N
+        for p in (2,3,5):
+            while not maxfactor%p and maxfactor>p:
+                maxfactor/=p
+        t0=time.time()
+        Iintwrapper_fftlog((l,kvals,rundat.kdata.nperlogk,rmin,rmax,cosm,m,Nrmin,rundat.fftlog_padlogk,rundat.fftlog_q,rundat.epsilon,rundat.besselxmincut))
+        print '  {0:s}: N={1:d}, largest factor {2:d} (should be <=5), {3:0.3f}s for l={4:d}'.format(m.tag,N,maxfactor,time.time()-t0,l)
+
+#---------------------------------------------------
+# check that Ilk cache keys depend on window and run settings, not tags
+def test_Ilk_cachekeys():
+    outdir = 'test_output/Ilktests/'
+    kdat=KData(kmin=1.e-3,kmax=1.,nperlogk=20)
+    rundat=ClRunData(rundir=outdir,tag='cachekeyA',lvals=np.array([2,5]),zmax=5.,kdata=kdat)
+    samerundat=ClRunData(rundir=outdir,tag='cachekeyB',iswilktag='other',lvals=np.arange(10),zmax=3.,kdata=KData(kmin=1.e-4,kmax=10.,nperlogk=20))
+    diffrundats=[ClRunData(rundir=outdir,tag='cachekeyC',lvals=np.array([2,5]),zmax=5.,kdata=kdat,epsilon=1.e-8),ClRunData(rundir=outdir,tag='cachekeyD',lvals=np.array([2,5]),zmax=5.,kdata=KData(kmin=1.e-3,kmax=1.,nperlogk=30)),ClRunData(rundir=outdir,tag='cachekeyE',lvals=np.array([2,5]),zmax=5.,kdata=kdat,ilkmethod='grid')]
+    m=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps[0]
+    samem=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='renamed').binmaps[0]
+    diffm=get_Euclidlike_SurveyType(z0=0.6,onebin=True,tag='eucz07').binmaps[0]
+    key=rundat.ilkhash(m)
+    print 'same window, new tags, k range, lvals: ',key==samerundat.ilkhash(samem),' (should be True)'
+    print 'different window: ',key==rundat.ilkhash(diffm),' (should be False)'
+    print 'different eps, nperlogk, ilkmethod: ',[key==r.ilkhash(m) for r in diffrundats],' (should be False)'
+
+#---------------------------------------------------
+# write Ilk as text, convert to npy, and check both read back the same
+def test_Ilk_npyformat():
+    outdir = 'test_output/Ilktests/'
+    cachedir = outdir+'formattest_cache/'
+    kdat=KData(kmin=1.e-3,kmax=1.,nperlogk=20)
+    textrundat=ClRunData(rundir=outdir,tag='formattest',lvals=np.arange(6),limberl=4,zmax=5.,kdata=kdat,ilkmethod='grid',ilkformat='text',ilkcachedir=cachedir)
+    npyrundat=ClRunData(rundir=outdir,tag='formattest',lvals=np.arange(6),limberl=4,zmax=5.,kdata=kdat,ilkmethod='grid',ilkformat='npy',ilkcachedir=cachedir)
+    m=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps[0]
+    Itext=getIlk_for_binmap(m,textrundat,redo=True)[0]
+    convertIlk_text_to_npy(existing_ilk_file(m,textrundat),removetext=True)
+    t0=time.time()
+    Inpy=getIlk_for_binmap(m,npyrundat)[0]
+    print 'npy read time: {0:0.4f}s'.format(time.time()-t0)
+    print 'max|I_npy-I_text| =',np.fabs(Inpy-Itext).max(),' (should be 0)'
+
+#---------------------------------------------------
+# compute Ilk for a few ell and k, then ask for more; check that the
+#  extended table matches computing everything at once
+def test_Ilk_extend(method='grid'):
+    outdir = 'test_output/Ilktests/'
+    cachedir = outdir+'extendtest_cache/'
+    if os.path.isdir(cachedir):
+        shutil.rmtree(cachedir)
+    smallrundat=ClRunData(rundir=outdir,tag='extendtest',lvals=np.array([2,5]),zmax=5.,kdata=KData(kmin=1.e-3,kmax=1.e-1,nperlogk=10),ilkmethod=method,ilkcachedir=cachedir)
+    bigrundat=ClRunData(rundir=outdir,tag='extendtest',lvals=np.array([2,5,10]),zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=10),ilkmethod=method,ilkcachedir=cachedir)
+    m=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps[0]
+    getIlk_for_binmap(m,smallrundat)
+    t0=time.time()
+    Iext,kext=getIlk_for_binmap(m,bigrundat)
+    t1=time.time()
+    Ifull=computeIlk(m,bigrundat,writefile=False)
+    t2=time.time()
+    print 'times: extend {0:0.2f}s, full {1:0.2f}s'.format(t1-t0,t2-t1)
+    print 'k match:',np.allclose(kext,bigrundat.kdata.karray)
+    print 'max|extended-full|/max|full| ',np.fabs(Iext-Ifull).max(axis=1)/np.fabs(Ifull).max(axis=1)
+
+#---------------------------------------------------
+# mimic an interrupted Ilk run: keep the saved chunks but drop one, then
+#  check that rerunning only redoes the missing one and gets same answer
+def test_Ilk_resume(method='quad'):
+    outdir = 'test_output/Ilktests/'
+    cachedir = outdir+'resumetest_cache/'
+    if os.path.isdir(cachedir):
+        shutil.rmtree(cachedir)
+    rundat=ClRunData(rundir=outdir,tag='resumetest',lvals=np.array([2,5,10]),zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=20),ilkmethod=method,ilkcachedir=cachedir)
+    rundat.ilkchunk_nk=20
+    m=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps[0]
+    t0=time.time()
+    Ifirst=computeIlk(m,rundat,writefile=False) #leaves chunks in place
+    t1=time.time()
+    chunkdir=ilk_chunkdir(m,rundat)
+    chunkfiles=sorted(os.listdir(chunkdir))
+    print len(chunkfiles),'chunks saved; removing',chunkfiles[0]
+    os.remove(chunkdir+chunkfiles[0])
+    Iresume=computeIlk(m,rundat)
+    t2=time.time()
+    print 'times: first {0:0.2f}s, resumed {1:0.2f}s'.format(t1-t0,t2-t1)
+    print 'max|resumed-first| =',np.fabs(Iresume-Ifirst).max(),' (should be 0)'
+    print 'chunks cleared after writing:',not os.path.isdir(chunkdir)
+
+#---------------------------------------------------
+# check scheduled (batched, expensive-first) Ilk tasks give the same
+#  results as running them serially, and show the batch sizes used
+def test_Ilk_scheduler(method='quad'):
+    outdir = 'test_output/Ilktests/'
+    rundat=ClRunData(rundir=outdir,tag='schedtest',lvals=np.array([2,5,10]),zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=20),ilkmethod=method,ilkcachedir=outdir+'schedtest_cache/')
+    m=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps[0]
+    cosm=rundat.cosm
+    cosm.tabulateZdep(rundat.zmax,nperz=cosm.nperz)
+    rmin=cosm.co_r(m.zmin)
+    rmax=cosm.co_r(m.zmax)
+    lvals=rundat.lvals
+    kvals=rundat.kdata.karray
+    tasks=[(0,lind,kind) for lind in xrange(lvals.size) for kind in xrange(kvals.size)]
+    costs=Ilk_taskcosts(rundat,m,rmin,rmax,lvals,kvals,tasks)
+    batches=schedule_batches(costs,cpu_count())
+    print len(tasks),'tasks in',len(batches),'batches; batch sizes:',[len(b) for b in batches]
+    argiter=[((lvals[t[1]],kvals[t[2]]),rmin,rmax,cosm,m,rundat.kdata.krcutadd,rundat.kdata.krcutmult,10000,rundat.epsilon,rundat.sharpkcut,rundat.besselxmincut) for t in tasks]
+    Iser=np.zeros(len(tasks))
+    Ipar=np.zeros(len(tasks))
+    for t,I,dt in run_scheduled(Iintwrapper,argiter,costs,DOPARALLEL=False):
+        Iser[t]=I
+    for t,I,dt in run_scheduled(Iintwrapper,argiter,costs,DOPARALLEL=True):
+        Ipar[t]=I
+    print 'max|scheduled-serial| =',np.fabs(Ipar-Iser).max(),' (should be 0)'
+
+#---------------------------------------------------
+# compare Ilk computed for all bins of a survey together against
+#  computing them one bin at a time
+def test_Ilk_batch(method='grid'):
+    outdir = 'test_output/Ilktests/'
+    cachedir = outdir+'batchtest_cache/'
+    if os.path.isdir(cachedir):
+        shutil.rmtree(cachedir)
+    rundat=ClRunData(rundir=outdir,tag='batchtest',lvals=np.array([2,5,10,19]),zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=50),ilkmethod=method,ilkcachedir=cachedir)
+    rundat.useilkshells=False
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucbatchtest').binmaps
+    t0=time.time()
+    Isingle=np.array([computeIlk(m,rundat,writefile=False) for m in maps])
+    t1=time.time()
+    for m in maps: #so batch doesn't resume from single-map chunks
+        clear_ilk_chunks(m,rundat)
+    Ibatch=computeIlk_batch(maps,rundat)
+    t2=time.time()
+    print '{0:d} maps, times: one at a time {1:0.2f}s, batched {2:0.2f}s'.format(len(maps),t1-t0,t2-t1)
+    for n,m in enumerate(maps):
+        print '  ',m.tag,' max|batch-single|/max|single| ',np.fabs(Ibatch[n]-Isingle[n]).max(axis=1)/np.fabs(Isingle[n]).max(axis=1)
+
+#---------------------------------------------------
+# compare non-Limber C_l from clmethod='grid' (one weighted sum over
+#  the ln k grid) against the adaptive quad reference, same Ilk for both
+def test_Cl_grid(ilkmethod='grid'):
+    outdir = 'test_output/Cltests/'
+    kdat=KData(kmin=1.e-4,kmax=1.,nperlogk=50)
+    quadrundat=ClRunData(rundir=outdir,tag='clquadtest',lmax=19,limberl=-1,zmax=5.,kdata=kdat,ilkmethod=ilkmethod)
+    gridrundat=ClRunData(rundir=outdir,tag='clgridtest',lmax=19,limberl=-1,zmax=5.,kdata=kdat,ilkmethod=ilkmethod,clmethod='grid')
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucgridtest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    getIlk_for_binmaplist(maps,quadrundat) #so timing is just C_l
+    t0=time.time()
+    quaddat=computeCl(maps,quadrundat,dopairs=dopairs)
+    t1=time.time()
+    gridcl=computeCl(maps,gridrundat,dopairs=dopairs).cl
+    t2=time.time()
+    print 'C_l times: quad {0:0.2f}s, grid {1:0.4f}s'.format(t1-t0,t2-t1)
+    quadcl=quaddat.cl
+    #compare relative to sqrt(C_l^ii C_l^jj), since some cross C_l ~0
+    auto=quadcl[quaddat.crossinds[np.arange(len(maps)),np.arange(len(maps))],2:]
+    norm=np.sqrt(auto[quaddat.crosspairs[:,0]]*auto[quaddat.crosspairs[:,1]])
+    reldiff=np.fabs(gridcl-quadcl)[:,2:]/norm
+    print 'max_l |grid-quad|/sqrt(C_l^ii C_l^jj) for each pair:'
+    print reldiff.max(axis=1)
+    print 'max|grid-quad| = {0:0.2e}; quad abs tolerance is 2/pi*eps = {1:0.2e}'.format(np.fabs(gridcl-quadcl).max(),2./np.pi*quadrundat.epsilon)
+
+#---------------------------------------------------
+# check that C_l computed by workers reading Ilk from shared memory mapped
+#  files match Clintwrapper called directly on the Ilk arrays
+def test_Cl_sharedIlk():
+    outdir = 'test_output/Cltests/'
+    rundat=ClRunData(rundir=outdir,tag='clsharedtest',lmax=19,limberl=-1,zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=50),ilkmethod='grid')
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucgridtest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    cldat=computeCl(maps,rundat,dopairs=dopairs)
+    Igrid,kforIgrid=getIlk_for_binmaplist(maps,rundat)
+    Plnk = interp1d(np.log(rundat.cosm.k_forPower),rundat.cosm.P_forPower,bounds_error=False,fill_value=0.)
+    lnkmin=np.log(rundat.kdata.kmin)
+    lnkmax=np.log(rundat.kdata.kmax)
+    maxdiff=0.
+    for xind in xrange(cldat.Ncross):
+        i1,i2=cldat.crosspairs[xind]
+        for lind in [2,10,19]:
+            direct=Clintwrapper(((xind,lind),True,lnkmin,lnkmax,Plnk,(Igrid[i1][lind],Igrid[i2][lind]),(np.log(kforIgrid[i1]),np.log(kforIgrid[i2])),rundat.kintlim,rundat.epsilon))
+            maxdiff=max(maxdiff,np.fabs(direct-cldat.cl[xind,lind]))
+    print 'max|shared-direct| =',maxdiff,' (should be 0)'
+    print 'shared files left in cldir:',[f for f in os.listdir(rundat.cldir) if f.startswith('Ilk_shared')]
+
+#---------------------------------------------------
+# C_l from each executor mode should be identical; the run's workers are
+#  started once, reused for Ilk, non-Limber, and Limber stages, and closed
+#  when computeCl returns
+def test_executor_modes():
+    outdir = 'test_output/Cltests/'
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucexectest').binmaps[:3]
+    maps+=get_fullISW_MapType(zmax=5).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    cls={}
+    for mode in TaskExecutor.modes:
+        cachedir=outdir+'exectest_cache/'
+        if os.path.isdir(cachedir):
+            shutil.rmtree(cachedir)
+        rundat=ClRunData(rundir=outdir,tag='exectest_'+mode,lmax=25,limberl=20,zmax=5.,kdata=KData(kmin=1.e-4,kmax=1.,nperlogk=10),ilkcachedir=cachedir,executormode=mode)
+        t0=time.time()
+        cls[mode]=computeCl(maps,rundat,dopairs=dopairs).cl
+        print mode,'time: {0:0.2f}s'.format(time.time()-t0)
+        print '  workers left running:',rundat.executor.pool is not None,' context left:',sorted(rundat.executor.context.keys()),' (should be False, cosm only)'
+    for mode in TaskExecutor.modes[1:]:
+        print 'max|{0:s}-{1:s}| ='.format(mode,TaskExecutor.modes[0]),np.fabs(cls[mode]-cls[TaskExecutor.modes[0]]).max(),' (should be 0)'
+
+#---------------------------------------------------
+# compare Limber C_l from limbermethod='grid' (sums on a shared z grid)
+#  against the per-(pair,ell) quad reference
+def test_Limber_grid(lmax=95):
+    outdir = 'test_output/Cltests/'
+    quadrundat=ClRunData(rundir=outdir,tag='limbquadtest',lmax=lmax,limberl=0,zmax=5.)
+    gridrundat=ClRunData(rundir=outdir,tag='limbgridtest',lmax=lmax,limberl=0,zmax=5.,limbermethod='grid')
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='euclimbtest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    maps+=MapType(idtag='mat_widez',zedges=[.01,3.]).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    t0=time.time()
+    quaddat=computeCl(maps,quadrundat,dopairs=dopairs)
+    t1=time.time()
+    gridcl=computeCl(maps,gridrundat,dopairs=dopairs).cl
+    t2=time.time()
+    print 'Limber C_l times: quad {0:0.2f}s, grid {1:0.2f}s'.format(t1-t0,t2-t1)
+    quadcl=quaddat.cl
+    auto=quadcl[quaddat.crossinds[np.arange(len(maps)),np.arange(len(maps))],2:]
+    norm=np.sqrt(auto[quaddat.crosspairs[:,0]]*auto[quaddat.crosspairs[:,1]])
+    reldiff=np.fabs(gridcl-quadcl)[:,2:]/norm
+    print 'max_l |grid-quad|/sqrt(C_l^ii C_l^jj) for each pair:'
+    print reldiff.max(axis=1)
+
+#---------------------------------------------------
+# with cloverlap_tol set, pairs of bins whose windows barely overlap aren't
+#  computed or recorded in the C_l file; computing them later with
+#  cloverlap_tol=0 fills them in, and the other pairs are unchanged
+def test_Cl_overlap_prune(tol=1.e-3,lmax=30):
+    outdir = 'test_output/Cltests/'
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucoverlaptest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    rundat=ClRunData(rundir=outdir,tag='overlaptest',lmax=lmax,limberl=0,zmax=5.)
+    overlap=window_overlaps(maps)
+    print 'window overlaps:'
+    print overlap
+    fulldat=getCl(maps,rundat,dopairs=['all'],redoAllCl=True,DoNotOverwrite=False)
+    rundat.cloverlap_tol=tol
+    t0=time.time()
+    prunedat=getCl(maps,rundat,dopairs=['all'],redoAllCl=True,DoNotOverwrite=False)
+    print 'time with pruning: {0:0.2f}s'.format(time.time()-t0)
+    skipped=[x for x in fulldat.docross if x not in prunedat.docross]
+    print 'skipped pairs:',[(prunedat.bintaglist[prunedat.crosspairs[x,0]],prunedat.bintaglist[prunedat.crosspairs[x,1]]) for x in skipped]
+    storeddocross=readCl_file(rundat).docross
+    print '  not in stored docross:',not any(x in storeddocross for x in skipped)
+    print '  max |C_l| for full run:',np.fabs(fulldat.cl[skipped,:]).max() if skipped else 0.
+    print 'other pairs unchanged:',np.all(fulldat.cl[prunedat.docross]==prunedat.cl[prunedat.docross])
+    rundat.cloverlap_tol=0.
+    filldat=getCl(maps,rundat,dopairs=['all'],DoNotOverwrite=False)
+    print 'filled in later:',np.all(filldat.cl==fulldat.cl)
+
+#---------------------------------------------------
+# check transformCl on made-up C_l: combining two bins matches the nbar
+#  weighted sum written out by hand, and all partitions of N bins made in
+#  one combineCl_bingroups call match chaining combineCl_binlist
+def test_Cl_transform(N=6,lmax=30):
+    outdir = 'test_output/Cltests/'
+    rundat=ClRunData(rundir=outdir,tag='transformtest',lmax=lmax)
+    tags=['isw_bin0']+['gal_bin{0:d}'.format(i) for i in xrange(N)]
+    Nmap=len(tags)
+    A=np.random.randn(rundat.lvals.size,Nmap,Nmap)
+    Clmat=np.matmul(A,A.transpose(0,2,1))
+    crosspairs,crossinds=get_index_pairs(Nmap)
+    nbar=np.array([-1.]+list(1.e8*np.random.rand(N)))
+    basecl=ClData(rundat,tags,clgrid=Clmat[:,crosspairs[:,0],crosspairs[:,1]].T,docrossind=range(crosspairs.shape[0]),nbarlist=nbar)
+    
+    combocl=combineCl_binlist(basecl,['gal_bin1','gal_bin2'],'gal12_bin0')
+    n1,n2=nbar[2],nbar[3]
+    expect=(n1*n1*Clmat[:,2,2]+n2*n2*Clmat[:,3,3]+2*n1*n2*Clmat[:,2,3])/(n1+n2)**2
+    c=combocl.tagdict['gal12_bin0']
+    print 'two bins: rel diff',np.max(np.fabs(combocl.cl[combocl.crossinds[c,c]]-expect)/expect),' nbar',combocl.nbar[c]/(n1+n2)
+
+    #all ways to split N bins into contiguous groups
+    grouplist=[]
+    combotags=[]
+    for d,divs in enumerate(itertools.product([0,1],repeat=N-1)):
+        edges=[0]+[i+1 for i in xrange(N-1) if divs[i]]+[N]
+        for b in xrange(len(edges)-1):
+            grouplist.append(tags[1+edges[b]:1+edges[b+1]])
+            combotags.append('div{0:d}_bin{1:d}'.format(d,b))
+    t0=time.time()
+    chaincl=basecl
+    for group,tag in zip(grouplist,combotags):
+        chaincl=combineCl_binlist(chaincl,group,tag,renamesingle=True)
+    t1=time.time()
+    onecl=combineCl_bingroups(basecl,grouplist,combotags)
+    t2=time.time()
+    print '{0:d} partitions: chained {1:0.2f}s, one pass {2:0.2f}s'.format(2**(N-1),t1-t0,t2-t1)
+    print '  same maps:',chaincl.bintaglist==onecl.bintaglist,' max rel diff',np.max(np.fabs(chaincl.cl-onecl.cl))/np.max(np.fabs(onecl.cl))
+
+#---------------------------------------------------
+# write made-up C_l as text and npy, check that both read back the same,
+#  that converting the text file gives the npy one, and that reading a
+#  subset of maps from the npy file matches get_reduced_cldata
+def test_Cl_npyformat(N=20,lmax=95):
+    outdir = 'test_output/Cltests/'
+    textrundat=ClRunData(rundir=outdir,tag='clformattest_text',lmax=lmax,clformat='text')
+    npyrundat=ClRunData(rundir=outdir,tag='clformattest_npy',lmax=lmax,clformat='npy')
+    tags=['isw_bin0']+['gal_bin{0:d}'.format(i) for i in xrange(N)]
+    crosspairs,crossinds=get_index_pairs(len(tags))
+    nbar=np.array([-1.]+list(1.e8*np.random.rand(N)))
+    cl=np.random.rand(crosspairs.shape[0],textrundat.lvals.size)
+    docross=[crossinds[i,j] for i in xrange(len(tags)) for j in xrange(i,len(tags)) if j-i<4]
+    for rundat in [textrundat,npyrundat]:
+        writeCl_file(ClData(rundat,tags,clgrid=cl,docrossind=docross,nbarlist=nbar))
+    t0=time.time()
+    textcl=readCl_file(textrundat)
+    t1=time.time()
+    npycl=readCl_file(npyrundat)
+    t2=time.time()
+    print 'read times: text {0:0.3f}s, npy {1:0.3f}s'.format(t1-t0,t2-t1)
+    print '  same C_l:',np.all(textcl.cl==npycl.cl),np.max(np.fabs(npycl.cl-cl)),' same docross:',sorted(textcl.docross)==sorted(npycl.docross)==sorted(docross)
+    
+    convfile=convertCl_text_to_npy(cl_filename(textrundat,'text'))
+    textrundat.clformat='npy'
+    convcl=readCl_file(textrundat)
+    print 'converted: same C_l',np.all(convcl.cl==textcl.cl),' same docross',sorted(convcl.docross)==sorted(docross)
+    
+    includecl=['isw_bin0','gal_bin3','gal_bin5','gal_bin4']
+    subcl=readCl_file(npyrundat,includecl)
+    redcl=get_reduced_cldata(npycl,includecl)
+    print 'subset:',subcl.bintaglist,' same C_l',np.all(subcl.cl==redcl.cl),' same docross',sorted(subcl.docross)==sorted(redcl.docross)
+    
+#---------------------------------------------------
+# ClData pair bookkeeping: getCl reusing stored C_l for some maps matches
+#  computing all at once, and merge/get_submaps/deletemap on made-up C_l
+#  for many maps keep values and docross with the right pairs
+def test_ClData_arrays(N=60):
+    outdir = 'test_output/Cltests/'
+    rundat=ClRunData(rundir=outdir,tag='cldatatest',lmax=30,limberl=0,zmax=5.,limbermethod='grid')
+    allrundat=ClRunData(rundir=outdir,tag='cldatatest_all',lmax=30,limberl=0,zmax=5.,limbermethod='grid')
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='euccldatatest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    getCl(maps[:-3],rundat,dopairs=['all'],redoAllCl=True,DoNotOverwrite=False)
+    partcl=getCl(maps,rundat,dopairs=['all'],DoNotOverwrite=False)
+    allcl=getCl(maps,allrundat,dopairs=['all'],redoAllCl=True,DoNotOverwrite=False)
+    print 'getCl reusing stored pairs: max rel diff',np.max(np.fabs(partcl.cl-allcl.cl))/np.max(np.fabs(allcl.cl)),' same docross',partcl.docross==allcl.docross
+
+    tags=['gal{0:d}_bin{1:d}'.format(i/10,i%10) for i in xrange(N)]
+    crosspairs,crossinds=get_index_pairs(N)
+    #C_l^ij=i+j/N, so values can be checked after maps are moved around
+    cl=np.tile((crosspairs[:,0]+crosspairs[:,1]/float(N))[:,np.newaxis],(1,rundat.lvals.size))
+    domask=(crosspairs[:,1]-crosspairs[:,0])<5
+    cldat=ClData(rundat,tags,clgrid=cl,nbarlist=np.arange(1.,N+1),domask=domask)
+    def checkvals(c):
+        inds=np.array([tags.index(t) for t in c.bintaglist])
+        i0=inds[c.crosspairs[:,0]]
+        i1=inds[c.crosspairs[:,1]]
+        lo=np.minimum(i0,i1)
+        hi=np.maximum(i0,i1)
+        return np.all(c.cl[:,0]==lo+hi/float(N)) and np.all(c.domask==(hi-lo<5))
+    #subset leaves out map 7, so after it's deleted, merging the subset back
+    # can't bring in pairs of map 7 that were never computed
+    subinds=np.array([i for i in np.random.RandomState(0).permutation(N) if i!=7][:N/2])
+    t0=time.time()
+    sub=cldat.get_submaps(subinds)
+    t1=time.time()
+    cldat.deletemap(tags[7])
+    t2=time.time()
+    merged=cldat.merge(sub)
+    t3=time.time()
+    pairs=merged.pairs
+    t4=time.time()
+    print 'subset+reorder {0:0.4f}s, delete {1:0.4f}s, merge {2:0.4f}s, pairs {3:0.4f}s'.format(t1-t0,t2-t1,t3-t2,t4-t3)
+    print '  values ok: subset',checkvals(sub),' delete',checkvals(cldat),' merge',checkvals(merged),' N merged',merged.Nmap
+
+#---------------------------------------------------
+# C_l from sparse ells (clsparse=True) vs computing every ell
+def test_Cl_sparse(lmax=1000,limberl=20):
+    outdir = 'test_output/Cltests/'
+    settings=dict(rundir=outdir,lmax=lmax,limberl=limberl,zmax=5.,ilkmethod='grid',clmethod='grid',limbermethod='grid')
+    fullrundat=ClRunData(tag='sparsetest_full',**settings)
+    sparserundat=ClRunData(tag='sparsetest',clsparse=True,**settings)
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucsparsetest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    computeCl(maps,fullrundat,dopairs=dopairs) #so both use stored Ilk
+    t0=time.time()
+    fulldat=computeCl(maps,fullrundat,dopairs=dopairs)
+    t1=time.time()
+    sparsedat=computeCl(maps,sparserundat,dopairs=dopairs)
+    t2=time.time()
+    print 'C_l times: all ells {0:0.2f}s, sparse {1:0.2f}s'.format(t1-t0,t2-t1)
+    err=np.fabs(sparsedat.cl-fulldat.cl)/sparseCl_norm(fulldat.cl,fulldat.crosspairs,fulldat.crossinds)
+    print 'max_l |sparse-full|/sqrt(C_l^ii C_l^jj) for each pair (tol {0:g}):'.format(sparserundat.clsparse_tol)
+    print err.max(axis=1)
+
+#---------------------------------------------------
+# per-pair Limber switch (limberauto=True) vs computing all ells exactly
+def test_Limber_auto(lmax=60):
+    outdir = 'test_output/Cltests/'
+    settings=dict(rundir=outdir,lmax=lmax,zmax=5.,ilkmethod='grid',clmethod='grid',limbermethod='grid')
+    exactrundat=ClRunData(tag='limbautotest_exact',limberl=-1,**settings)
+    autorundat=ClRunData(tag='limbautotest',limberauto=True,**settings)
+    maps=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='euclimbautotest').binmaps
+    maps+=get_fullISW_MapType(zmax=15).binmaps
+    types=list(set([m.typetag for m in maps]))
+    dopairs=[(t0,t1) for t0 in types for t1 in types]
+    exactdat=computeCl(maps,exactrundat,dopairs=dopairs)
+    t0=time.time()
+    autodat=computeCl(maps,autorundat,dopairs=dopairs)
+    print 'time with limberauto: {0:0.2f}s'.format(time.time()-t0)
+    lswitch=limber_switch(maps,autorundat,autodat.docross)
+    err=np.fabs(autodat.cl-exactdat.cl)/sparseCl_norm(exactdat.cl,exactdat.crosspairs,exactdat.crossinds)
+    print 'pair, switch ell, max_l |auto-exact|/sqrt(C_l^ii C_l^jj) (tol {0:g}):'.format(autorundat.limberauto_tol)
+    for x in autodat.docross:
+        print '  {0:s}-{1:s} {2:6.1f} {3:0.2e}'.format(autodat.bintaglist[autodat.crosspairs[x,0]],autodat.bintaglist[autodat.crosspairs[x,1]],lswitch[x],err[x].max())
+
+#---------------------------------------------------
+# background tabulation: one cumulative Gauss-Legendre pass vs a quad
+#  integral for each z
+def test_cosm_tabmethods(zmax=15.,nperz=200):
+    outdir = 'test_output/ztabulation/'
+    cosmfile = 'testparam.cosm'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    quadcosm=Cosmology(cosmfile,cambdir=outdir,tabmethod='quad')
+    gausscosm=Cosmology(cosmfile,cambdir=outdir,tabmethod='gauss')
+    t0=time.time()
+    quadcosm.tabulateZdep(zmax,nperz,overwritefile=True)
+    t1=time.time()
+    gausscosm.tabulateZdep(zmax,nperz,overwritefile=True)
+    t2=time.time()
+    print 'tabulation times: quad {0:0.3f}s, gauss {1:0.3f}s'.format(t1-t0,t2-t1)
+    for name in ['r_array','H_array','g_array','f_array']:
+        q=getattr(quadcosm,name)
+        g=getattr(gausscosm,name)
+        print '  {0:s} max rel diff {1:0.2e}'.format(name,np.max(np.fabs(g-q)[1:]/np.fabs(q[1:])))
+
+#---------------------------------------------------
+# UniformSpline background fns vs the interp1d ones they replaced, values
+#  and time per scalar call
+def test_cosm_splines(zmax=15.,nperz=200,Ncall=20000):
+    outdir = 'test_output/ztabulation/'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    cosm=Cosmology('testparam.cosm',cambdir=outdir)
+    cosm.tabulateZdep(zmax,nperz)
+    tabs={'co_r':(cosm.z_array,cosm.r_array),'z_from_cor':(cosm.r_array,cosm.z_array),'growth':(cosm.z_array,cosm.g_array),'growthrate':(cosm.z_array,cosm.f_array)}
+    for name in tabs:
+        x,y=tabs[name]
+        oldfn=interp1d(x,y,kind='cubic',bounds_error=False,fill_value=0.)
+        newfn=getattr(cosm,name)
+        xtest=np.random.uniform(x[0]-.01*x[-1],1.01*x[-1],Ncall)
+        t0=time.time()
+        for xx in xtest:
+            oldfn(xx)
+        t1=time.time()
+        for xx in xtest:
+            newfn(xx)
+        t2=time.time()
+        print '{0:s}: max |diff| {1:0.2e}, per call: interp1d {2:0.2f}us, UniformSpline {3:0.2f}us'.format(name,np.max(np.fabs(newfn(xtest)-oldfn(xtest))),(t1-t0)/Ncall*1.e6,(t2-t1)/Ncall*1.e6)
+
+#---------------------------------------------------
+# stored background tables: a table extended from a lower zmax matches one
+#  made in one go, lower zmax are read from it, and different params get
+#  a different file
+def test_cosm_bkgdcache(zmax=15.,nperz=200):
+    outdir = 'test_output/ztabulation/'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for tabmethod in ['gauss','quad']:
+        cosm=Cosmology('testparam.cosm',cambdir=outdir,tabmethod=tabmethod)
+        f=cosm.bkgd_filename(nperz)
+        if os.path.isfile(f):
+            os.remove(f)
+        cosm.tabulateZdep(2.,nperz)
+        t0=time.time()
+        cosm.tabulateZdep(zmax,nperz)
+        t1=time.time()
+        extended=np.array([cosm.r_array,cosm.g_array,cosm.f_array])
+        cosm.tabulateZdep(zmax,nperz,overwritefile=True)
+        t2=time.time()
+        full=np.array([cosm.r_array,cosm.g_array,cosm.f_array])
+        print '{0:s}: extend from zmax=2 {1:0.3f}s, all from z=0 {2:0.3f}s; max rel diff {3:0.2e}'.format(tabmethod,t1-t0,t2-t1,np.max(np.fabs(extended-full)[:,1:]/np.fabs(full[:,1:])))
+        cosm.tabulateZdep(1.,nperz)
+        print '  zmax=1 read from stored table:',cosm.zmax==1. and np.all(cosm.r_array==full[0,:cosm.r_array.size])
+    cosm.h0*=1.01
+    print 'different file after changing h0:',cosm.bkgd_filename(nperz)!=f
+
+#---------------------------------------------------
+# background fns for many cosmologies from one tabulate_bkgd_batch call vs
+#  tabulating each Cosmology, and ClRunData made from a batch
+def test_cosm_batch(N=100,zmax=15.,nperz=200):
+    outdir = 'test_output/ztabulation/'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    Och2=np.linspace(.10,.14,N)
+    paramlist=[{'Och2':x} for x in Och2]
+    t0=time.time()
+    cosmlist=[Cosmology('testparam.cosm',cambdir=outdir,params=p) for p in paramlist]
+    for cosm in cosmlist:
+        cosm.tabulateZdep(zmax,nperz,overwritefile=True)
+    t1=time.time()
+    Om=np.array([cosm.Om for cosm in cosmlist])
+    zrhgf=tabulate_bkgd_batch(Om,-1.,zmax,nperz)
+    t2=time.time()
+    print '{0:d} cosmologies: one at a time {1:0.3f}s, batch {2:0.3f}s'.format(N,t1-t0,t2-t1)
+    single=np.array([[cosm.r_array,cosm.H_array,cosm.g_array,cosm.f_array] for cosm in cosmlist])
+    print '  max rel diff',np.max(np.fabs(zrhgf[:,1:,1:]-single[:,:,1:])/np.fabs(single[:,:,1:]))
+    rundatlist=get_ClRunData_batch(paramlist[:3],['batchtest{0:d}'.format(n) for n in xrange(3)],zmax=zmax,nperz=nperz,rundir='test_output/Cltests/',lmax=10)
+    print 'ClRunData Och2:',[rundat.cosm.Och2 for rundat in rundatlist],'vs',list(Och2[:3])
+    print 'ClRunData r(z=1):',[rundat.cosm.co_r(1.) for rundat in rundatlist],'vs',[cosm.co_r(1.) for cosm in cosmlist[:3]]
+
+#---------------------------------------------------
+# P(k) from pkmethod='eh': timing, sigma8 with the .cosm As, and that the
+#  sigma8-normalized mode hits the requested value
+def test_Pk_eh(kmin=1.e-5,kmax=10.):
+    t0=time.time()
+    cosm=Cosmology('testparam.cosm',needPk=True,kmin=kmin,kmax=kmax,pkmethod='eh')
+    t1=time.time()
+    print 'EH getPk: {0:0.4f}s, {1:d} k pts'.format(t1-t0,cosm.k_forPower.size)
+    print '  sigma8 from As={0:0.3g}: {1:0.4f}'.format(cosm.As,cosm.sigmaR(8.))
+    print '  P(k=.01,.1,1)=',np.interp([.01,.1,1.],cosm.k_forPower,cosm.P_forPower)
+    cosm8=Cosmology('testparam.cosm',needPk=True,kmin=kmin,kmax=kmax,pkmethod='eh',params={'sigma8':0.8})
+    P8=interp1d(cosm8.k_forPower,cosm8.P_forPower)
+    k=np.logspace(-4,1,2001)
+    x=8.*k
+    W=3.*(np.sin(x)-x*np.cos(x))/x**3
+    print '  sigma8 of normalized P(k):',np.sqrt(np.trapz(k**3*P8(k)*W**2/(2.*np.pi**2),np.log(k))),'(want 0.8)'
+    print '  ',cosm8.infostr
+
+#---------------------------------------------------
+# compare Ilk built from a shell basis to Ilk computed directly on a grid
+def test_Ilk_shellbasis(REDOBASIS=1):
+    outdir = 'test_output/Ilktests/'
+    cosmfile = 'testparam.cosm'
+    lvals = np.array([2,5,10,19])
+    kdat=KData(kmin=1.e-3,kmax=1.,nperlogk=20)
+    shellrundat=ClRunData(rundir=outdir,tag='shelltest',cosmpfile=cosmfile,lvals=lvals,zmax=5.,kdata=kdat,ilkmethod='grid')
+    gridrundat=ClRunData(rundir=outdir,tag='shelltest_grid',cosmpfile=cosmfile,lvals=lvals,zmax=5.,kdata=kdat,ilkmethod='grid')
+    gridrundat.useilkshells=False
+    if REDOBASIS or getIlk_shellbasis(shellrundat) is None:
+        t0=time.time()
+        computeIlk_shellbasis(shellrundat)
+        print 'shell basis time: {0:0.2f}s'.format(time.time()-t0)
+
+    maps=[MapType(idtag='mat_widez',zedges=[.01,3.]).binmaps[0],MapType(idtag='isw_widez',zedges=[.01,3.],isISW=True).binmaps[0]]
+    maps+=get_Euclidlike_SurveyType(sigz=0.05,z0=0.7,tag='eucshelltest').binmaps
+    maps+=get_Euclidlike_SurveyType(z0=0.7,onebin=True,tag='eucz07').binmaps
+    for m in maps:
+        t0=time.time()
+        Ishell=getIlk_for_binmap(m,shellrundat,redo=True)[0]
+        t1=time.time()
+        Igrid=getIlk_for_binmap(m,gridrundat,redo=True)[0]
+        t2=time.time()
+        print m.tag,' times: shells {0:0.2f}s, grid {1:0.2f}s'.format(t1-t0,t2-t1)
+        print '   max|shell-grid|/max|grid| ',np.fabs(Ishell-Igrid).max(axis=1)/np.fabs(Igrid).max(axis=1)
+
+#---------------------------------------------------
+# compare Cl computed with ilkmethod='fftlog' against the stored (quad)
+#  depthtest Cl from run_euclidlike_analysis, ell by ell
+def test_Cl_fftlog_vsstored(REDODATA=1):
+    refdir='output/depthtest/'
+    outdir='test_output/fftlogtest/'
+    lmax=95
+    z0vals=[.3,.5,.6,.7,.8]
+    maps=get_fullISW_MapType(zmax=15).binmaps
+    for z0 in z0vals:
+        maps+=get_Euclidlike_SurveyType(z0=z0,onebin=True,tag='eucz{0:02d}'.format(int(10*z0))).binmaps
+    zmax=max(m.zmax for m in maps)
+    refrundat=ClRunData(tag='depthtest',rundir=refdir,lmax=lmax,zmax=zmax)
+    rundat=ClRunData(tag='depthtest_fftlog',rundir=outdir,lmax=lmax,zmax=zmax,ilkmethod='fftlog')
+    t0=time.time()
+    cldat=getCl(maps,rundat,dopairs=['all'],DoNotOverwrite=not REDODATA)
+    print 'fftlog Cl time: {0:0.2f}s'.format(time.time()-t0)
+    refcl=readCl_file(refrundat)
+    for l in xrange(cldat.Nell):
+        maxdiff=0.
+        worst=''
+        for i in xrange(refcl.Nmap):
+            for j in xrange(i,refcl.Nmap):
+                tags=(refcl.bintaglist[i],refcl.bintaglist[j])
+                if tags[0] not in cldat.tagdict or tags[1] not in cldat.tagdict:
+                    continue
+                refval=refcl.cl[refcl.crossinds[i,j],l]
+                if refval==0:
+                    continue
+                n=cldat.crossinds[cldat.tagdict[tags[0]],cldat.tagdict[tags[1]]]
+                diff=np.fabs(cldat.cl[n,l]/refval-1.)
+                if diff>maxdiff:
+                    maxdiff=diff
+                    worst='-'.join(tags)
+        print 'l={0:3d}: max|fftlog/stored-1|={1:0.2e} ({2:s})'.format(cldat.rundat.lvals[l],maxdiff,worst)
+
 #---------------------------------------------------
 # to evaluate whether kmax, kmin are sufficient, look at I^2 k^3 P(k)
 def eyeball_Ilk_convergence():
@@ -1470,6 +2119,31 @@ if __name__=="__main__":
     #test_Ilk_krcut()
     #test_Ilk_nperlogk()
     #eyeball_Ilk_convergence()
+    #test_Ilk_methods()
+    #test_Ilk_fftlog_fastlen()
+    #test_Cl_fftlog_vsstored()
+    #test_Ilk_shellbasis()
+    #test_Ilk_cachekeys()
+    #test_Ilk_npyformat()
+    #test_Ilk_extend()
+    #test_Ilk_resume()
+    #test_Ilk_scheduler()
+    #test_Ilk_batch()
+    #test_Cl_grid()
+    #test_Cl_sharedIlk()
+    #test_executor_modes()
+    #test_Limber_grid()
+    #test_Cl_overlap_prune()
+    #test_Cl_transform()
+    #test_Cl_npyformat()
+    #test_ClData_arrays()
+    #test_Cl_sparse()
+    #test_Limber_auto()
+    #test_cosm_tabmethods()
+    #test_cosm_splines()
+    #test_cosm_bkgdcache()
+    #test_cosm_batch()
+    #test_Pk_eh()
 
     if 0:
         test_Cl_nperlogk() 